@@ -35,20 +35,60 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import argparse
+import binascii
+import bisect
 import codecs
+import fnmatch
+import ctypes
+import ctypes.util
 import hashlib
+import heapq
+import json
 import logging
+import mmap
 import multiprocessing
+import multiprocessing.pool
+import numbers
 import os
+import random
 import re
+import select
 import signal
+import socket
+import sqlite3
+import struct
 import sys
 import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
 from datetime import date
 from functools import partial
 from os.path import abspath, isdir, isfile, join
 from pkg_resources import DistributionNotFound, get_distribution
 
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    from collections.abc import ItemsView, MutableMapping, ValuesView
+except ImportError:  # Python 2
+    from collections import ItemsView, MutableMapping, ValuesView
+
+try:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import asyncio
+except ImportError:  # Python 2 has no asyncio; the *_async API is unavailable
+    asyncio = None
+
 MODULE_NAME = 'bagit' if __name__ == '__main__' else __name__
 
 LOGGER = logging.getLogger(MODULE_NAME)
@@ -77,18 +117,134 @@ STANDARD_BAG_INFO_HEADERS = [
     # Payload-Oxum is autogenerated
 ]
 
-CHECKSUM_ALGOS = ['md5', 'sha1', 'sha256', 'sha512']
+#: Names of the hash algorithms which bagit.py knows about. Algorithms added
+#: with register_hash_algorithm() are appended to this list.
+CHECKSUM_ALGOS = []
+
+#: Candidate implementations for each hash algorithm, keyed by the name used
+#: in manifest file names. See register_hash_algorithm().
+HASH_ALGORITHMS = {}
+
+# Cache of the implementation chosen for each algorithm by _hash_factory()
+_SELECTED_HASH_FACTORIES = {}
+
+# Settings found by tune() for processes='auto' when none were recorded with
+# persist=True, keyed by _tuning_key()
+_TUNED_SETTINGS = {}
+_TUNED_SETTINGS_LOCK = threading.Lock()
+
+#: Size of the blocks in which files are read and passed to the hashers
+HASH_BLOCK_SIZE = 1048576
+
+#: Number of directories listed at once when walking a tree, which
+#: mostly helps on network filesystems; 1 lists them in the calling thread
+WALK_THREADS = 16
+
+# Thread pools kept by _walk_pool() for the life of the process
+_WALK_POOLS = {}
+_WALK_POOLS_LOCK = threading.Lock()
+
+#: Name of the binary index of the manifests kept in the bag directory by
+#: Bag(path, index=True)
+MANIFEST_INDEX = '.manifest-index'
+
+#: Where tune(persist=True) records the settings chosen for each mount point
+TUNING_CACHE = os.path.join(os.path.expanduser('~'), '.bagit-tuning.json')
 
 #: Convenience function used everywhere we want to open a file to read text
 #: rather than undecoded bytes:
 open_text_file = partial(codecs.open, encoding='utf-8', errors='strict')
 
 
-def make_bag(bag_dir, bag_info=None, processes=1, checksum=None):
+def register_hash_algorithm(name, factory):
+    """
+    Makes a hash algorithm available for creating and validating manifests
+    and tagmanifests named manifest-<name>.txt. factory is a callable
+    returning a new hash object with the hashlib update() and hexdigest()
+    interface; it should raise ImportError or ValueError if the
+    implementation is not available on this system.
+
+    Several implementations may be registered under the same name: the
+    fastest one which is available and produces the same digests as the
+    others is picked the first time the algorithm is used.
+    """
+    HASH_ALGORITHMS.setdefault(name, []).append(factory)
+    _SELECTED_HASH_FACTORIES.pop(name, None)
+    if name not in CHECKSUM_ALGOS:
+        CHECKSUM_ALGOS.append(name)
+
+
+def _blake3():
+    import blake3
+    return blake3.blake3()
+
+
+def _xxhash_factory(name):
+    def factory():
+        import xxhash
+        return getattr(xxhash, name)()
+    return factory
+
+
+# OpenSSL backed hashlib constructors use the CPU's SHA and AVX extensions
+# where available, so they are already the fastest implementation for these
+for _alg in ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512', 'sha3_256', 'sha3_512'):
+    register_hash_algorithm(_alg, partial(hashlib.new, _alg))
+del _alg
+
+# hashlib ships the reference BLAKE2 implementation while OpenSSL 1.1+ has
+# its own; both are registered and the faster one wins
+register_hash_algorithm('blake2b', partial(hashlib.new, 'blake2b512'))
+register_hash_algorithm('blake2b', partial(hashlib.new, 'blake2b'))
+register_hash_algorithm('blake2s', partial(hashlib.new, 'blake2s256'))
+register_hash_algorithm('blake2s', partial(hashlib.new, 'blake2s'))
+
+# Optional third party backends
+register_hash_algorithm('blake3', _blake3)
+register_hash_algorithm('xxh64', _xxhash_factory('xxh64'))
+register_hash_algorithm('xxh3_64', _xxhash_factory('xxh3_64'))
+register_hash_algorithm('xxh128', _xxhash_factory('xxh3_128'))
+
+
+def make_bag(bag_dir, bag_info=None, processes=1, checksum=None, journal=None, dedupe=False,
+             digest_store=None, fadvise=False, device_processes=None, rollup=False, pool=None):
     """
     Convert a given directory into a bag. You can pass in arbitrary
     key/value pairs to put into the bag-info.txt metadata file as
     the bag_info dictionary.
+
+    processes may be 'auto' to use the settings recorded by tune() for the
+    directory's filesystem, or to calibrate them on the spot; the settings
+    calibrated are reused for that filesystem for the life of the process.
+
+    If the path of a journal file is given, the digests of the payload
+    files are recorded in it as they are calculated. Calling make_bag again
+    with the same journal after an interruption carries on where it left
+    off rather than moving the payload again and re-hashing every file.
+
+    With dedupe=True, files which are hard links to the same inode are only
+    read once and share their digests in the manifests.
+
+    A DigestStore shared between bags supplies the digests of files it has
+    already seen, and records those of the others.
+
+    fadvise=True keeps hashing from flushing the page cache of other
+    programs on the same host, where os.posix_fadvise is available: files
+    are read sequentially, the next one is prefetched and the pages read
+    are dropped from the cache afterwards.
+
+    For payloads spread over several disks, device_processes maps a path on
+    each device (such as its mount point) to the number of processes which
+    should read from it. The files on each device are then hashed by their
+    own workers, with processes used for any device not listed.
+
+    rollup=True also writes the per-directory digests used by
+    Bag.validate_subtree() and Bag.changed_directories().
+
+    A long-running program can pass the multiprocessing or thread pool it
+    keeps as pool, which is then used for hashing instead of a pool
+    being started for this call; processes and device_processes are then
+    ignored.
     """
     bag_dir = os.path.abspath(bag_dir)
     LOGGER.info("creating bag for directory %s", bag_dir)
@@ -100,15 +256,20 @@ def make_bag(bag_dir, bag_info=None, processes=1, checksum=None):
         LOGGER.error("no such bag directory %s", bag_dir)
         raise RuntimeError("no such bag directory %s" % bag_dir)
 
-    old_dir = os.path.abspath(os.path.curdir)
-    os.chdir(bag_dir)
+    # fail before any of the payload has been moved
+    for c in checksum:
+        if _hash_factory(c) is None:
+            raise RuntimeError("unknown algorithm %s" % c)
+
+    if journal is not None:
+        journal = Journal(journal)
 
     try:
-        unbaggable = _can_bag(os.curdir)
+        unbaggable = _can_bag(bag_dir)
         if unbaggable:
             LOGGER.error("no write permissions for the following directories and files: \n%s", unbaggable)
             raise BagError("Not all files/folders can be moved.")
-        unreadable_dirs, unreadable_files = _can_read(os.curdir)
+        unreadable_dirs, unreadable_files = _can_read(bag_dir)
         if unreadable_dirs or unreadable_files:
             if unreadable_dirs:
                 LOGGER.error("The following directories do not have read permissions: \n%s", unreadable_dirs)
@@ -116,32 +277,45 @@ def make_bag(bag_dir, bag_info=None, processes=1, checksum=None):
                 LOGGER.error("The following files do not have read permissions: \n%s", unreadable_files)
             raise BagError("Read permissions are required to calculate file fixities.")
         else:
-            LOGGER.info("creating data dir")
+            data_dir = join(bag_dir, 'data')
+
+            if journal is not None and journal.payload_moved(bag_dir) and isdir(data_dir):
+                LOGGER.info("resuming creation of %s with the payload already in %s", bag_dir, data_dir)
+            else:
+                LOGGER.info("creating data dir")
 
-            cwd = os.getcwd()
-            temp_data = tempfile.mkdtemp(dir=cwd)
+                temp_data = tempfile.mkdtemp(dir=bag_dir)
 
-            for f in os.listdir('.'):
-                if os.path.abspath(f) == temp_data:
-                    continue
-                new_f = os.path.join(temp_data, f)
-                LOGGER.info("moving %s to %s", f, new_f)
-                os.rename(f, new_f)
+                for f in os.listdir(bag_dir):
+                    old_f = join(bag_dir, f)
+                    if old_f == temp_data:
+                        continue
+                    new_f = join(temp_data, f)
+                    LOGGER.info("moving %s to %s", old_f, new_f)
+                    os.rename(old_f, new_f)
+
+                LOGGER.info("moving %s to %s", temp_data, data_dir)
+                os.rename(temp_data, data_dir)
 
-            LOGGER.info("moving %s to %s", temp_data, 'data')
-            os.rename(temp_data, 'data')
+                # permissions for the payload directory should match those of the
+                # original directory
+                os.chmod(data_dir, os.stat(bag_dir).st_mode)
 
-            # permissions for the payload directory should match those of the
-            # original directory
-            os.chmod('data', os.stat(cwd).st_mode)
+                if journal is not None:
+                    journal.record_payload_moved(bag_dir)
 
-            for c in checksum:
-                LOGGER.info("writing manifest-%s.txt", c)
-                Oxum = _make_manifest('manifest-%s.txt' % c, 'data', processes, algorithm=c, encoding='utf-8')
+            payload_entries = {}
+            Oxum = _make_manifests(bag_dir, processes, algorithms=checksum, encoding='utf-8',
+                                   digest_cache=_digest_cache(journal, digest_store), dedupe=dedupe,
+                                   fadvise=fadvise, device_processes=device_processes,
+                                   entries=payload_entries, pool=pool)
+
+            if rollup:
+                _make_rollups(bag_dir, payload_entries, checksum, encoding='utf-8')
 
             LOGGER.info("writing bagit.txt")
             txt = """BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n"""
-            with open_text_file('bagit.txt', 'w') as bagit_file:
+            with open_text_file(join(bag_dir, 'bagit.txt'), 'w') as bagit_file:
                 bagit_file.write(txt)
 
             LOGGER.info("writing bag-info.txt")
@@ -154,37 +328,464 @@ def make_bag(bag_dir, bag_info=None, processes=1, checksum=None):
             if 'Bag-Software-Agent' not in bag_info:
                 bag_info['Bag-Software-Agent'] = 'bagit.py v' + VERSION + ' <http://github.com/libraryofcongress/bagit-python>'
             bag_info['Payload-Oxum'] = Oxum
-            _make_tag_file('bag-info.txt', bag_info)
+            _make_tag_file(join(bag_dir, 'bag-info.txt'), bag_info)
 
-            for c in checksum:
-                _make_tagmanifest_file(c, bag_dir, encoding='utf-8')
+            _make_tagmanifests(bag_dir, checksum, encoding='utf-8')
     except Exception:
         LOGGER.exception("An error occurred creating the bag")
         raise
     finally:
-        os.chdir(old_dir)
+        if journal is not None:
+            journal.close()
 
     return Bag(bag_dir)
 
 
+def make_bag_async(bag_dir, bag_info=None, processes=1, checksum=None, executor=None, journal=None,
+                   dedupe=False, digest_store=None, fadvise=False, device_processes=None,
+                   rollup=False, pool=None):
+    """
+    asyncio counterpart of make_bag: returns an awaitable which resolves to
+    the new Bag once it has been created. Bag creation runs on the supplied
+    concurrent.futures executor (or the event loop's default executor) so
+    the event loop is never blocked.
+
+    Since make_bag moves the payload into place before generating the
+    manifests, cancelling the awaitable only stops waiting for the result:
+    creation of a bag which has already started runs to completion rather
+    than leaving a half-built bag behind.
+    """
+    _require_asyncio()
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(executor, partial(make_bag, bag_dir, bag_info=bag_info,
+                                                  processes=processes, checksum=checksum,
+                                                  journal=journal, dedupe=dedupe,
+                                                  digest_store=digest_store, fadvise=fadvise,
+                                                  device_processes=device_processes,
+                                                  rollup=rollup, pool=pool))
+
+
+def write_json_lines(results, stream, bag=None, include=None, exclude=None):
+    """
+    Writes the FileValidationResults from results (e.g. Bag.iter_validate())
+    to stream as JSON Lines as they arrive: a record for each algorithm each
+    file was checked with, then a summary record with the totals and the
+    throughput, which is also returned. If validation stops with a BagError
+    the summary records it before the error is raised again; a validation
+    which ran out of time is not valid, and is marked as incomplete. The include
+    and exclude patterns of a partial validation are recorded in the
+    summary, which is then marked as partial.
+    """
+    start = time.time()
+    statuses = {}
+    files = 0
+    total_bytes = 0
+    error = None
+    try:
+        for result in results:
+            for record in result.to_records():
+                stream.write(json.dumps(record, sort_keys=True) + '\n')
+            stream.flush()
+            files += 1
+            total_bytes += result.bytes or 0
+            statuses[result.status] = statuses.get(result.status, 0) + 1
+    except BagError as e:
+        error = e
+        raise
+    finally:
+        duration = time.time() - start
+        summary = {
+            'type': 'summary',
+            'bag': bag.path if bag is not None else None,
+            'files': files,
+            'bytes': total_bytes,
+            'duration': duration,
+            'bytes_per_second': total_bytes / duration if duration else None,
+            'statuses': statuses,
+            'valid': error is None and statuses.get(FileValidationResult.OK, 0) == files,
+            'error': force_unicode(error) if error is not None else None,
+            'partial': bool(include or exclude),
+            'complete': not isinstance(error, BagValidationIncomplete),
+        }
+        if include or exclude:
+            summary['include'] = list(include or ())
+            summary['exclude'] = list(exclude or ())
+        stream.write(json.dumps(summary, sort_keys=True) + '\n')
+        stream.flush()
+    return summary
+
+
+def diff_bags(old_bag_dir, new_bag_dir, algorithm=None, chunk_size=100000):
+    """
+    Yields a PayloadChange for each payload file added to, removed from,
+    modified in or renamed in new_bag_dir compared with old_bag_dir.
+
+    The manifests are compared by merging them in path order, spilling
+    sorted runs of chunk_size entries to temporary files, so neither is
+    ever held in memory in full. The manifests for algorithm are used, or
+    for the first algorithm the two bags have in common.
+    """
+    if isinstance(old_bag_dir, Bag):
+        old_bag_dir = old_bag_dir.path
+    if isinstance(new_bag_dir, Bag):
+        new_bag_dir = new_bag_dir.path
+
+    old_encoding, old_algs = _manifest_algorithms(old_bag_dir)
+    new_encoding, new_algs = _manifest_algorithms(new_bag_dir)
+
+    if algorithm is None:
+        common = [alg for alg in old_algs if alg in new_algs]
+        if not common:
+            raise BagError("%s and %s have no manifest algorithm in common" % (old_bag_dir, new_bag_dir))
+        algorithm = common[0]
+    elif algorithm not in old_algs or algorithm not in new_algs:
+        raise BagError("%s and %s do not both have a %s manifest" % (old_bag_dir, new_bag_dir, algorithm))
+
+    old_manifest = join(old_bag_dir, "manifest-%s.txt" % algorithm)
+    new_manifest = join(new_bag_dir, "manifest-%s.txt" % algorithm)
+    return _diff_entries(_iter_manifest(old_manifest, old_encoding, old_bag_dir),
+                         _iter_manifest(new_manifest, new_encoding, new_bag_dir),
+                         chunk_size)
+
+
+def diff_manifests(old_manifest, new_manifest, encoding='utf-8', chunk_size=100000):
+    """
+    Yields a PayloadChange for each difference between two versions of a
+    manifest file, as for diff_bags()
+    """
+    return _diff_entries(_iter_manifest(old_manifest, encoding, old_manifest),
+                         _iter_manifest(new_manifest, encoding, new_manifest),
+                         chunk_size)
+
+
+def _manifest_algorithms(bag_dir):
+    """
+    Returns the tag file encoding of the bag in bag_dir and the algorithms
+    of its payload manifests, without loading them
+    """
+    bagit_file_path = join(bag_dir, "bagit.txt")
+    if not isfile(bagit_file_path):
+        raise BagError("No bagit.txt found: %s" % bagit_file_path)
+    encoding = _load_tag_file(bagit_file_path).get("Tag-File-Character-Encoding", "utf-8")
+    algorithms = [alg for alg in CHECKSUM_ALGOS if isfile(join(bag_dir, "manifest-%s.txt" % alg))]
+    return encoding, algorithms
+
+
+def _diff_entries(old_entries, new_entries, chunk_size):
+    """
+    Compares two streams of (path, digest) entries by a sorted merge on
+    path, then pairs the removed and added files by a sorted merge on
+    digest to find those which were renamed
+    """
+    removed, removed_runs = [], []
+    added, added_runs = [], []
+    old_sorted = _external_sort(old_entries, chunk_size)
+    new_sorted = _external_sort(new_entries, chunk_size)
+    old = next(old_sorted, None)
+    new = next(new_sorted, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            removed.append((old[1].lower(), old[0]))
+            old = next(old_sorted, None)
+        elif old is None or new[0] < old[0]:
+            added.append((new[1].lower(), new[0]))
+            new = next(new_sorted, None)
+        else:
+            if old[1].lower() != new[1].lower():
+                yield PayloadChange(PayloadChange.MODIFIED, new[0], old_digest=old[1], new_digest=new[1])
+            old = next(old_sorted, None)
+            new = next(new_sorted, None)
+
+        # spill long runs of additions and removals to disk as well
+        if len(removed) >= chunk_size:
+            removed_runs.append(_spill(removed))
+            removed = []
+        if len(added) >= chunk_size:
+            added_runs.append(_spill(added))
+            added = []
+
+    removed = _external_sort(_unspill(removed_runs, removed), chunk_size)
+    added = _external_sort(_unspill(added_runs, added), chunk_size)
+    old = next(removed, None)
+    new = next(added, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield PayloadChange(PayloadChange.REMOVED, old[1], old_digest=old[0])
+            old = next(removed, None)
+        elif old is None or new[0] < old[0]:
+            yield PayloadChange(PayloadChange.ADDED, new[1], new_digest=new[0])
+            new = next(added, None)
+        else:
+            yield PayloadChange(PayloadChange.RENAMED, new[1], old_path=old[1],
+                                old_digest=old[0], new_digest=new[0])
+            old = next(removed, None)
+            new = next(added, None)
+
+
+def _external_sort(records, chunk_size):
+    """
+    Returns an iterator over the tuples from records in sorted order,
+    holding no more than chunk_size of them in memory by writing sorted runs to temporary files
+    and merging those
+    """
+    runs = []
+    chunk = []
+    for record in records:
+        chunk.append(tuple(record))
+        if len(chunk) >= chunk_size:
+            chunk.sort()
+            runs.append(_iter_run(_spill(chunk)))
+            chunk = []
+    chunk.sort()
+
+    if not runs:
+        return iter(chunk)
+    runs.append(iter(chunk))
+    return heapq.merge(*runs)
+
+
+def _spill(records):
+    """Writes records to a temporary file, returning it for _iter_run"""
+    f = tempfile.TemporaryFile()
+    for record in records:
+        f.write((json.dumps(record) + '\n').encode('ascii'))
+    f.seek(0)
+    return f
+
+
+def _iter_run(f):
+    with f:
+        for line in f:
+            yield tuple(json.loads(line.decode('ascii')))
+
+
+def _unspill(runs, records):
+    """Yields the records spilled to each of runs followed by records"""
+    for run in runs:
+        for record in _iter_run(run):
+            yield record
+    for record in records:
+        yield record
+
+
+def tune(path, algorithms=None, sample_bytes=67108864, persist=False, cache_file=None):
+    """
+    Runs a short micro-benchmark against the filesystem holding path and
+    returns the hashing settings which should give the best throughput
+    there, as a dictionary with these keys:
+
+        processes: the number of hashing workers
+        executor: 'process' for a multiprocessing pool or 'thread' for a
+                  thread pool, which avoids process start-up and pickling
+                  costs when the hash implementations release the GIL
+        block_size: the size of the blocks files are read in
+
+    Up to sample_bytes of the files below path are read to measure serial
+    and concurrent read throughput, and the hash throughput of the
+    algorithms (md5 by default) is measured in memory. If persist is True
+    the result is recorded in cache_file (TUNING_CACHE by default) for the
+    mount point of path, where processes='auto' will find it.
+    """
+    if not algorithms:
+        algorithms = ['md5']
+    algorithms = sorted(set(a for a in algorithms if _hash_factory(a) is not None))
+    cpus = multiprocessing.cpu_count()
+
+    block_size = _tune_block_size(algorithms)
+    hash_rate = _measure_hash_rate(algorithms, block_size)
+    thread_scaling = _measure_thread_scaling(algorithms, block_size) if cpus > 1 else 1.0
+
+    sample = _sample_files(path, sample_bytes)
+    half = len(sample) // 2
+    serial_rate = _measure_read_rate(sample[:half] or sample, block_size, 1)
+    concurrent_rate = _measure_read_rate(sample[half:], block_size, min(4, cpus))
+    read_rate = max(serial_rate, concurrent_rate)
+
+    if read_rate and hash_rate:
+        # enough workers to keep up with the storage, but no more than the
+        # CPUs can hash at once
+        processes = int(min(cpus, max(1, -(-read_rate // hash_rate))))
+    else:
+        processes = cpus
+
+    mean_size = sum(size for _, size in sample) / len(sample) if sample else 0
+    if thread_scaling >= 1.5 and mean_size >= block_size:
+        executor = 'thread'
+    else:
+        executor = 'process'
+
+    settings = {'processes': processes, 'executor': executor, 'block_size': block_size}
+    LOGGER.info("tuned %s for %s: hash rate %d B/s, read rate %d B/s (serial %d B/s), thread scaling %.2f: %s",
+                path, ', '.join(algorithms), hash_rate, read_rate, serial_rate, thread_scaling, settings)
+
+    if persist:
+        _save_tuning(path, algorithms, settings, cache_file)
+
+    return settings
+
+
+def _tuning_key(path, algorithms):
+    return '%s|%s' % (_mount_point(path), ','.join(sorted(set(algorithms))))
+
+
+def _load_tuning(path, algorithms, cache_file=None):
+    cache_file = cache_file or TUNING_CACHE
+    try:
+        with open_text_file(cache_file, 'r') as f:
+            return json.load(f).get(_tuning_key(path, algorithms))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _save_tuning(path, algorithms, settings, cache_file=None):
+    cache_file = cache_file or TUNING_CACHE
+    try:
+        with open_text_file(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        cache = {}
+    cache[_tuning_key(path, algorithms)] = settings
+    LOGGER.info("recording tuned settings in %s", cache_file)
+    with open_text_file(cache_file, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+def _hashing_settings(processes, path, algorithms):
+    """
+    Returns the settings to hash with: the tuned settings for path when
+    processes is 'auto', otherwise the requested number of processes
+    """
+    if processes == 'auto':
+        settings = _load_tuning(path, algorithms)
+        if settings is None:
+            # only benchmark each mount point once per process
+            key = _tuning_key(path, algorithms)
+            with _TUNED_SETTINGS_LOCK:
+                if key not in _TUNED_SETTINGS:
+                    _TUNED_SETTINGS[key] = tune(path, algorithms)
+                settings = _TUNED_SETTINGS[key]
+        return settings
+    return {'processes': processes, 'executor': 'process', 'block_size': HASH_BLOCK_SIZE}
+
+
+def _mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def _sample_files(path, sample_bytes):
+    sample = []
+    total = 0
+    for dirpath, dirnames, filenames in _walk_tree(path):
+        for fn in filenames:
+            full_path = os.path.join(dirpath, fn)
+            try:
+                size = os.path.getsize(full_path)
+            except OSError:
+                continue
+            if size == 0 or not os.access(full_path, os.R_OK):
+                continue
+            sample.append((full_path, size))
+            total += size
+            if total >= sample_bytes:
+                return sample
+    return sample
+
+
+def _measure_read_rate(sample, block_size, threads):
+    if not sample:
+        return 0
+
+    def read(item):
+        with open(item[0], 'rb') as f:
+            while f.read(block_size):
+                pass
+
+    start = time.time()
+    if threads > 1:
+        pool = multiprocessing.pool.ThreadPool(threads)
+        try:
+            pool.map(read, sample)
+        finally:
+            pool.terminate()
+    else:
+        for item in sample:
+            read(item)
+    elapsed = max(time.time() - start, 1e-6)
+    return sum(size for _, size in sample) / elapsed
+
+
+def _measure_hash_rate(algorithms, block_size, total=16777216):
+    block = b'\x5a' * block_size
+    rounds = max(1, total // block_size)
+    hashers = [_hasher(alg) for alg in algorithms]
+    start = time.time()
+    for _ in range(rounds):
+        for h in hashers:
+            h.update(block)
+    elapsed = max(time.time() - start, 1e-6)
+    return rounds * block_size / elapsed
+
+
+def _measure_thread_scaling(algorithms, block_size):
+    # How much faster two threads hash than one; close to 2 when the hash
+    # implementations release the GIL, close to 1 when they do not
+    single = _measure_hash_rate(algorithms, block_size, total=8388608)
+    pool = multiprocessing.pool.ThreadPool(2)
+    try:
+        start = time.time()
+        pool.map(partial(_measure_hash_rate, algorithms, block_size), [8388608, 8388608])
+        elapsed = max(time.time() - start, 1e-6)
+    finally:
+        pool.terminate()
+    return (2 * 8388608 / elapsed) / single
+
+
+def _tune_block_size(algorithms):
+    # Larger blocks amortize the per-call overhead; take the smallest one
+    # which is within 5% of the fastest to keep memory use down
+    rates = [(size, _measure_hash_rate(algorithms, size, total=4194304))
+             for size in (65536, 262144, 1048576, 4194304)]
+    best = max(rate for _, rate in rates)
+    for size, rate in rates:
+        if rate >= 0.95 * best:
+            return size
+    return HASH_BLOCK_SIZE
+
+
 class Bag(object):
     """A representation of a bag."""
 
     valid_files = ["bagit.txt", "fetch.txt"]
     valid_directories = ['data']
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, index=False):
+        """
+        With index=True the manifests are loaded from a binary index kept
+        in the bag directory, which is much quicker than parsing them for
+        bags with many files. The index is checked against bagit.txt and
+        the manifests each time, and written again from the manifests if
+        it is missing or out of date; bags which cannot be written to are
+        just read as usual. The entries are then looked up in the index as
+        they are used rather than all held in memory.
+        """
         super(Bag, self).__init__()
         self.tags = {}
         self.info = {}
         self.entries = {}
         self.algs = []
         self.tag_file_name = None
+        self.index = index
         self.path = abspath(path)
         if path:
             # if path ends in a path separator, strip it off
             if path[-1] == os.sep:
-                self.path = path[:-1]
+                self.path = abspath(path[:-1])
             self._open()
 
     def __str__(self):
@@ -260,7 +861,7 @@ class Bag(object):
     def payload_files(self):
         payload_dir = os.path.join(self.path, "data")
 
-        for dirpath, _, filenames in os.walk(payload_dir):
+        for dirpath, _, filenames in _walk_tree(payload_dir):
             for f in filenames:
                 # Jump through some hoops here to make the payload files come out
                 # looking like data/dir/file, rather than having the entire path.
@@ -268,12 +869,32 @@ class Bag(object):
                 rel_path = rel_path.replace(self.path + os.path.sep, "", 1)
                 yield rel_path
 
+    def _filtered_payload_files(self, path_filter):
+        """
+        Yields the payload files matching a _PathFilter, only walking the
+        directories which can hold them
+        """
+        for root in path_filter.roots():
+            full_root = join(self.path, root)
+            if isfile(full_root):
+                if path_filter(root):
+                    yield root
+                continue
+            for dirpath, dirnames, filenames in _walk_tree(full_root):
+                rel_dir = os.path.relpath(dirpath, self.path)
+                dirnames[:] = [d for d in dirnames if not path_filter.excludes(join(rel_dir, d))]
+                for f in filenames:
+                    rel_path = join(rel_dir, f)
+                    if path_filter(rel_path):
+                        yield rel_path
+
     def payload_entries(self):
         # Don't use dict comprehension (compatibility with Python < 2.7)
         return dict((key, value) for (key, value) in self.entries.items()
                     if key.startswith("data" + os.sep))
 
-    def save(self, processes=1, manifests=False):
+    def save(self, processes=1, manifests=False, journal=None, dedupe=False, digest_store=None,
+             fadvise=False, device_processes=None):
         """
         save will persist any changes that have been made to the bag
         metadata (self.info).
@@ -285,16 +906,17 @@ class Bag(object):
         a corrupted bag.
 
         If you want to control the number of processes that are used when
-        recalculating checksums use the processes parameter.
+        recalculating checksums use the processes parameter, which may be
+        'auto' as described for tune(). A journal file lets an interrupted
+        regeneration of the manifests be resumed, dedupe hashes hard linked
+        files once, a digest_store shares digests between bags, fadvise
+        spares the page cache and device_processes sets the number of
+        processes for each disk, as for make_bag().
         """
         # Error checking
         if not self.path:
             raise BagError("Bag does not have a path.")
 
-        # Change working directory to bag directory so helper functions work
-        old_dir = os.path.abspath(os.path.curdir)
-        os.chdir(self.path)
-
         # Generate new manifest files
         if manifests:
             unbaggable = _can_bag(self.path)
@@ -309,29 +931,48 @@ class Bag(object):
                     LOGGER.error("The following files do not have read permissions: \n%s", unreadable_files)
                 raise BagError("Read permissions are required to calculate file fixities.")
 
-            oxum = None
             self.algs = list(set(self.algs))  # Dedupe
-            for alg in self.algs:
-                LOGGER.info('updating manifest-%s.txt', alg)
-                oxum = _make_manifest('manifest-%s.txt' % alg, 'data', processes,
-                                      algorithm=alg,
-                                      encoding=self.encoding)
+            LOGGER.info('updating manifests for %s', ', '.join(self.algs))
+            if journal is not None:
+                journal = Journal(journal)
+            payload_entries = {}
+            try:
+                oxum = _make_manifests(self.path, processes, algorithms=self.algs,
+                                       encoding=self.encoding,
+                                       digest_cache=_digest_cache(journal, digest_store),
+                                       entries=payload_entries, dedupe=dedupe, fadvise=fadvise,
+                                       device_processes=device_processes)
+            finally:
+                if journal is not None:
+                    journal.close()
 
             # Update Payload-Oxum
             LOGGER.info('updating %s', self.tag_file_name)
             if oxum:
                 self.info['Payload-Oxum'] = oxum
 
-        _make_tag_file(self.tag_file_name, self.info)
-
-        # Update tag-manifest for changes to manifest & bag-info files
-        for alg in self.algs:
-            _make_tagmanifest_file(alg, self.path, encoding=self.encoding)
+            # and any rollups of the payload
+            rollup_algorithms = [alg for alg in self.algs if isfile(join(self.path, 'rollup-%s.txt' % alg))]
+            rollup_files = _make_rollups(self.path, payload_entries, rollup_algorithms, encoding=self.encoding)
 
-        # Reload the manifests
-        self._load_manifests()
+        _make_tag_file(join(self.path, self.tag_file_name), self.info)
 
-        os.chdir(old_dir)
+        # Update tag-manifest for changes to manifest & bag-info files
+        changed = [self.tag_file_name]
+        if manifests:
+            changed.extend(os.path.basename(f) for f in self.manifest_files())
+            changed.extend(rollup_files)
+        tag_entries = _make_tagmanifests(self.path, self.algs, encoding=self.encoding,
+                                         entries=self.entries, changed=changed)
+
+        # Update the entries from the digests just written rather than
+        # parsing the manifests again
+        if not manifests:
+            payload_entries = self.payload_entries()
+        self.entries = payload_entries
+        if self.version == "0.97":
+            # v0.97 requires that optional tagfiles are verified.
+            self.entries.update(tag_entries)
 
     def tagfile_entries(self):
         return dict((key, value) for (key, value) in self.entries.items()
@@ -365,19 +1006,476 @@ class Bag(object):
     def has_oxum(self):
         return 'Payload-Oxum' in self.info
 
-    def validate(self, processes=1, fast=False):
+    def validate(self, processes=1, fast=False, sample=None, sample_bytes=None, cursor=None,
+                 max_bytes_per_second=None, max_seconds=None, journal=None, dedupe=False,
+                 digest_store=None, fadvise=False, device_processes=None, include=None, exclude=None,
+                 pool=None):
         """Checks the structure and contents are valid. If you supply
         the parameter fast=True the Payload-Oxum (if present) will
         be used to check that the payload files are present and
         accounted for, instead of re-calculating fixities and
         comparing them against the manifest. By default validate()
         will re-calculate fixities (fast=False).
+
+        processes may be 'auto' to hash with the settings chosen by tune()
+        for the filesystem the bag is on.
+
+        For a spot check which costs a fraction of a full validation pass
+        sample (a fraction of the payload bytes) and/or sample_bytes: the
+        structure, Payload-Oxum and completeness of the bag are checked in
+        full but only the payload files chosen by sample_entries() are
+        hashed. With a cursor file successive runs work through the whole
+        payload in turn.
+
+        To limit the impact of a validation on other users of the storage,
+        max_bytes_per_second caps the combined read rate of all of the
+        processes and max_seconds stops hashing once the time is up. When
+        it does, BagValidationIncomplete is raised unless a problem has
+        already been found, since the rest of the payload was not checked.
+        max_seconds requires a cursor or a journal so that the work done is
+        not lost: a cursor file records the position reached, and the next
+        run with the same cursor resumes from there, while a journal lets
+        the next run skip the files already hashed.
+
+        With the path of a journal file the digests of the files are
+        recorded as they are calculated. If the validation is interrupted
+        a later run with the same journal reuses the recorded digests of
+        files whose size, modification time and inode have not changed.
+
+        With dedupe=True payload files which are hard links to the same
+        inode are read once and the digests checked against each entry.
+
+        A DigestStore shared between bags supplies the digests of files
+        which were hashed recently enough, while validating this or any
+        other bag, so each file is read once per audit cycle.
+
+        fadvise=True reads files in a way which spares the page cache of
+        other programs, and device_processes gives the files on each disk
+        their own workers, as described for make_bag(). Files on different
+        disks are not hashed by separate workers when a cursor is used,
+        since they are then checked in order.
+
+        To check only part of the payload, such as the files affected by a
+        storage incident, give include and/or exclude lists of patterns,
+        each a path prefix such as data/scans/2019 or a glob such as
+        data/*/2019/*.tif, which matches a file if it matches its path or
+        the path of any directory containing it. data/ is added to patterns
+        which do not start with it, and a BagError is raised if an include
+        pattern matches no payload file in the manifests. Only the directories which
+        can hold matching files are walked, and only matching files are
+        checked for completeness and hashed. The tag files are still
+        checked in full, but the Payload-Oxum is not, since it describes
+        the whole payload.
+
+        pool is a multiprocessing or thread pool kept by the caller to hash
+        with, as described for make_bag(). max_bytes_per_second can only be
+        combined with a thread pool; worker processes use the throttle they
+        were started with, if any.
+        """
+        errors = []
+        try:
+            for result in self.iter_validate(processes=processes, fast=fast, sample=sample,
+                                             sample_bytes=sample_bytes, cursor=cursor,
+                                             max_bytes_per_second=max_bytes_per_second,
+                                             max_seconds=max_seconds, journal=journal,
+                                             dedupe=dedupe, digest_store=digest_store,
+                                             fadvise=fadvise, device_processes=device_processes,
+                                             include=include, exclude=exclude, pool=pool):
+                errors.extend(result.errors)
+        except BagValidationIncomplete:
+            # the problems found so far are reported rather than the stop
+            if not errors:
+                raise
+
+        if errors:
+            raise BagValidationError("invalid bag", errors)
+
+        return True
+
+    def iter_validate(self, processes=1, fast=False, sample=None, sample_bytes=None, cursor=None,
+                      max_bytes_per_second=None, max_seconds=None, journal=None, dedupe=False,
+                      digest_store=None, fadvise=False, device_processes=None, include=None,
+                      exclude=None, pool=None, cancelled=None):
+        """Generator version of validate(): rather than raising a single
+        BagValidationError at the end, a FileValidationResult is yielded
+        for every missing or unexpected file and for every manifest entry
+        as soon as it has been checked, so that the results for very large
+        bags can be streamed somewhere without being held in memory.
+
+        Problems with the structure of the bag or its Payload-Oxum are
+        still raised as a BagError, and BagValidationIncomplete is raised
+        after the last result if max_seconds ran out.
+
+        Setting the cancelled threading.Event from another thread stops the
+        files being hashed by threads part way through, with a BagError;
+        closing the generator stops any worker processes.
         """
+        if max_seconds is not None and not (cursor or journal):
+            raise BagError("max_seconds requires a cursor or a journal to keep the progress made")
+        deadline = time.time() + max_seconds if max_seconds is not None else None
+
+        path_filter = None
+        if include or exclude:
+            path_filter = _PathFilter(include, exclude)
+
         self._validate_structure()
         self._validate_bagittxt()
-        self._validate_contents(processes=processes, fast=fast)
+        if fast and path_filter is not None:
+            raise BagValidationError("cannot validate Bag with fast=True for part of the payload")
+        if fast and not self.has_oxum():
+            raise BagValidationError("cannot validate Bag with fast=True if Bag lacks a Payload-Oxum")
+        if path_filter is None:
+            self._validate_oxum()    # Fast
+        else:
+            unmatched = path_filter.unmatched(self.payload_entries())
+            if unmatched:
+                raise BagError("no payload file in the manifests matches %s" % ", ".join(unmatched))
+            LOGGER.info("%s: only validating the payload files matching %s, without the Payload-Oxum",
+                        self, path_filter)
+        if fast:
+            return
+
+        for result in self._iter_completeness(path_filter):
+            yield result
+
+        if sample is not None or sample_bytes is not None or cursor:
+            payload = self.sample_entries(sample=sample, sample_bytes=sample_bytes, cursor_file=cursor)
+        else:
+            payload = list(self.payload_entries())
+        if path_filter is not None:
+            payload = [path for path in payload if path_filter(path)]
+
+        # tag files are always checked, and first, so that the position
+        # reached in the payload can be recorded when time runs out
+        entries = list(self.tagfile_entries().items())
+        entries.extend((path, self.entries[path]) for path in payload)
+
+        if journal is not None:
+            journal = Journal(journal)
+
+        reached = None
+        checked = 0
+        stopped = False
+        hash_results = self._iter_hash_entries(processes, entries, max_bytes_per_second=max_bytes_per_second,
+                                               ordered=bool(cursor),
+                                               digest_cache=_digest_cache(journal, digest_store),
+                                               dedupe=dedupe, fadvise=fadvise,
+                                               device_processes=device_processes, pool=pool,
+                                               cancelled=cancelled)
+        try:
+            for result in hash_results:  # *SLOW*
+                yield result
+                checked += 1
+                if result.path.startswith('data' + os.sep):
+                    reached = result.path
+                    # stop once the time is up, but only after making some
+                    # progress through the payload
+                    if deadline is not None and time.time() > deadline and checked < len(entries):
+                        LOGGER.warning("%s: time budget exhausted after checking %s of %s files",
+                                       self, checked, len(entries))
+                        stopped = True
+                        break
+        finally:
+            hash_results.close()
+            if journal is not None:
+                journal.close()
+
+        if cursor and reached is not None:
+            _save_cursor(cursor, reached)
+
+        if stopped:
+            raise BagValidationIncomplete("validation stopped after max_seconds with %s of %s files checked"
+                                          % (checked, len(entries)), checked, len(entries))
+
+    def sample_entries(self, sample=None, sample_bytes=None, cursor_file=None):
+        """
+        Returns the paths of the payload files to hash in a sampled fixity
+        check: enough files to cover the fraction sample of the payload
+        bytes, limited to sample_bytes bytes if given, and always at least
+        one file.
+
+        Files are picked at random with a probability proportional to their
+        size. If cursor_file is given they are instead taken in path order
+        starting after the last file checked by the previous validation
+        using that cursor, so that the whole payload is covered over
+        successive runs.
+        """
+        sizes = []
+        for path in sorted(self.payload_entries()):
+            try:
+                size = os.stat(join(self.path, path)).st_size
+            except OSError:
+                # missing files are reported by the completeness check
+                size = 0
+            sizes.append((path, size))
+
+        if not sizes:
+            return []
+
+        total_bytes = sum(size for _, size in sizes)
+        budget = total_bytes
+        if sample is not None:
+            budget = sample * total_bytes
+        if sample_bytes is not None:
+            budget = min(budget, sample_bytes)
+
+        if cursor_file:
+            cursor = _load_cursor(cursor_file)
+            start = 0
+            if cursor is not None:
+                start = bisect.bisect_right([path for path, _ in sizes], cursor) % len(sizes)
+            candidates = sizes[start:] + sizes[:start]
+        else:
+            # weighted random sampling without replacement (Efraimidis and
+            # Spirakis): the largest random() ** (1 / size) keys win
+            keyed = [(random.random() ** (1.0 / size), path, size) for path, size in sizes if size > 0]
+            keyed.sort(reverse=True)
+            candidates = [(path, size) for _, path, size in keyed] or sizes
+
+        selected = []
+        covered = 0
+        for path, size in candidates:
+            if selected and covered + size > budget:
+                break
+            selected.append(path)
+            covered += size
+
+        LOGGER.info("%s: sampling %s of %s payload files (%s of %s bytes)",
+                    self, len(selected), len(sizes), covered, total_bytes)
+        return selected
+
+    def rollup_files(self):
+        for filename in ["rollup-%s.txt" % a for a in CHECKSUM_ALGOS]:
+            f = os.path.join(self.path, filename)
+            if isfile(f):
+                yield f
+
+    def save_rollups(self, algorithms=None):
+        """
+        Writes rollup-<alg>.txt with the digest, byte count and file count
+        of every payload directory, for each of the algorithms of the
+        payload manifests by default, and updates the tag manifests.
+
+        The rollup digest of a directory is a hash of the sorted digests
+        and names of its files and subdirectories, so it changes with
+        anything below it, and the counts are a Payload-Oxum of its
+        subtree. Once written, the rollups are kept up to date by
+        save(manifests=True).
+        """
+        if algorithms is None:
+            algorithms = _manifest_algorithms(self.path)[1]
+        written = _make_rollups(self.path, self.payload_entries(), algorithms, encoding=self.encoding)
+        tag_entries = _make_tagmanifests(self.path, self.algs, encoding=self.encoding, entries=self.entries,
+                                         changed=written)
+        if self.version == "0.97":
+            self.entries.update(tag_entries)
+
+    def rollups(self, algorithm=None):
+        """
+        Returns the algorithm of a rollup file of the bag, the first found
+        unless one is given, and a dictionary of the (digest, byte_count,
+        file_count) rollup of each payload directory recorded in it
+        """
+        if algorithm is None:
+            for rollup_file in self.rollup_files():
+                algorithm = os.path.basename(rollup_file)[len("rollup-"):-len(".txt")]
+                break
+            else:
+                raise BagError("%s has no rollup file" % self)
+        rollup_file = join(self.path, "rollup-%s.txt" % algorithm)
+        if not isfile(rollup_file):
+            raise BagError("%s has no rollup file for %s" % (self, algorithm))
+        return algorithm, _load_rollup(rollup_file, self.encoding)
+
+    def validate_subtree(self, path, processes=1, fast=False, algorithm=None):
+        """
+        Validates the payload below path (such as data/images/2019, or
+        images/2019) in isolation, using the digests recorded by
+        save_rollups() rather than visiting the rest of the payload.
+
+        The rollup file is first checked against the tag manifests. The
+        files below path must then match their manifest entries and add up
+        to the recorded byte and file counts, the entries must roll up to
+        the recorded digest, and, unless fast=True, the files are hashed.
+        """
+        top = os.path.normpath(path.rstrip('/'))
+        if top != 'data' and not top.startswith('data' + os.sep):
+            top = join('data', top)
+
+        algorithm, rollups = self.rollups(algorithm)
+        if top not in rollups:
+            raise BagError("%s has no rollup for %s" % (self, top))
+        expected_digest, byte_count, file_count = rollups[top]
+
+        rollup_file = "rollup-%s.txt" % algorithm
+        if rollup_file in self.entries:
+            errors = []
+            for result in self._iter_hash_entries(1, [(rollup_file, self.entries[rollup_file])]):
+                errors.extend(result.errors)
+            if errors:
+                raise BagValidationError("invalid rollup file", errors)
+
+        files_on_fs = set()
+        total_bytes = 0
+        for dirpath, _, filenames in _walk_tree(join(self.path, top)):
+            for f in filenames:
+                full_path = join(dirpath, f)
+                files_on_fs.add(os.path.relpath(full_path, self.path))
+                total_bytes += os.stat(full_path).st_size
+        if file_count != len(files_on_fs) or byte_count != total_bytes:
+            raise BagValidationError("Oxum error.  Found %s files and %s bytes on disk below %s; expected %s files and %s bytes." % (len(files_on_fs), total_bytes, top, file_count, byte_count))
+
+        entries = dict((p, hashes) for p, hashes in self.payload_entries().items()
+                       if p.startswith(top + os.sep))
+        errors = []
+        for p in sorted(set(entries) - files_on_fs):
+            errors.append(FileMissing(p))
+        for p in sorted(files_on_fs - set(entries)):
+            errors.append(UnexpectedFile(p))
+
+        found_digest = _rollup(entries, algorithm, {}, top)[top][0]
+        if found_digest != expected_digest:
+            errors.append(ChecksumMismatch(top, algorithm, expected_digest, found_digest))
+
+        if not fast:
+            to_hash = sorted((p, hashes) for p, hashes in entries.items() if p in files_on_fs)
+            for result in self._iter_hash_entries(processes, to_hash):
+                errors.extend(result.errors)
+
+        for e in errors:
+            LOGGER.warning(force_unicode(e))
+        if errors:
+            raise BagValidationError("invalid subtree %s" % top, errors)
+
+        return True
+
+    def changed_directories(self, other, algorithm=None):
+        """
+        Compares the rollups of this bag with those of another copy of it,
+        given as a Bag or a path, and returns the payload directories whose
+        contents differ, top-down. Only the subdirectories of directories
+        which differ are compared, so an unchanged subtree costs a single
+        comparison however large it is, and the deepest directories
+        returned are where the changes are.
+        """
+        if not isinstance(other, Bag):
+            other = Bag(other)
+        if algorithm is None:
+            algorithm = self.rollups()[0]
+        _, old = self.rollups(algorithm)
+        _, new = other.rollups(algorithm)
+
+        children = {}
+        for directory in set(old) | set(new):
+            if directory != 'data':
+                children.setdefault(os.path.dirname(directory), []).append(directory)
+
+        changed = []
+        stack = ['data']
+        while stack:
+            directory = stack.pop()
+            if old.get(directory) == new.get(directory):
+                continue
+            changed.append(directory)
+            stack.extend(sorted(children.get(directory, ()), reverse=True))
+        return changed
+
+    def validate_sharded(self, transport, shards=8, local_workers=0, processes=1, timeout=None,
+                         claim_timeout=3600, poll_interval=1.0):
+        """
+        Validates the bag with the work split between worker processes,
+        which may run on other hosts sharing the storage, by
+        iter_validate_sharded(). Raises a BagValidationError for any
+        problems found, as validate() does.
+        """
+        errors = []
+        for result in self.iter_validate_sharded(transport, shards=shards, local_workers=local_workers,
+                                                 processes=processes, timeout=timeout,
+                                                 claim_timeout=claim_timeout, poll_interval=poll_interval):
+            errors.extend(result.errors)
+
+        if errors:
+            raise BagValidationError("invalid bag", errors)
+
         return True
 
+    def iter_validate_sharded(self, transport, shards=8, local_workers=0, processes=1, timeout=None,
+                              claim_timeout=3600, poll_interval=1.0):
+        """
+        A version of iter_validate() for bags too large for one host to hash
+        in time. This process acts as the coordinator: it checks the
+        structure, Payload-Oxum and completeness of the bag itself, then
+        splits the entries into shards of roughly equal bytes and hands them
+        to run_shard_worker() processes through the transport (such as a
+        DirectoryQueueTransport), yielding the FileValidationResults of each
+        shard as it comes back.
+
+        local_workers starts that many workers on this host, each hashing
+        with processes; workers elsewhere are started separately, e.g. with
+        bagit.py --shard-worker, and must see the bag at the same path. With
+        a timeout a BagError is raised if the shards are not all done in
+        time. Shards claimed by a worker which has not finished them in
+        claim_timeout seconds (because it died, say) are handed out again,
+        unless claim_timeout is None, and a BagError is raised if one of the
+        local workers exits.
+        """
+        self._validate_structure()
+        self._validate_bagittxt()
+        self._validate_oxum()
+
+        for result in self._iter_completeness():
+            yield result
+
+        entries = list(self.tagfile_entries().items())
+        entries.extend(self.payload_entries().items())
+
+        job = "%s-%08x" % (int(time.time()), random.getrandbits(32))
+        pending = set()
+        for i, shard in enumerate(_balanced_shards(self.path, entries, shards)):
+            shard_id = "%s-%04d" % (job, i)
+            transport.put_shard(shard_id, {'bag': self.path, 'entries': shard})
+            pending.add(shard_id)
+        LOGGER.info("%s: validating in %s shards", self, len(pending))
+
+        workers = []
+        for _ in range(local_workers):
+            worker = multiprocessing.Process(target=run_shard_worker, args=(transport,),
+                                             kwargs={'processes': processes, 'poll_interval': poll_interval})
+            # not daemonic, as daemonic processes can't start the pool of
+            # processes > 1; they are terminated below
+            worker.start()
+            workers.append(worker)
+
+        deadline = time.time() + timeout if timeout is not None else None
+        try:
+            while pending:
+                done = list(transport.take_results(sorted(pending)))
+                for shard_id, result in done:
+                    pending.discard(shard_id)
+                    if result.get('error') is not None:
+                        raise BagError("shard %s could not be validated by %s: %s"
+                                       % (shard_id, result.get('worker'), result['error']))
+                    for record in result['results']:
+                        path = os.path.normpath(record['path'])
+                        yield _hash_result(path, record['found'], self.entries[path],
+                                           record['bytes'], record['duration'])
+                if not pending:
+                    break
+                if deadline is not None and time.time() > deadline:
+                    raise BagError("timed out waiting for %s shards of %s" % (len(pending), self))
+                for worker in workers:
+                    if not worker.is_alive():
+                        raise BagError("shard worker %s exited with code %s" % (worker.pid, worker.exitcode))
+                if claim_timeout is not None:
+                    transport.requeue_stale(claim_timeout)
+                if not done:
+                    time.sleep(poll_interval)
+        finally:
+            transport.cancel(pending)
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+
     def is_valid(self, fast=False):
         """Returns validation success or failure as boolean.
         Optional fast parameter passed directly to validate().
@@ -388,6 +1486,64 @@ class Bag(object):
             return False
         return True
 
+    def iter_validate_async(self, concurrency=1, fast=False, executor='thread', **options):
+        """
+        Returns an asynchronous iterator of FileValidationResult objects, one
+        for each file that was found missing, unexpected or hashed:
+
+            async for result in bag.iter_validate_async(concurrency=4):
+                if not result.ok:
+                    print(result.errors)
+
+        The results are those of iter_validate(), which runs on a separate
+        thread hashing with a pool of concurrency workers, threads or
+        processes as executor says; the other options, such as journal or
+        include, are passed on to it. It stays at most concurrency results
+        ahead of the consumer. Structural problems with the bag are raised
+        as a BagError from the first iteration. Cancelling the task which is
+        consuming the results stops any outstanding hashing.
+        """
+        _require_asyncio()
+        return _AsyncValidation(self, concurrency, executor, dict(options, fast=fast))
+
+    def validate_async(self, concurrency=1, fast=False, executor='thread', **options):
+        """
+        asyncio counterpart of validate(): returns an awaitable which
+        resolves to True for a valid bag or raises BagValidationError with
+        the same details that validate() would report. The arguments are
+        those of iter_validate_async().
+        """
+        _require_asyncio()
+        loop = asyncio.get_event_loop()
+        results = self.iter_validate_async(concurrency=concurrency, fast=fast, executor=executor, **options)
+        done = loop.create_future()
+        errors = []
+
+        def step(fut=None):
+            if done.done():
+                return
+            if fut is not None:
+                exc = fut.exception()
+                if isinstance(exc, StopAsyncIteration):
+                    if errors:
+                        done.set_exception(BagValidationError("invalid bag", errors))
+                    else:
+                        done.set_result(True)
+                    return
+                elif exc is not None:
+                    done.set_exception(exc)
+                    return
+                errors.extend(fut.result().errors)
+            results.__anext__().add_done_callback(step)
+
+        def on_done(fut):
+            if fut.cancelled():
+                results.cancel()
+
+        done.add_done_callback(on_done)
+        step()
+        return done
+
     def _load_manifests(self):
         self.entries = {}
         manifests = list(self.manifest_files())
@@ -396,38 +1552,37 @@ class Bag(object):
             # v0.97 requires that optional tagfiles are verified.
             manifests += list(self.tagmanifest_files())
 
+        sources = [join(self.path, "bagit.txt")] + manifests
+        if self.index:
+            loaded = _read_manifest_index(join(self.path, MANIFEST_INDEX), sources)
+            if loaded is not None:
+                self.algs, self.entries = loaded
+                return
+            # the stat results from before the manifests are read, so that
+            # the index is not written if they change in the meantime
+            stats = [os.stat(f) for f in sources]
+
         for manifest_file in manifests:
-            if not manifest_file.find("tagmanifest-") is -1:
+            if os.path.basename(manifest_file).startswith("tagmanifest-"):
                 search = "tagmanifest-"
             else:
                 search = "manifest-"
             alg = os.path.basename(manifest_file).replace(search, "").replace(".txt", "")
             self.algs.append(alg)
 
-            with open_text_file(manifest_file, 'r', encoding=self.encoding) as manifest_file:
-                for line in manifest_file:
-                    line = line.strip()
-
-                    # Ignore blank lines and comments.
-                    if line == "" or line.startswith("#"):
-                        continue
-
-                    entry = line.split(None, 1)
-
-                    # Format is FILENAME *CHECKSUM
-                    if len(entry) != 2:
-                        LOGGER.error("%s: Invalid %s manifest entry: %s", self, alg, line)
-                        continue
-
-                    entry_hash = entry[0]
-                    entry_path = os.path.normpath(entry[1].lstrip("*"))
-                    entry_path = _decode_filename(entry_path)
+            for entry_path, entry_hash in _iter_manifest(manifest_file, self.encoding, self):
+                if entry_path in self.entries:
+                    self.entries[entry_path][alg] = entry_hash
+                else:
+                    self.entries[entry_path] = {}
+                    self.entries[entry_path][alg] = entry_hash
 
-                    if entry_path in self.entries:
-                        self.entries[entry_path][alg] = entry_hash
-                    else:
-                        self.entries[entry_path] = {}
-                        self.entries[entry_path][alg] = entry_hash
+        if self.index:
+            try:
+                _write_manifest_index(join(self.path, MANIFEST_INDEX), list(zip(sources, stats)),
+                                      self.algs, self.entries)
+            except (IOError, OSError) as e:
+                LOGGER.warning("%s: could not write the manifest index: %s", self, e)
 
     def _validate_structure(self):
         """Checks the structure of the bag, determining if it conforms to the
@@ -451,13 +1606,6 @@ class Bag(object):
         if "bagit.txt" not in os.listdir(self.path):
             raise BagValidationError("Missing bagit.txt")
 
-    def _validate_contents(self, processes=1, fast=False):
-        if fast and not self.has_oxum():
-            raise BagValidationError("cannot validate Bag with fast=True if Bag lacks a Payload-Oxum")
-        self._validate_oxum()    # Fast
-        if not fast:
-            self._validate_entries(processes)  # *SLOW*
-
     def _validate_oxum(self):
         oxum = self.info.get('Payload-Oxum')
 
@@ -487,24 +1635,192 @@ class Bag(object):
         if file_count != total_files or byte_count != total_bytes:
             raise BagValidationError("Oxum error.  Found %s files and %s bytes on disk; expected %s files and %s bytes." % (total_files, total_bytes, file_count, byte_count))
 
-    def _validate_entries(self, processes):
-        """
-        Verify that the actual file contents match the recorded hashes stored in the manifest files
-        """
-        errors = list()
-
+    def _iter_completeness(self, path_filter=None):
         # First we'll make sure there's no mismatch between the filesystem
         # and the list of files in the manifest(s)
-        only_in_manifests, only_on_fs = self.compare_manifests_with_fs()
+        if path_filter is None:
+            only_in_manifests, only_on_fs = self.compare_manifests_with_fs()
+        else:
+            files_on_fs = set(self._filtered_payload_files(path_filter))
+            files_in_manifest = set(path for path in self.payload_entries() if path_filter(path))
+            if self.version == "0.97":
+                files_in_manifest = files_in_manifest | set(self.missing_optional_tagfiles())
+            only_in_manifests = sorted(files_in_manifest - files_on_fs)
+            only_on_fs = sorted(files_on_fs - files_in_manifest)
         for path in only_in_manifests:
             e = FileMissing(path)
             LOGGER.warning(force_unicode(e))
-            errors.append(e)
+            yield FileValidationResult(path, FileValidationResult.MISSING, [e])
         for path in only_on_fs:
             e = UnexpectedFile(path)
             LOGGER.warning(force_unicode(e))
-            errors.append(e)
+            yield FileValidationResult(path, FileValidationResult.UNEXPECTED, [e])
+
+    def _iter_hash_entries(self, processes, entries, max_bytes_per_second=None, ordered=False,
+                           digest_cache=None, dedupe=False, fadvise=False, device_processes=None, pool=None,
+                           cancelled=None):
+        """
+        Yields a FileValidationResult for each of the (path, hashes) entries
+        as soon as it has been hashed, or in order if ordered is True. Files
+        with digests in the digest_cache (see _digest_cache) are not read
+        again, and the digests of the others are added to it. With dedupe,
+        entries for the same inode are checked against the digests of a
+        single read. fadvise applies the page cache hints of _read_blocks,
+        prefetching the entry after each one. device_processes sets the
+        number of workers for the files on each device, as described for
+        _group_by_device. Files are sent to the workers in batches by
+        _hash_batch, of the given pool if there is one. Setting the
+        cancelled threading.Event stops the hashing done by threads; worker
+        processes are stopped when the generator is closed.
+        """
+        available_hashers = self._available_hashers()
+        settings = _hashing_settings(processes, join(self.path, 'data'), available_hashers)
+
+        throttle = None
+        if max_bytes_per_second:
+            if pool is not None and not isinstance(pool, multiprocessing.pool.ThreadPool):
+                # worker processes only receive a throttle when they start
+                raise BagError("max_bytes_per_second cannot be applied to a running process pool")
+            throttle = _Throttle(max_bytes_per_second)
+
+        # stat results of the files being hashed, for the digest cache
+        signatures = {}
+
+        aliases = {}
+        if dedupe:
+            entries, aliases = _dedupe_entries(self.path, entries)
+        expected = dict(entries)
+
+        # digests recorded in the digest cache, which are not sent to the
+        # workers at all
+        known = {}
+        if digest_cache is not None:
+            to_hash = []
+            for rel_path, hashes in entries:
+                full_path = join(self.path, rel_path)
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    st = None
+                digests = None
+                if st is not None:
+                    digests = digest_cache.lookup(full_path, st, [a for a in hashes if a in available_hashers])
+                    if digests is None:
+                        signatures[rel_path] = st
+                if digests is None:
+                    to_hash.append((rel_path, hashes))
+                else:
+                    known[rel_path] = digests
+        else:
+            to_hash = entries
+
+        # the algorithms to calculate for most files are sent once as part of
+        # the workers' context; only files missing from some of the
+        # manifests have their own list
+        algorithms = tuple(sorted(available_hashers))
+
+        def file_algorithms(hashes):
+            return tuple(sorted(alg for alg in hashes if alg in available_hashers))
+
+        def batches(group, workers):
+            items = []
+            for i, (rel_path, hashes) in enumerate(group):
+                prefetch = None
+                if fadvise and i + 1 < len(group):
+                    prefetch = group[i + 1][0]
+                file_algs = file_algorithms(hashes)
+                items.append((rel_path, None if file_algs == algorithms else file_algs, prefetch))
+            return _batches(items, _batch_size(len(items), workers))
+
+        def expand(hash_results):
+            for batch in hash_results:
+                for rel_path, digests, byte_count, duration in batch:
+                    file_algs = file_algorithms(expected[rel_path])
+                    if isinstance(digests, tuple):
+                        f_hashes = dict(zip(file_algs, digests))
+                    else:
+                        # the file could not be read
+                        f_hashes = dict((alg, digests) for alg in file_algs)
+                    yield rel_path, f_hashes, byte_count, duration
+
+        # with limits per device the files on each device are hashed by
+        # their own workers, which cannot keep the entries in order
+        groups = []
+        if device_processes is not None and not ordered and pool is None:
+            groups = _group_by_device(self.path, to_hash, device_processes, processes,
+                                      algorithms=available_hashers)
+        if not groups:
+            groups = [(processes, to_hash, settings)]
+
+        pools = []
+        try:
+            streams = []
+            for group_processes, group, group_settings in groups:
+                if pool is not None:
+                    # the caller's pool was not started with the context of
+                    # this bag, so it is sent with each batch; an Event can
+                    # only be shared with threads
+                    if not isinstance(pool, multiprocessing.pool.ThreadPool):
+                        cancelled = None
+                    context = (self.path, algorithms, group_settings['block_size'], fadvise, throttle, cancelled)
+                    hash_batch = partial(_hash_batch, context=context)
+                    workers = multiprocessing.cpu_count()
+                    if ordered:
+                        streams.append(pool.imap(hash_batch, batches(group, workers)))
+                    else:
+                        streams.append(pool.imap_unordered(hash_batch, batches(group, workers)))
+                    continue
+                if group_settings['processes'] == 1:
+                    context = (self.path, algorithms, group_settings['block_size'], fadvise, throttle, cancelled)
+                    streams.append(_lazy_map(partial(_hash_batch, context=context), batches(group, 1)))
+                    continue
+                workers = group_settings['processes'] or multiprocessing.cpu_count()
+                if group_settings['executor'] == 'thread':
+                    context = (self.path, algorithms, group_settings['block_size'], fadvise, throttle, cancelled)
+                    group_pool = _make_pool(group_settings['processes'], 'thread')
+                    hash_batch = partial(_hash_batch, context=context)
+                else:
+                    # the context, including the shared throttle, is handed
+                    # to each worker process once when it starts
+                    context = (self.path, algorithms, group_settings['block_size'], fadvise, None, None)
+                    group_pool = _make_pool(group_settings['processes'], throttle=throttle, context=context)
+                    hash_batch = _hash_batch
+                pools.append(group_pool)
+                if ordered:
+                    streams.append(group_pool.imap(hash_batch, batches(group, workers)))
+                else:
+                    streams.append(group_pool.imap_unordered(hash_batch, batches(group, workers)))
+
+            if len(streams) == 1:
+                hash_results = expand(streams[0])
+            else:
+                hash_results = expand(_merge_iterators(streams))
+
+            if known:
+                hash_results = _with_known(entries, known, hash_results, ordered)
+
+            for rel_path, f_hashes, byte_count, duration in hash_results:
+                st = signatures.pop(rel_path, None)
+                if st is not None:
+                    digest_cache.record(join(self.path, rel_path), st, f_hashes)
+                yield _hash_result(rel_path, f_hashes, expected[rel_path], byte_count, duration)
+                for alias, alias_hashes in aliases.pop(rel_path, ()):
+                    yield _hash_result(alias, f_hashes, alias_hashes, 0, 0.0)
+        # Any unhandled exceptions are probably fatal
+        except GeneratorExit:
+            raise
+        except:
+            LOGGER.exception("unable to calculate file hashes for %s", self)
+            raise
+        finally:
+            for group_pool in pools:
+                try:
+                    group_pool.terminate()
+                except Exception:
+                    # we really don't care about any exception in terminate()
+                    pass
 
+    def _available_hashers(self):
         # To avoid the overhead of reading the file more than once or loading
         # potentially massive files into memory we'll create a dictionary of
         # hash objects so we can open a file, read a block and pass it to
@@ -512,50 +1828,15 @@ class Bag(object):
 
         available_hashers = set()
         for alg in self.algs:
-            try:
-                hashlib.new(alg)
+            if _hash_factory(alg) is not None:
                 available_hashers.add(alg)
-            except ValueError:
+            else:
                 LOGGER.warning("Unable to validate file contents using unknown %s hash algorithm", alg)
 
         if not available_hashers:
             raise RuntimeError("%s: Unable to validate bag contents: none of the hash algorithms in %s are supported!" % (self, self.algs))
 
-        if os.name == 'posix':
-            worker_init = posix_multiprocessing_worker_initializer
-        else:
-            worker_init = None
-
-        args = ((self.path, rel_path, hashes, available_hashers) for rel_path, hashes in self.entries.items())
-
-        try:
-            if processes == 1:
-                hash_results = [_calc_hashes(i) for i in args]
-            else:
-                try:
-                    pool = multiprocessing.Pool(processes if processes else None, initializer=worker_init)
-                    hash_results = pool.map(_calc_hashes, args)
-                finally:
-                    try:
-                        pool.terminate()
-                    except Exception:
-                        # we really don't care about any exception in terminate()
-                        pass
-        # Any unhandled exceptions are probably fatal
-        except:
-            LOGGER.exception("unable to calculate file hashes for %s", self)
-            raise
-
-        for rel_path, f_hashes, hashes in hash_results:
-            for alg, computed_hash in f_hashes.items():
-                stored_hash = hashes[alg]
-                if stored_hash.lower() != computed_hash:
-                    e = ChecksumMismatch(rel_path, alg, stored_hash.lower(), computed_hash)
-                    LOGGER.warning(force_unicode(e))
-                    errors.append(e)
-
-        if errors:
-            raise BagValidationError("invalid bag", errors)
+        return available_hashers
 
     def _validate_bagittxt(self):
         """
@@ -592,6 +1873,23 @@ class BagValidationError(BagError):
         return self.message
 
 
+class BagValidationIncomplete(BagError):
+    """
+    Raised by Bag.iter_validate() and Bag.validate() when hashing stops
+    because max_seconds ran out: checked of the total manifest entries
+    were hashed, and none of them had a problem.
+    """
+
+    def __init__(self, message, checked, total):
+        super(BagValidationIncomplete, self).__init__()
+        self.message = message
+        self.checked = checked
+        self.total = total
+
+    def __str__(self):
+        return self.message
+
+
 class ManifestErrorDetail(BagError):
     def __init__(self, path):
         super(ManifestErrorDetail, self).__init__()
@@ -622,58 +1920,2028 @@ class UnexpectedFile(ManifestErrorDetail):
         return "%s exists on filesystem but is not in manifest" % self.path
 
 
+class FileValidationResult(object):
+    """
+    The outcome of validating a single file: status is one of OK, MISMATCH,
+    MISSING or UNEXPECTED and errors holds the ManifestErrorDetail instances
+    which would be reported in BagValidationError.details for this file.
+    For files which were hashed, bytes and duration are the number of bytes
+    read and the seconds spent reading them.
+    """
+
+    OK = 'ok'
+    MISMATCH = 'mismatch'
+    MISSING = 'missing'
+    UNEXPECTED = 'unexpected'
+
+    def __init__(self, path, status, errors=None, expected=None, found=None, byte_count=None, duration=None):
+        self.path = path
+        self.status = status
+        self.errors = errors or []
+        self.expected = expected or {}
+        self.found = found or {}
+        self.bytes = byte_count
+        self.duration = duration
+
+    def to_records(self):
+        """
+        Returns a list of JSON serializable dictionaries describing the
+        result, one for each algorithm the file was checked with
+        """
+        record = {'type': 'file', 'path': self.path, 'status': self.status,
+                  'bytes': self.bytes, 'duration': self.duration}
+        algorithms = sorted(set(self.expected) | set(self.found))
+        if not algorithms:
+            record.update(algorithm=None, expected=None, actual=None)
+            return [record]
+        records = []
+        for alg in algorithms:
+            alg_record = dict(record, algorithm=alg, expected=self.expected.get(alg),
+                              actual=self.found.get(alg))
+            if alg_record['expected'] is not None:
+                alg_record['expected'] = alg_record['expected'].lower()
+            records.append(alg_record)
+        return records
+
+    @property
+    def ok(self):
+        return self.status == self.OK
+
+    def __repr__(self):
+        return "<FileValidationResult %s %s>" % (self.path, self.status)
+
+
+class PayloadChange(object):
+    """
+    A difference between the payloads of two bags found by diff_bags():
+    status is one of ADDED, REMOVED, MODIFIED or RENAMED. For a renamed file
+    old_path is its path in the old bag and path its path in the new one.
+    """
+
+    ADDED = 'added'
+    REMOVED = 'removed'
+    MODIFIED = 'modified'
+    RENAMED = 'renamed'
+
+    def __init__(self, status, path, old_path=None, old_digest=None, new_digest=None):
+        self.status = status
+        self.path = path
+        self.old_path = old_path
+        self.old_digest = old_digest
+        self.new_digest = new_digest
+
+    def __eq__(self, other):
+        return isinstance(other, PayloadChange) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if self.status == self.RENAMED:
+            return "<PayloadChange %s %s -> %s>" % (self.status, self.old_path, self.path)
+        return "<PayloadChange %s %s>" % (self.status, self.path)
+
+
+class _Inotify(object):
+    """A minimal binding of the Linux inotify API through ctypes"""
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    _EVENT = struct.Struct(str('iIII'))
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if libc is None or not hasattr(libc, 'inotify_init1'):
+            raise BagError("inotify is not available on this system")
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_CLOEXEC if hasattr(os, 'O_CLOEXEC') else 0)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(self.fd, path, ctypes.c_uint32(mask))
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "unable to watch %s" % force_unicode(path))
+        return wd
+
+    def read(self, timeout=None):
+        """
+        Returns a list of (watch descriptor, mask, name) events, waiting up
+        to timeout seconds for the first
+        """
+        if self.fd < 0 or not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, _fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _fsdecode(name):
+    if hasattr(os, 'fsdecode'):
+        return os.fsdecode(name)
+    return name.decode(sys.getfilesystemencoding())
+
+
+class BagWatcher(object):
+    """
+    Keeps track of the validity of a bag while it is being edited, using
+    Linux inotify to find out which files change rather than repeatedly
+    validating the whole bag.
+
+    The bag is checked in full when the watcher is created. Each call to
+    poll() then waits for changes to the payload or tag files and re-checks
+    only the files which were touched, reloading the manifests first if
+    they were among them. results holds the latest FileValidationResult of
+    every file with one, and is_valid whether all of them are ok; the
+    Payload-Oxum is not checked.
+
+        with BagWatcher(bag) as watcher:
+            for result in watcher.watch():
+                print(result, watcher.is_valid)
+    """
+
+    # events which mean a file may have been added, changed or removed
+    MASK = (_Inotify.IN_CLOSE_WRITE | _Inotify.IN_CREATE | _Inotify.IN_DELETE |
+            _Inotify.IN_MOVED_FROM | _Inotify.IN_MOVED_TO | _Inotify.IN_ATTRIB)
+
+    def __init__(self, bag, processes=1, settle=0.1):
+        if not isinstance(bag, Bag):
+            bag = Bag(bag)
+        self.bag = bag
+        self.processes = processes
+        self.settle = settle
+        self.results = {}
+        self.error = None
+        self._inotify = _Inotify()
+        self._dirs = {}
+        try:
+            self._add_watches(self.bag.path)
+            self._check(self._all_paths())
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def is_valid(self):
+        return self.error is None and all(result.ok for result in self.results.values())
+
+    def poll(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for files in the bag
+        to change, then returns a list of FileValidationResults for those
+        which were re-checked. A result with status OK is also returned for
+        files which no longer affect the validity of the bag, such as an
+        unexpected file which was removed.
+        """
+        events = self._inotify.read(timeout)
+        if not events:
+            return []
+        # wait for a burst of changes to finish before hashing anything
+        while True:
+            more = self._inotify.read(self.settle)
+            if not more:
+                break
+            events.extend(more)
+
+        touched = set()
+        rescan = False
+        for wd, mask, name in events:
+            if mask & _Inotify.IN_Q_OVERFLOW:
+                rescan = True
+                continue
+            if mask & _Inotify.IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            full_path = join(directory, name)
+            rel_path = os.path.relpath(full_path, self.bag.path)
+            if mask & _Inotify.IN_ISDIR:
+                if mask & (_Inotify.IN_CREATE | _Inotify.IN_MOVED_TO):
+                    self._add_watches(full_path)
+                    touched.update(os.path.relpath(join(dirpath, f), self.bag.path)
+                                   for dirpath, _, filenames in _walk_tree(full_path) for f in filenames)
+                else:
+                    prefix = rel_path + os.sep
+                    touched.update(p for p in set(self.results) | set(self.bag.entries)
+                                   if p.startswith(prefix))
+                    # forget the watches of a directory which was moved away
+                    for watched, dirpath in list(self._dirs.items()):
+                        if dirpath == full_path or dirpath.startswith(full_path + os.sep):
+                            del self._dirs[watched]
+            else:
+                touched.add(rel_path)
+
+        if rescan:
+            LOGGER.warning("%s: too many changes to follow, checking the whole bag", self.bag)
+            touched = self._all_paths()
+        elif any(_is_manifest_or_bag_tag_file(p) for p in touched):
+            touched.update(self._reload())
+        return self._check(touched)
+
+    def watch(self):
+        """Yields each FileValidationResult returned by poll() as files change"""
+        while True:
+            for result in self.poll():
+                yield result
+
+    def close(self):
+        self._inotify.close()
+
+    def _add_watches(self, top):
+        for dirpath, _, _ in _walk_tree(top):
+            wd = self._inotify.add_watch(dirpath, self.MASK)
+            self._dirs[wd] = dirpath
+
+    def _all_paths(self):
+        return set(self.bag.entries) | set(self.bag.payload_files())
+
+    def _reload(self):
+        """
+        Reloads the bag after its manifests or metadata changed and returns
+        the paths whose manifest entries changed
+        """
+        old_entries = self.bag.entries
+        try:
+            self.bag = Bag(self.bag.path, index=self.bag.index)
+            self.bag._validate_structure()
+        except BagError as e:
+            LOGGER.warning("%s: %s", self.bag, e)
+            self.error = e
+            return set()
+        self.error = None
+        changed = set(old_entries) ^ set(self.bag.entries)
+        changed.update(p for p in self.bag.entries if p in old_entries and old_entries[p] != self.bag.entries[p])
+        return changed
+
+    def _check(self, paths):
+        """Re-checks each of the paths and returns their new results"""
+        results = []
+        entries = []
+        for path in sorted(paths):
+            expected = self.bag.entries.get(path)
+            exists = isfile(join(self.bag.path, path))
+            if expected is not None and exists:
+                entries.append((path, expected))
+            elif expected is not None:
+                results.append(FileValidationResult(path, FileValidationResult.MISSING, [FileMissing(path)]))
+            elif exists and path.startswith('data' + os.sep):
+                results.append(FileValidationResult(path, FileValidationResult.UNEXPECTED, [UnexpectedFile(path)]))
+            elif path in self.results:
+                results.append(FileValidationResult(path, FileValidationResult.OK))
+        if entries:
+            results.extend(self.bag._iter_hash_entries(self.processes, entries, ordered=True))
+
+        for result in results:
+            if result.ok and result.path not in self.bag.entries:
+                self.results.pop(result.path, None)
+            else:
+                self.results[result.path] = result
+        return results
+
+
+def _is_manifest_or_bag_tag_file(path):
+    return (re.match(r'^(tag)?manifest-.+\.txt$', path) is not None
+            or path in ('bagit.txt', 'bag-info.txt', 'package-info.txt'))
+
+
+class _AsyncValidation(object):
+    """
+    The asynchronous iterator returned by Bag.iter_validate_async. A thread
+    runs Bag.iter_validate() and hands the results to the event loop
+    through a queue holding at most concurrency of them, so the validation
+    waits for the consumer rather than buffering the results of the whole
+    bag.
+    """
+
+    def __init__(self, bag, concurrency, executor, options):
+        self.bag = bag
+        self.concurrency = max(1, concurrency or 1)
+        self.executor = executor or 'thread'
+        self.options = options
+        self._cancelled = threading.Event()
+        self._results = queue.Queue(self.concurrency)
+        self._thread = None
+        self._waiter = None
+        self._loop = None
+        self._finished = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self._waiter is not None:
+            raise RuntimeError("iter_validate_async does not support concurrent iteration")
+
+        self._loop = asyncio.get_event_loop()
+        self._waiter = waiter = self._loop.create_future()
+        waiter.add_done_callback(self._on_waiter_done)
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        self._wakeup()
+        return waiter
+
+    def cancel(self):
+        """Stops any outstanding hashing and discards the results waiting"""
+        self._cancelled.set()
+        while True:
+            try:
+                self._results.get_nowait()
+            except queue.Empty:
+                break
+
+    def aclose(self):
+        self.cancel()
+        fut = asyncio.get_event_loop().create_future()
+        fut.set_result(None)
+        return fut
+
+    def _run(self):
+        # Runs on the thread, until the results run out or it is cancelled
+        pool = None
+        results = None
+        try:
+            if self.concurrency > 1:
+                pool = _make_pool(self.concurrency, self.executor)
+            results = self.bag.iter_validate(processes=self.concurrency, pool=pool,
+                                             cancelled=self._cancelled, **self.options)
+            for result in results:
+                if not self._put(('result', result)):
+                    return
+            self._put(('done', None))
+        except Exception as e:
+            self._put(('error', e))
+        finally:
+            if results is not None:
+                results.close()
+            if pool is not None:
+                pool.terminate()
+
+    def _put(self, item):
+        """Queues an item for the event loop, returning False once cancelled"""
+        while not self._cancelled.is_set():
+            try:
+                self._results.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup)
+            except RuntimeError:
+                # the event loop has been closed
+                self.cancel()
+            return True
+        return False
+
+    def _on_waiter_done(self, waiter):
+        if waiter.cancelled():
+            self._waiter = None
+            self.cancel()
+
+    def _wakeup(self):
+        waiter = self._waiter
+        if waiter is None or waiter.done():
+            return
+
+        if self._finished is None:
+            try:
+                kind, value = self._results.get_nowait()
+            except queue.Empty:
+                return
+            if kind == 'result':
+                self._waiter = None
+                waiter.set_result(value)
+                return
+            self._finished = value if kind == 'error' else StopAsyncIteration()
+
+        self._waiter = None
+        waiter.set_exception(self._finished)
+        if not isinstance(self._finished, StopAsyncIteration):
+            # raised once; the iteration is over after that
+            self._finished = StopAsyncIteration()
+
+
 def posix_multiprocessing_worker_initializer():
     """Ignore SIGINT in multiprocessing workers on POSIX systems"""
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
-def _calc_hashes(args):
-    # auto unpacking of sequences illegal in Python3
-    (base_path, rel_path, hashes, available_hashes) = args
-    full_path = os.path.join(base_path, rel_path)
+# The throttle shared by the processes of a multiprocessing pool, and the
+# context of the batches they are sent, set by _worker_initializer
+_worker_throttle = None
+_worker_context = None
 
-    # Create a clone of the default empty hash objects:
-    f_hashers = dict(
-        (alg, hashlib.new(alg)) for alg in hashes if alg in available_hashes
-    )
 
-    try:
-        f_hashes = _calculate_file_hashes(full_path, f_hashers)
-    except BagValidationError as e:
-        f_hashes = dict(
-            (alg, force_unicode(e)) for alg in f_hashers.keys()
-        )
+def _worker_initializer(throttle=None, context=None):
+    global _worker_throttle, _worker_context
+    _worker_throttle = throttle
+    _worker_context = context
+    if os.name == 'posix':
+        posix_multiprocessing_worker_initializer()
+
+
+def _make_pool(processes, executor='process', throttle=None, context=None):
+    """
+    Returns a multiprocessing pool, or for executor='thread' a thread pool
+    with the same interface. processes=0 uses one worker per CPU. Worker
+    processes share the given _Throttle, and the context used by
+    _hash_batch and _manifest_batch is sent to each of them once.
+    """
+    if executor == 'thread':
+        return multiprocessing.pool.ThreadPool(processes if processes else None)
+
+    return multiprocessing.Pool(processes if processes else None, initializer=_worker_initializer,
+                                initargs=(throttle, context))
+
+
+def _batch_size(count, workers):
+    """
+    The number of files sent to a worker at once: small batches keep
+    results flowing back steadily while still amortizing the per-task
+    overhead for large bags
+    """
+    return max(1, min(64, count // (4 * workers)))
+
+
+def _batches(items, size):
+    """Splits a list into lists of at most size items"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class _Throttle(object):
+    """
+    Paces reads so the combined rate of all of the threads and processes
+    sharing the throttle stays below bytes_per_second. Each read reserves
+    the next free slot of time on a shared clock and waits for it to start.
+    """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = float(bytes_per_second)
+        self._next_slot = multiprocessing.Value('d', 0.0)
+
+    def consume(self, byte_count):
+        with self._next_slot.get_lock():
+            now = time.time()
+            start = max(now, self._next_slot.value)
+            self._next_slot.value = start + byte_count / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+class Journal(object):
+    """
+    An append-only record of the digests calculated for files, used to
+    resume an interrupted make_bag(), save() or validate(). Each line is a
+    JSON object holding the digests of a file along with the size,
+    modification time and inode it had when it was read; the digests are
+    only reused while the file still has the same signature.
+
+    Records are flushed to disk every flush_interval seconds or
+    flush_records records, so at most that much work is lost if the
+    process is killed.
+    """
+
+    def __init__(self, path, flush_interval=10, flush_records=1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self._files = {}
+        self._moved = set()
+        self._pending = 0
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line may have been cut short by a crash
+                        continue
+                    if 'payload_moved' in record:
+                        self._moved.add(record['payload_moved'])
+                    elif 'path' in record:
+                        self._files[record['path']] = record
+            LOGGER.info("loaded %s journaled files from %s", len(self._files), path)
+
+        self._file = open(path, 'a')
+
+    def lookup(self, full_path, st, algorithms):
+        """
+        Returns the journaled digests of the file for the given algorithms,
+        or None if some are missing or the file has changed since
+        """
+        record = self._files.get(abspath(full_path))
+        if record is None or record['signature'] != _stat_signature(st):
+            return None
+        hashes = record['hashes']
+        if not all(alg in hashes for alg in algorithms):
+            return None
+        return dict((alg, hashes[alg]) for alg in algorithms)
+
+    def record(self, full_path, st, hashes):
+        """
+        Records the digests calculated for a file which had the given stat
+        result before it was read. Failures to read the file are not kept.
+        """
+        hashes = dict((alg, digest) for alg, digest in hashes.items()
+                      if re.match(r'^[0-9a-f]+$', digest))
+        if not hashes:
+            return
+        record = {'path': abspath(full_path), 'signature': _stat_signature(st), 'hashes': hashes}
+        self._files[record['path']] = record
+        self._write(record)
+
+    def payload_moved(self, bag_dir):
+        """
+        Returns True if make_bag() already moved the payload of bag_dir into
+        its data directory
+        """
+        return abspath(bag_dir) in self._moved
+
+    def record_payload_moved(self, bag_dir):
+        self._moved.add(abspath(bag_dir))
+        self._write({'payload_moved': abspath(bag_dir)})
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = 0
+            self._last_flush = time.time()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record, sort_keys=True) + '\n')
+            self._pending += 1
+            due = (self._pending >= self.flush_records
+                   or time.time() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+
+def _stat_signature(st):
+    """
+    Returns the size, modification time and inode from a stat result, which
+    together identify one version of a file's contents
+    """
+    return [st.st_size, _mtime(st), st.st_ino]
+
+
+class DigestStore(object):
+    """
+    A SQLite database of file digests shared between bags, so files which
+    appear in many bags (or many versions of a bag) are only read once.
+
+    Digests are keyed by the device, inode, size and modification time of
+    the file they were calculated for, which only identify its content on
+    the machine where it was read. Digests older than max_age seconds are
+    ignored, so that every file is read again at least once per audit
+    cycle; purge() removes them.
+
+    A single store may be used by several threads, but should be closed
+    once the bags using it have been created or validated.
+    """
+
+    def __init__(self, path, max_age=None, commit_records=1000):
+        self.path = path
+        self.max_age = max_age
+        self.commit_records = commit_records
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS digests ("
+                         "device INTEGER, inode INTEGER, size INTEGER, mtime INTEGER, "
+                         "algorithm TEXT, digest TEXT, hashed_at REAL, "
+                         "PRIMARY KEY (device, inode, size, mtime, algorithm))")
+        self._db.commit()
+
+    def lookup(self, full_path, st, algorithms):
+        """
+        Returns the stored digests of the file for the given algorithms, or
+        None if some are missing or too old
+        """
+        oldest = time.time() - self.max_age if self.max_age is not None else 0
+        with self._lock:
+            rows = self._db.execute("SELECT algorithm, digest FROM digests "
+                                    "WHERE device = ? AND inode = ? AND size = ? AND mtime = ? "
+                                    "AND hashed_at >= ?", _store_key(st) + (oldest,)).fetchall()
+        hashes = dict(rows)
+        if not all(alg in hashes for alg in algorithms):
+            return None
+        return dict((alg, hashes[alg]) for alg in algorithms)
+
+    def record(self, full_path, st, hashes):
+        """
+        Stores the digests calculated for a file which had the given stat
+        result before it was read. Failures to read the file are not kept.
+        """
+        now = time.time()
+        rows = [_store_key(st) + (alg, digest, now) for alg, digest in hashes.items()
+                if re.match(r'^[0-9a-f]+$', digest)]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._pending += 1
+            if self._pending >= self.commit_records:
+                self._db.commit()
+                self._pending = 0
+
+    def purge(self):
+        """Removes the digests which are older than max_age"""
+        if self.max_age is None:
+            return
+        with self._lock:
+            self._db.execute("DELETE FROM digests WHERE hashed_at < ?", (time.time() - self.max_age,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+def _store_key(st):
+    return (st.st_dev, st.st_ino, st.st_size, _mtime(st))
+
+
+class BagCatalog(object):
+    """
+    A SQLite index of the bag-info.txt metadata and manifest entries of
+    many bags, so that questions such as which bags hold a file with a
+    given digest, or the total size of a group of bags, can be answered
+    without opening every bag and parsing its manifests.
+
+    update() only re-reads a bag when the size or modification time of its
+    bagit.txt, bag-info.txt or payload manifests has changed, so indexing
+    a large collection again is cheap.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS bags (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE, signature TEXT, indexed_at REAL,
+                byte_count INTEGER, file_count INTEGER);
+            CREATE TABLE IF NOT EXISTS bag_info (bag_id INTEGER, name TEXT, value TEXT);
+            CREATE INDEX IF NOT EXISTS bag_info_name ON bag_info (name, value);
+            CREATE TABLE IF NOT EXISTS entries (bag_id INTEGER, path TEXT, algorithm TEXT, digest TEXT);
+            CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
+            CREATE INDEX IF NOT EXISTS entries_path ON entries (path);
+            CREATE INDEX IF NOT EXISTS entries_bag ON entries (bag_id);
+        """)
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def update(self, bag_dir):
+        """
+        Indexes the bag in bag_dir unless it is unchanged since it was last
+        indexed, and returns whether it was (re)indexed
+        """
+        bag_dir = os.path.abspath(bag_dir)
+        signature = json.dumps(self._signature(bag_dir))
+        with self._lock:
+            row = self._db.execute("SELECT signature FROM bags WHERE path = ?", (bag_dir,)).fetchone()
+        if row is not None and row[0] == signature:
+            return False
+
+        encoding, algorithms = _manifest_algorithms(bag_dir)
+        info = {}
+        for info_file in ("bag-info.txt", "package-info.txt"):
+            if isfile(join(bag_dir, info_file)):
+                info = _load_tag_file(join(bag_dir, info_file), encoding=encoding)
+                break
+        byte_count = file_count = None
+        oxum = info.get('Payload-Oxum')
+        if isinstance(oxum, list):
+            oxum = oxum[0]
+        if oxum and re.match(r'^\d+\.\d+$', oxum):
+            byte_count, file_count = (int(i) for i in oxum.split('.', 1))
+
+        LOGGER.info("indexing %s in %s", bag_dir, self.path)
+        with self._lock:
+            try:
+                self._remove(bag_dir)
+                bag_id = self._db.execute("INSERT INTO bags (path, signature, indexed_at, byte_count, file_count) "
+                                          "VALUES (?, ?, ?, ?, ?)",
+                                          (bag_dir, signature, time.time(), byte_count, file_count)).lastrowid
+                for name, values in info.items():
+                    if not isinstance(values, list):
+                        values = [values]
+                    self._db.executemany("INSERT INTO bag_info VALUES (?, ?, ?)",
+                                         ((bag_id, name, value) for value in values))
+                for algorithm in algorithms:
+                    manifest_file = join(bag_dir, "manifest-%s.txt" % algorithm)
+                    self._db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?)",
+                                         ((bag_id, path, algorithm, digest.lower())
+                                          for path, digest in _iter_manifest(manifest_file, encoding, bag_dir)))
+            except Exception:
+                self._db.rollback()
+                raise
+            self._db.commit()
+        return True
+
+    def update_all(self, top):
+        """
+        Indexes every bag at or below top, and forgets bags below top which
+        no longer exist. Returns the number of bags (re)indexed.
+        """
+        top = os.path.abspath(top)
+        found = set()
+        updated = 0
+        for dirpath, dirnames, filenames in _walk_tree(top):
+            if 'bagit.txt' in filenames:
+                # bags are not looked for in the payload of other bags
+                dirnames[:] = []
+                found.add(dirpath)
+                try:
+                    updated += self.update(dirpath)
+                except (BagError, IOError, OSError) as e:
+                    LOGGER.error("Unable to index %s: %s", dirpath, e)
+        for bag_dir in self.bags():
+            if (bag_dir == top or bag_dir.startswith(top + os.sep)) and bag_dir not in found:
+                self.remove(bag_dir)
+        return updated
+
+    def remove(self, bag_dir):
+        """Removes a bag from the catalog"""
+        with self._lock:
+            self._remove(os.path.abspath(bag_dir))
+            self._db.commit()
+
+    def _remove(self, bag_dir):
+        row = self._db.execute("SELECT id FROM bags WHERE path = ?", (bag_dir,)).fetchone()
+        if row is not None:
+            self._db.execute("DELETE FROM entries WHERE bag_id = ?", row)
+            self._db.execute("DELETE FROM bag_info WHERE bag_id = ?", row)
+            self._db.execute("DELETE FROM bags WHERE id = ?", row)
+
+    @staticmethod
+    def _signature(bag_dir):
+        signature = []
+        for name in sorted(os.listdir(bag_dir)):
+            if name in ("bagit.txt", "bag-info.txt", "package-info.txt") or re.match(r'^manifest-.+\.txt$', name):
+                st = os.stat(join(bag_dir, name))
+                signature.append([name, st.st_size, _mtime(st)])
+        return signature
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def bags(self, **info):
+        """
+        Returns the paths of the bags in the catalog, or of those whose
+        bag-info.txt has each of the given values, such as
+        bags(Source_Organization='...'), with underscores for hyphens
+        """
+        sql = "SELECT path FROM bags"
+        conditions = []
+        parameters = []
+        for name, value in sorted(info.items()):
+            conditions.append("id IN (SELECT bag_id FROM bag_info WHERE name = ? AND value = ?)")
+            parameters.extend([name.replace('_', '-'), value])
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return [row[0] for row in self._query(sql + " ORDER BY path", parameters)]
+
+    def info(self, bag_dir):
+        """Returns the indexed bag-info.txt metadata of a bag, as in Bag.info"""
+        info = {}
+        for name, value in self._query("SELECT name, value FROM bag_info JOIN bags ON bags.id = bag_id "
+                                       "WHERE bags.path = ? ORDER BY bag_info.rowid",
+                                       (os.path.abspath(bag_dir),)):
+            if name not in info:
+                info[name] = value
+            elif isinstance(info[name], list):
+                info[name].append(value)
+            else:
+                info[name] = [info[name], value]
+        return info
+
+    def find_digest(self, digest, algorithm=None):
+        """Returns the (bag path, payload path, algorithm) of the entries with a digest"""
+        sql = ("SELECT bags.path, entries.path, algorithm FROM entries JOIN bags ON bags.id = bag_id "
+               "WHERE digest = ?")
+        parameters = [digest.lower()]
+        if algorithm is not None:
+            sql += " AND algorithm = ?"
+            parameters.append(algorithm)
+        return [tuple(row) for row in self._query(sql + " ORDER BY bags.path, entries.path", parameters)]
+
+    def find_path(self, pattern):
+        """
+        Returns the (bag path, payload path) of the entries whose paths
+        match a glob, such as data/*/report.pdf
+        """
+        return [tuple(row) for row in self._query(
+            "SELECT DISTINCT bags.path, entries.path FROM entries JOIN bags ON bags.id = bag_id "
+            "WHERE entries.path GLOB ? ORDER BY bags.path, entries.path", (pattern,))]
+
+    def oxum(self, **info):
+        """
+        Returns the total Payload-Oxum, as (byte_count, file_count), of the
+        bags selected as for bags(), e.g. oxum(Bag_Group_Identifier='X')
+        """
+        paths = self.bags(**info)
+        byte_count = file_count = 0
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            row = self._query("SELECT SUM(byte_count), SUM(file_count) FROM bags WHERE path IN (%s)"
+                              % ", ".join("?" * len(chunk)), chunk)[0]
+            byte_count += row[0] or 0
+            file_count += row[1] or 0
+        return byte_count, file_count
+
+
+class _DigestCaches(object):
+    """
+    Looks up digests in each of a Journal and a DigestStore in turn, and
+    records newly calculated digests in both
+    """
+
+    def __init__(self, caches):
+        self.caches = caches
+
+    def lookup(self, full_path, st, algorithms):
+        for cache in self.caches:
+            hashes = cache.lookup(full_path, st, algorithms)
+            if hashes is not None:
+                return hashes
+        return None
+
+    def record(self, full_path, st, hashes):
+        for cache in self.caches:
+            cache.record(full_path, st, hashes)
+
+
+def _digest_cache(*caches):
+    """
+    Returns an object with lookup() and record() methods for any of the
+    given Journal and DigestStore which are not None, or None if all are
+    """
+    caches = [cache for cache in caches if cache is not None]
+    if not caches:
+        return None
+    if len(caches) == 1:
+        return caches[0]
+    return _DigestCaches(caches)
+
+
+class DirectoryQueueTransport(object):
+    """
+    Carries the shards of Bag.iter_validate_sharded() to run_shard_worker()
+    processes, and their results back, through a directory which all of
+    them can reach, e.g. on the same network filesystem as the bag.
+
+    Shards are written to pending/ and a worker claims one by renaming it
+    into claimed/, which succeeds for exactly one worker, and results are
+    written to results/. Files are written under a temporary name and
+    renamed into place, so they are never read half written.
+
+    Other transports only need the same methods: put_shard, claim_shard,
+    put_result, take_results, requeue_stale and cancel.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        for directory in ('pending', 'claimed', 'results'):
+            try:
+                os.makedirs(join(self.path, directory))
+            except OSError:
+                if not isdir(join(self.path, directory)):
+                    raise
+
+    def _write(self, directory, name, record):
+        temp_file = join(self.path, directory, ".%s.%s.tmp" % (name, os.getpid()))
+        with open_text_file(temp_file, 'w') as f:
+            f.write(force_unicode(json.dumps(record)))
+        os.rename(temp_file, join(self.path, directory, name + ".json"))
+
+    def _read(self, path):
+        with open_text_file(path, 'r') as f:
+            return json.load(f)
+
+    def _names(self, directory):
+        return sorted(name[:-len(".json")] for name in os.listdir(join(self.path, directory))
+                      if name.endswith(".json") and not name.startswith("."))
+
+    def put_shard(self, shard_id, shard):
+        """Queues a shard for the workers"""
+        self._write('pending', shard_id, shard)
+
+    def claim_shard(self, worker_id):
+        """Returns the (shard_id, shard) of a pending shard, or None"""
+        for shard_id in self._names('pending'):
+            claimed = join(self.path, 'claimed', shard_id + ".json")
+            try:
+                os.rename(join(self.path, 'pending', shard_id + ".json"), claimed)
+            except OSError:
+                # claimed by another worker first
+                continue
+            # the time of the claim, for requeue_stale
+            os.utime(claimed, None)
+            LOGGER.debug("%s claimed shard %s", worker_id, shard_id)
+            return shard_id, self._read(claimed)
+        return None
+
+    def put_result(self, shard_id, result):
+        """Returns the result of a claimed shard to the coordinator"""
+        self._write('results', shard_id, result)
+        try:
+            os.remove(join(self.path, 'claimed', shard_id + ".json"))
+        except OSError:
+            pass
+
+    def take_results(self, shard_ids):
+        """Yields and removes the (shard_id, result) of the shards which are done"""
+        wanted = set(shard_ids)
+        for shard_id in self._names('results'):
+            if shard_id in wanted:
+                path = join(self.path, 'results', shard_id + ".json")
+                result = self._read(path)
+                os.remove(path)
+                yield shard_id, result
+
+    def requeue_stale(self, max_age):
+        """Puts back shards which were claimed more than max_age seconds ago"""
+        now = time.time()
+        for shard_id in self._names('claimed'):
+            claimed = join(self.path, 'claimed', shard_id + ".json")
+            try:
+                if now - os.stat(claimed).st_mtime > max_age:
+                    LOGGER.warning("handing out shard %s again", shard_id)
+                    os.rename(claimed, join(self.path, 'pending', shard_id + ".json"))
+            except OSError:
+                # finished or requeued in the meantime
+                pass
+
+    def cancel(self, shard_ids):
+        """Withdraws any of the shards which have not been claimed yet"""
+        for shard_id in shard_ids:
+            try:
+                os.remove(join(self.path, 'pending', shard_id + ".json"))
+            except OSError:
+                pass
+
+
+def run_shard_worker(transport, processes=1, worker_id=None, idle_timeout=None, poll_interval=1.0):
+    """
+    Hashes the files of the shards handed out by Bag.iter_validate_sharded()
+    through the transport, with processes as for Bag.validate(), and
+    returns the number of shards done once none have arrived for
+    idle_timeout seconds (or never, by default).
+    """
+    if worker_id is None:
+        worker_id = "%s-%s" % (socket.gethostname(), os.getpid())
+    # opening a bag reads its manifests, which is worth doing only once
+    bags = {}
+    done = 0
+    idle_since = time.time()
+    while True:
+        claimed = transport.claim_shard(worker_id)
+        if claimed is None:
+            if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                return done
+            time.sleep(poll_interval)
+            continue
+
+        shard_id, shard = claimed
+        LOGGER.info("%s: validating shard %s of %s", worker_id, shard_id, shard['bag'])
+        try:
+            if shard['bag'] not in bags:
+                bags[shard['bag']] = Bag(shard['bag'])
+            entries = [(path, hashes) for path, hashes in shard['entries']]
+            records = []
+            for result in bags[shard['bag']]._iter_hash_entries(processes, entries):
+                records.append({'path': result.path, 'found': result.found, 'bytes': result.bytes,
+                                'duration': result.duration})
+            result = {'worker': worker_id, 'results': records}
+        except BagError as e:
+            result = {'worker': worker_id, 'error': force_unicode(e)}
+        except Exception as e:
+            # reported to the coordinator rather than leaving the shard
+            # claimed by a worker which is no longer running
+            LOGGER.exception("%s: could not validate shard %s", worker_id, shard_id)
+            result = {'worker': worker_id, 'error': "%s: %s" % (type(e).__name__, force_unicode(e))}
+        transport.put_result(shard_id, result)
+        done += 1
+        idle_since = time.time()
+
+
+def _balanced_shards(base_dir, entries, count):
+    """
+    Splits the (path, hashes) entries into at most count lists with roughly
+    the same number of bytes, largest files first
+    """
+    sized = []
+    for path, hashes in entries:
+        try:
+            size = os.stat(join(base_dir, path)).st_size
+        except OSError:
+            size = 0
+        sized.append((size, path, hashes))
+    sized.sort(key=lambda entry: (-entry[0], entry[1]))
+
+    count = max(1, min(count, len(sized)))
+    shards = [[] for _ in range(count)]
+    totals = [(0, i) for i in range(count)]
+    for size, path, hashes in sized:
+        total, i = heapq.heappop(totals)
+        shards[i].append([path, hashes])
+        heapq.heappush(totals, (total + size, i))
+    return [sorted(shard) for shard in shards if shard]
+
+
+def _job_count(value):
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool) and value >= 1
+
+
+def _job_processes(value):
+    # no more workers than the CPUs of the daemon's host
+    return _job_count(value) and value <= multiprocessing.cpu_count()
+
+
+def _job_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool) and value > 0
+
+
+def _job_flag(value):
+    return isinstance(value, bool)
+
+
+def _job_strings(value):
+    return isinstance(value, list) and all(isinstance(v, type('')) for v in value)
+
+
+def _job_algorithms(value):
+    return _job_strings(value) and all(v in CHECKSUM_ALGOS for v in value)
+
+
+def _job_bag_info(value):
+    return isinstance(value, dict) and all(isinstance(v, type('')) or _job_strings(v) for v in value.values())
+
+
+class ValidationDaemon(object):
+    """
+    A long-running service which validates and creates bags on request,
+    so that a scheduler does not pay for starting Python, parsing manifests
+    and starting workers for every bag.
+
+    Jobs are submitted over HTTP, on a (host, port) address or the path of
+    a Unix socket:
+
+    POST /jobs with {"type": "validate" or "create", "path": ..., "priority":
+    0, "options": {...}} queues a job and returns it, with its id. Jobs of
+    higher priority run first, and options are passed on to
+    Bag.iter_validate() or make_bag(). Only the options in JOB_OPTIONS are
+    accepted, none of which name files for the daemon to write, and the
+    path must be below one of the roots the daemon was given. There is no
+    authentication, so a (host, port) address should only be reachable by
+    trusted clients.
+
+    GET /jobs and GET /jobs/<id> return the state of the jobs.
+
+    GET /metrics returns Prometheus metrics: bytes and files hashed (in
+    total and per second over the last minute), queue depth, job latency
+    and error counts.
+
+    concurrency jobs run at once, all hashing with a single pool of
+    processes kept for the life of the daemon (see _make_pool), and the
+    manifests of the most recently used bag_cache_size bags are kept
+    loaded until they change.
+
+    processes='auto' takes the number of processes and the executor from
+    the tuned settings (see tune()) for the first of the roots.
+
+    max_bytes_per_second caps the read rate of validate jobs. The worker
+    processes of the pool share one limit; with processes=1 or
+    executor='thread' the limit applies to each job.
+    """
+
+    JOB_TYPES = ('validate', 'create')
+
+    #: The options which jobs of each type may give, with a check of their
+    #: values
+    JOB_OPTIONS = {
+        'validate': {
+            'processes': _job_processes,
+            'fast': _job_flag,
+            'sample': _job_number,
+            'sample_bytes': _job_count,
+            'dedupe': _job_flag,
+            'fadvise': _job_flag,
+            'include': _job_strings,
+            'exclude': _job_strings,
+        },
+        'create': {
+            'processes': _job_processes,
+            'checksum': _job_algorithms,
+            'bag_info': _job_bag_info,
+            'dedupe': _job_flag,
+            'fadvise': _job_flag,
+            'rollup': _job_flag,
+        },
+    }
+
+    def __init__(self, address, roots, processes=1, executor='process', concurrency=1, bag_cache_size=16,
+                 max_bytes_per_second=None):
+        self.address = address
+        self.roots = [os.path.realpath(root) for root in roots]
+        if not self.roots:
+            raise ValueError("a ValidationDaemon needs at least one root directory for its jobs")
+        self.metrics = _DaemonMetrics()
+        self._pool = None
+        # the rate limit given to each job, where it is not already
+        # enforced by the worker processes
+        self._job_max_bytes_per_second = max_bytes_per_second
+        if processes == 'auto':
+            settings = _hashing_settings(processes, self.roots[0], ['md5'])
+            processes, executor = settings['processes'], settings['executor']
+        if processes != 1:
+            throttle = None
+            if max_bytes_per_second and executor != 'thread':
+                throttle = _Throttle(max_bytes_per_second)
+                self._job_max_bytes_per_second = None
+            self._pool = _make_pool(processes, executor, throttle=throttle)
+        self._lock = threading.Lock()
+        self._queue = queue.PriorityQueue()
+        self._jobs = OrderedDict()
+        self._sequence = 0
+        self._bags = OrderedDict()
+        self._bag_cache_size = bag_cache_size
+        self._running = 0
+
+        if isinstance(address, tuple):
+            self._server = _DaemonHTTPServer(address, _DaemonRequestHandler)
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            self._server = _DaemonUnixHTTPServer(address, _DaemonRequestHandler)
+        self._server.bagit_daemon = self
+        if isinstance(address, tuple):
+            # with the port chosen if 0 was given
+            self.address = self._server.server_address[:2]
+
+        self._runners = []
+        for _ in range(max(1, concurrency)):
+            runner = threading.Thread(target=self._run_jobs)
+            runner.daemon = True
+            runner.start()
+            self._runners.append(runner)
+
+    def serve_forever(self):
+        LOGGER.info("serving bagit jobs on %s", self.address)
+        self._server.serve_forever()
+
+    def start(self):
+        """Serves requests from a background thread"""
+        server = threading.Thread(target=self.serve_forever)
+        server.daemon = True
+        server.start()
+
+    def close(self):
+        """Stops serving requests, leaving any queued jobs unfinished"""
+        self._server.shutdown()
+        self._server.server_close()
+        if not isinstance(self.address, tuple):
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+        for _ in self._runners:
+            # after any queued jobs, which are abandoned
+            self._queue.put((float('inf'), 0, None))
+        if self._pool is not None:
+            self._pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, job_type, path, priority=0, options=None):
+        """Queues a job and returns its state"""
+        if job_type not in self.JOB_TYPES:
+            raise ValueError("unknown job type %s" % job_type)
+        if not isinstance(options or {}, dict):
+            raise ValueError("options must be an object")
+        allowed = self.JOB_OPTIONS[job_type]
+        for name, value in (options or {}).items():
+            if name not in allowed:
+                raise ValueError("option %s is not allowed in %s jobs" % (name, job_type))
+            if not allowed[name](value):
+                raise ValueError("invalid value for option %s: %r" % (name, value))
+        # symlinks are resolved so they cannot lead out of the roots
+        path = os.path.realpath(path)
+        if not any(path == root or path.startswith(root.rstrip(os.sep) + os.sep) for root in self.roots):
+            raise ValueError("%s is not below any of the roots of this daemon" % path)
+        with self._lock:
+            self._sequence += 1
+            job = {
+                'id': "%s-%s" % (int(time.time()), self._sequence),
+                'type': job_type,
+                'path': path,
+                'priority': priority,
+                'options': options or {},
+                'status': 'queued',
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'files': 0,
+                'bytes': 0,
+                'error_count': 0,
+                'errors': [],
+                'error': None,
+            }
+            self._jobs[job['id']] = job
+            self._queue.put((-priority, self._sequence, job['id']))
+            LOGGER.info("queued %s job %s for %s", job_type, job['id'], job['path'])
+            return dict(job)
+
+    def job(self, job_id):
+        """Returns the state of a job, or None if there is no such job"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def jobs(self):
+        with self._lock:
+            return [dict(job) for job in self._jobs.values()]
+
+    def wait(self, job_id, timeout=None, poll_interval=0.1):
+        """Returns the state of a job once it has finished, or None after timeout seconds"""
+        deadline = time.time() + timeout if timeout is not None else None
+        while deadline is None or time.time() < deadline:
+            job = self.job(job_id)
+            if job is None or job['finished'] is not None:
+                return job
+            time.sleep(poll_interval)
+        return None
+
+    def metrics_text(self):
+        with self._lock:
+            queued = sum(1 for job in self._jobs.values() if job['status'] == 'queued')
+            running = self._running
+        return self.metrics.render(queued, running)
+
+    def _run_jobs(self):
+        while True:
+            _, _, job_id = self._queue.get()
+            if job_id is None:
+                return
+            with self._lock:
+                job = self._jobs[job_id]
+                job['status'] = 'running'
+                job['started'] = time.time()
+                self._running += 1
+            self.metrics.observe('bagit_job_wait_seconds', job['started'] - job['submitted'], type=job['type'])
+            try:
+                if job['type'] == 'create':
+                    status = self._create(job)
+                else:
+                    status = self._validate(job)
+            except BagError as e:
+                status = 'invalid' if job['type'] == 'validate' else 'failed'
+                self._finish_error(job, e)
+            except Exception as e:
+                LOGGER.exception("%s job %s for %s failed", job['type'], job['id'], job['path'])
+                status = 'failed'
+                self._finish_error(job, e)
+            with self._lock:
+                job['status'] = status
+                job['finished'] = time.time()
+                self._running -= 1
+            self.metrics.inc('bagit_jobs_total', type=job['type'], status=status)
+            self.metrics.observe('bagit_job_duration_seconds', job['finished'] - job['started'], type=job['type'])
+            LOGGER.info("%s job %s for %s: %s", job['type'], job['id'], job['path'], status)
+
+    def _finish_error(self, job, e):
+        with self._lock:
+            job['error'] = force_unicode(e)
+        self.metrics.inc('bagit_job_errors_total', type=job['type'])
+
+    def _validate(self, job):
+        bag = self._open_bag(job['path'])
+        for result in bag.iter_validate(pool=self._pool, max_bytes_per_second=self._job_max_bytes_per_second,
+                                        **job['options']):
+            with self._lock:
+                job['files'] += 1
+                job['bytes'] += result.bytes or 0
+                if result.errors:
+                    job['error_count'] += len(result.errors)
+                    # enough to show what went wrong without the state of a
+                    # badly damaged bag growing without bound
+                    job['errors'].extend(force_unicode(e) for e in result.errors[:100 - len(job['errors'])])
+            if result.bytes is not None:
+                self.metrics.hashed(result.bytes)
+            if result.errors:
+                self.metrics.inc('bagit_validation_errors_total', len(result.errors))
+        return 'invalid' if job['error_count'] else 'valid'
+
+    def _create(self, job):
+        bag = make_bag(job['path'], pool=self._pool, **job['options'])
+        byte_count, file_count = bag.info['Payload-Oxum'].split('.', 1)
+        with self._lock:
+            job['files'] = int(file_count)
+            job['bytes'] = int(byte_count)
+        self.metrics.hashed(int(byte_count), int(file_count))
+        return 'done'
+
+    def _open_bag(self, path):
+        """
+        Returns the Bag at path, reusing its parsed manifests while the tag
+        files in its top directory are unchanged
+        """
+        signature = []
+        for name in sorted(os.listdir(path)):
+            full_path = join(path, name)
+            if isfile(full_path):
+                st = os.stat(full_path)
+                signature.append((name, st.st_size, _mtime(st)))
+        with self._lock:
+            cached = self._bags.pop(path, None)
+        if cached is not None and cached[0] == signature:
+            bag = cached[1]
+        else:
+            bag = Bag(path)
+        with self._lock:
+            self._bags[path] = (signature, bag)
+            while len(self._bags) > self._bag_cache_size:
+                self._bags.popitem(last=False)
+        return bag
+
+
+class _DaemonMetrics(object):
+    """The counters of a ValidationDaemon, in the Prometheus text format"""
+
+    HELP = OrderedDict([
+        ('bagit_hashed_bytes_total', ('counter', 'Bytes of files hashed')),
+        ('bagit_hashed_files_total', ('counter', 'Files hashed')),
+        ('bagit_bytes_per_second', ('gauge', 'Bytes hashed per second over the last minute')),
+        ('bagit_files_per_second', ('gauge', 'Files hashed per second over the last minute')),
+        ('bagit_queue_depth', ('gauge', 'Jobs waiting to run')),
+        ('bagit_jobs_running', ('gauge', 'Jobs running')),
+        ('bagit_jobs_total', ('counter', 'Jobs finished, by type and status')),
+        ('bagit_job_errors_total', ('counter', 'Jobs stopped by an error, by type')),
+        ('bagit_validation_errors_total', ('counter', 'Problems found in bags by validate jobs')),
+        ('bagit_job_wait_seconds', ('summary', 'Time jobs spent queued, by type')),
+        ('bagit_job_duration_seconds', ('summary', 'Time jobs took to run, by type')),
+    ])
+
+    def __init__(self, window=60):
+        self.window = window
+        self._lock = threading.Lock()
+        self._values = {}
+        self._recent = deque()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        self.inc(name + '_sum', value, **labels)
+        self.inc(name + '_count', 1, **labels)
+
+    def hashed(self, byte_count, file_count=1):
+        self.inc('bagit_hashed_bytes_total', byte_count)
+        self.inc('bagit_hashed_files_total', file_count)
+        now = time.time()
+        with self._lock:
+            self._recent.append((now, byte_count, file_count))
+
+    def _rates(self):
+        cutoff = time.time() - self.window
+        with self._lock:
+            while self._recent and self._recent[0][0] < cutoff:
+                self._recent.popleft()
+            byte_count = sum(r[1] for r in self._recent)
+            file_count = sum(r[2] for r in self._recent)
+        return byte_count / self.window, file_count / self.window
+
+    def render(self, queued, running):
+        bytes_per_second, files_per_second = self._rates()
+        with self._lock:
+            values = dict(self._values)
+        values[('bagit_bytes_per_second', ())] = bytes_per_second
+        values[('bagit_files_per_second', ())] = files_per_second
+        values[('bagit_queue_depth', ())] = queued
+        values[('bagit_jobs_running', ())] = running
+        for name in ('bagit_hashed_bytes_total', 'bagit_hashed_files_total'):
+            values.setdefault((name, ()), 0)
+
+        lines = []
+        for family, (metric_type, help_text) in self.HELP.items():
+            lines.append("# HELP %s %s" % (family, help_text))
+            lines.append("# TYPE %s %s" % (family, metric_type))
+            for (name, labels), value in sorted(values.items()):
+                if name != family and name not in (family + '_sum', family + '_count'):
+                    continue
+                if labels:
+                    name += "{%s}" % ",".join('%s="%s"' % label for label in labels)
+                lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+
+class _DaemonRequestHandler(BaseHTTPRequestHandler):
+    """The HTTP API of a ValidationDaemon"""
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+    def _reply(self, status, body, content_type='application/json'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, status, record):
+        self._reply(status, force_unicode(json.dumps(record, sort_keys=True)))
+
+    def do_GET(self):
+        daemon = self.server.bagit_daemon
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path == '/metrics':
+            self._reply(200, daemon.metrics_text(), content_type='text/plain; version=0.0.4')
+        elif path == '/jobs':
+            self._json(200, daemon.jobs())
+        elif path.startswith('/jobs/') and daemon.job(path[len('/jobs/'):]) is not None:
+            self._json(200, daemon.job(path[len('/jobs/'):]))
+        else:
+            self._json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        daemon = self.server.bagit_daemon
+        if self.path.rstrip('/') != '/jobs':
+            self._json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            job = daemon.submit(request.get('type', 'validate'), request['path'],
+                                priority=int(request.get('priority', 0)), options=request.get('options'))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._json(400, {'error': force_unicode(e)})
+            return
+        self._json(202, job)
+
+
+class _DaemonHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _DaemonUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+
+def _hash_batch(batch, context=None):
+    """
+    Hashes a batch of (rel_path, algorithms, prefetch) files for
+    Bag._iter_hash_entries, where algorithms is None for the algorithms of
+    the context, and returns a (rel_path, digests, byte_count, duration)
+    tuple for each with the hex digests in the order of the algorithms, or
+    the error message if the file could not be read.
+
+    The (base_path, algorithms, block_size, fadvise, throttle, cancelled)
+    context is set once for each worker process by _worker_initializer
+    rather than being sent with every batch.
+    """
+    base_path, default_algorithms, block_size, fadvise, throttle, cancelled = context or _worker_context
+    results = []
+    for rel_path, algorithms, prefetch in batch:
+        full_path = join(base_path, rel_path)
+        # start reading the next file while this one is hashed
+        if prefetch is not None:
+            _prefetch(join(base_path, prefetch))
+
+        LOGGER.info("Verifying checksum for file %s", full_path)
+        hashers = [_hasher(alg) for alg in algorithms or default_algorithms]
+        start = time.time()
+        try:
+            byte_count = _hash_file(full_path, hashers, cancelled=cancelled, block_size=block_size,
+                                    throttle=throttle or _worker_throttle, fadvise=fadvise)
+            digests = tuple(h.hexdigest() for h in hashers)
+        except BagValidationError as e:
+            digests = force_unicode(e)
+            byte_count = 0
+        results.append((rel_path, digests, byte_count, time.time() - start))
+    return results
+
+
+def _with_known(entries, known, hash_results, ordered):
+    """
+    Adds a (rel_path, digests, 0, 0.0) result for each of the entries
+    with known digests to the results of Bag._iter_hash_entries, in the
+    order of the entries if ordered and otherwise ahead of the others
+    """
+    if not ordered:
+        for rel_path, _ in entries:
+            if rel_path in known:
+                yield rel_path, known[rel_path], 0, 0.0
+        for result in hash_results:
+            yield result
+        return
+
+    for rel_path, _ in entries:
+        if rel_path in known:
+            yield rel_path, known[rel_path], 0, 0.0
+        else:
+            yield next(hash_results)
 
-    return rel_path, f_hashes, hashes
+
+def _compare_hashes(rel_path, f_hashes, hashes):
+    """
+    Returns a list of ChecksumMismatch errors for the computed hashes of
+    rel_path which do not match those stored in the manifest
+    """
+    errors = []
+    for alg, computed_hash in f_hashes.items():
+        stored_hash = hashes[alg]
+        if stored_hash.lower() != computed_hash:
+            e = ChecksumMismatch(rel_path, alg, stored_hash.lower(), computed_hash)
+            LOGGER.warning(force_unicode(e))
+            errors.append(e)
+    return errors
+
+
+def _hash_result(rel_path, f_hashes, hashes, byte_count=None, duration=None):
+    """
+    Builds a FileValidationResult from the digests found for a file and
+    those expected
+    """
+    errors = _compare_hashes(rel_path, f_hashes, hashes)
+    if errors:
+        status = FileValidationResult.MISMATCH
+    else:
+        status = FileValidationResult.OK
+    return FileValidationResult(rel_path, status, errors, expected=hashes, found=f_hashes,
+                                byte_count=byte_count, duration=duration)
 
 
-def _calculate_file_hashes(full_path, f_hashers):
+def _calculate_file_hashes(full_path, f_hashers, cancelled=None, block_size=HASH_BLOCK_SIZE, throttle=None,
+                           fadvise=False):
     """
     Returns a dictionary of (algorithm, hexdigest) values for the provided
     filename
+
+    If a threading.Event is passed as cancelled, hashing is abandoned with a
+    BagError as soon as it is set. Reads are paced by throttle if given, and
+    fadvise applies the page cache hints of _read_blocks.
     """
     LOGGER.info("Verifying checksum for file %s", full_path)
-    if not os.path.exists(full_path):
-        raise BagValidationError("%s does not exist" % full_path)
-
-    try:
-        with open(full_path, 'rb') as f:
-            while True:
-                block = f.read(1048576)
-                if not block:
-                    break
-                for i in f_hashers.values():
-                    i.update(block)
-    except IOError as e:
-        raise BagValidationError("could not read %s: %s" % (full_path, force_unicode(e)))
-    except OSError as e:
-        raise BagValidationError("could not read %s: %s" % (full_path, force_unicode(e)))
+    _hash_file(full_path, f_hashers.values(), cancelled=cancelled, block_size=block_size, throttle=throttle,
+               fadvise=fadvise)
 
     return dict(
         (alg, h.hexdigest()) for alg, h in f_hashers.items()
     )
 
 
+def _hash_file(full_path, hashers, cancelled=None, block_size=HASH_BLOCK_SIZE, throttle=None, fadvise=False):
+    """
+    Updates each of the hash objects with the contents of full_path and
+    returns the number of bytes read, raising BagValidationError if the
+    file cannot be read. See _calculate_file_hashes for the other arguments.
+    """
+    byte_count = 0
+    try:
+        # unbuffered, so that a file smaller than a block is read by a
+        # single system call
+        with open(full_path, 'rb', 0) as f:
+            size = os.fstat(f.fileno()).st_size
+            for block in _read_blocks(f, block_size, fadvise, size=size):
+                if cancelled is not None and cancelled.is_set():
+                    raise BagError("hashing of %s was cancelled" % full_path)
+                if throttle is not None:
+                    throttle.consume(len(block))
+                byte_count += len(block)
+                for h in hashers:
+                    h.update(block)
+    except (IOError, OSError) as e:
+        if not os.path.exists(full_path):
+            raise BagValidationError("%s does not exist" % full_path)
+        raise BagValidationError("could not read %s: %s" % (full_path, force_unicode(e)))
+
+    return byte_count
+
+
+def _load_cursor(cursor_file):
+    try:
+        with open_text_file(cursor_file, 'r') as f:
+            return json.load(f).get('cursor')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _save_cursor(cursor_file, cursor):
+    with open_text_file(cursor_file, 'w') as f:
+        json.dump({'cursor': cursor}, f)
+
+
+def _require_asyncio():
+    if asyncio is None:
+        raise RuntimeError("the asyncio API requires Python 3.5 or later")
+
+
+def _iter_manifest(manifest_file, encoding, source):
+    """
+    Yields the (path, digest) entries of a manifest file, logging invalid
+    entries against source
+    """
+    with open_text_file(manifest_file, 'r', encoding=encoding) as manifest:
+        for line in manifest:
+            line = line.strip()
+
+            # Ignore blank lines and comments.
+            if line == "" or line.startswith("#"):
+                continue
+
+            entry = line.split(None, 1)
+
+            # Format is FILENAME *CHECKSUM
+            if len(entry) != 2:
+                LOGGER.error("%s: Invalid %s entry: %s", source, os.path.basename(manifest_file), line)
+                continue
+
+            entry_path = os.path.normpath(entry[1].lstrip("*"))
+            yield _decode_filename(entry_path), entry[0]
+
+
+class _IndexedEntries(MutableMapping):
+    """
+    Bag.entries backed by a memory map of a manifest index written by
+    _write_manifest_index(). Entries are decoded as they are looked up;
+    changes are kept in memory and never written to the index, so the
+    dictionaries returned must be replaced rather than modified.
+    """
+
+    def __init__(self, mm, count, offsets_at, paths_at, algorithms):
+        self._mm = mm
+        self._count = count
+        self._offsets_at = offsets_at
+        self._paths_at = paths_at
+        # (name, digest width, offset of the presence flags, offset of the digests)
+        self._algorithms = algorithms
+        self._changed = {}
+        self._removed = set()
+
+    def _path(self, i):
+        start, end = struct.unpack_from('<QQ', self._mm, self._offsets_at + 8 * i)
+        return self._mm[self._paths_at + start:self._paths_at + end]
+
+    def _find(self, key):
+        try:
+            target = key.encode('utf-8')
+        except (AttributeError, UnicodeError):
+            return -1
+        # the paths are sorted by their UTF-8 encoding
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._path(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._path(lo) == target:
+            return lo
+        return -1
+
+    def _hashes(self, i):
+        hashes = {}
+        for name, width, flags_at, digests_at in self._algorithms:
+            if self._mm[flags_at + i:flags_at + i + 1] != b'\0':
+                start = digests_at + i * width
+                hashes[name] = binascii.hexlify(self._mm[start:start + width]).decode('ascii')
+        return hashes
+
+    def __getitem__(self, key):
+        if key in self._changed:
+            return self._changed[key]
+        i = -1 if key in self._removed else self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._hashes(i)
+
+    def __contains__(self, key):
+        if key in self._changed:
+            return True
+        return key not in self._removed and self._find(key) >= 0
+
+    def __setitem__(self, key, value):
+        self._removed.discard(key)
+        self._changed[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._changed.pop(key, None)
+        self._removed.add(key)
+
+    def __iter__(self):
+        for key, _ in self._iter_items(values=False):
+            yield key
+
+    def _iter_items(self, values=True):
+        # the rows are read in order, and each table in one go, rather than
+        # each key being looked up
+        mm = self._mm
+        offsets = struct.unpack_from('<%sQ' % (self._count + 1), mm, self._offsets_at)
+        paths = mm[self._paths_at:self._paths_at + offsets[-1]]
+        columns = []
+        if values:
+            for name, width, flags_at, digests_at in self._algorithms:
+                flags = bytearray(mm[flags_at:flags_at + self._count])
+                digests = binascii.hexlify(mm[digests_at:digests_at + self._count * width]).decode('ascii')
+                columns.append((name, 2 * width, flags, digests))
+        for i in range(self._count):
+            key = paths[offsets[i]:offsets[i + 1]].decode('utf-8')
+            if key in self._removed:
+                continue
+            if not values:
+                yield key, None
+            elif key in self._changed:
+                yield key, self._changed[key]
+            else:
+                yield key, dict((name, digests[i * width:(i + 1) * width])
+                                for name, width, flags, digests in columns if flags[i])
+        for key, value in list(self._changed.items()):
+            if self._find(key) < 0:
+                yield key, value
+
+    def items(self):
+        return _IndexedItemsView(self)
+
+    def values(self):
+        return _IndexedValuesView(self)
+
+    def __len__(self):
+        removed = sum(1 for key in self._removed if self._find(key) >= 0)
+        added = sum(1 for key in self._changed if self._find(key) < 0)
+        return self._count - removed + added
+
+
+class _IndexedItemsView(ItemsView):
+
+    def __iter__(self):
+        return self._mapping._iter_items()
+
+
+class _IndexedValuesView(ValuesView):
+
+    def __iter__(self):
+        for _, value in self._mapping._iter_items():
+            yield value
+
+
+# magic, version, path separator, number of source files, of entries, of
+# manifest algorithms and of digest algorithms, and when it was written
+_INDEX_HEADER = struct.Struct('<8sH1sIQHHq')
+_INDEX_MAGIC = b'BAGIDX\r\n'
+_INDEX_VERSION = 2
+# name length, size, modification time, inode change time and SHA-256 of a
+# source file
+_INDEX_SOURCE = struct.Struct('<HQqq32s')
+# name length and digest width of an algorithm
+_INDEX_ALGORITHM = struct.Struct('<HH')
+
+# Source files changed less than this many nanoseconds before the index
+# was written may have changed again within the resolution of their
+# timestamps, so their contents are checked as well
+_INDEX_RACY_WINDOW = 2000000000
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in _read_blocks(f, HASH_BLOCK_SIZE):
+            h.update(block)
+    return h.digest()
+
+
+def _mtime_ns(st):
+    mtime = _mtime(st)
+    return mtime if isinstance(mtime, int) else int(mtime * 1000000000)
+
+
+def _ctime_ns(st):
+    ctime = _ctime(st)
+    return ctime if isinstance(ctime, int) else int(ctime * 1000000000)
+
+
+def _write_manifest_index(index_file, sources, algs, entries):
+    """
+    Writes the manifest entries of a bag to index_file: a header, the size,
+    modification and inode change times and SHA-256 of each of the (path,
+    stat result) sources they were read from, the manifest algorithms, a table of
+    offsets into the sorted UTF-8 paths, then for each digest algorithm a
+    presence flag and a fixed-width binary digest per path.
+
+    Nothing is written, and False returned, if a source has changed since
+    its stat result was taken or the digests cannot be stored in binary.
+    """
+    written_at = int(time.time() * 1000000000)
+    records = []
+    for path, st in sources:
+        digest = _file_sha256(path)
+        now = os.stat(path)
+        if _stat_signature(now) != _stat_signature(st) or _ctime_ns(now) != _ctime_ns(st):
+            LOGGER.debug("%s changed while it was read, not indexing it", path)
+            return False
+        records.append((os.path.basename(path).encode('utf-8'), st.st_size, _mtime_ns(st), _ctime_ns(st),
+                        digest))
+
+    try:
+        paths = sorted(key.encode('utf-8') for key in entries)
+        names = sorted(set(alg for hashes in entries.values() for alg in hashes))
+        columns = []
+        for name in names:
+            flags = bytearray(len(paths))
+            digests = []
+            width = None
+            for i, path in enumerate(paths):
+                hashes = entries[path.decode('utf-8')]
+                if name not in hashes:
+                    continue
+                digest = binascii.unhexlify(hashes[name])
+                if width is None:
+                    width = len(digest)
+                elif len(digest) != width:
+                    raise ValueError("digests of different widths")
+                flags[i] = 1
+                digests.append((i, digest))
+            column = bytearray(len(paths) * width)
+            for i, digest in digests:
+                column[i * width:(i + 1) * width] = digest
+            columns.append((name.encode('utf-8'), width, bytes(flags), bytes(column)))
+    except (TypeError, ValueError) as e:  # binascii.Error is a ValueError
+        LOGGER.debug("not indexing %s: %s", index_file, e)
+        return False
+
+    chunks = [_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, os.sep.encode('ascii'), len(records),
+                                 len(paths), len(algs), len(columns), written_at)]
+    for name, size, mtime, ctime, digest in records:
+        chunks.append(_INDEX_SOURCE.pack(len(name), size, mtime, ctime, digest))
+        chunks.append(name)
+    for alg in algs:
+        alg = alg.encode('utf-8')
+        chunks.append(struct.pack('<H', len(alg)))
+        chunks.append(alg)
+    for name, width, _, _ in columns:
+        chunks.append(_INDEX_ALGORITHM.pack(len(name), width))
+        chunks.append(name)
+    offset = 0
+    offsets = [0]
+    for path in paths:
+        offset += len(path)
+        offsets.append(offset)
+    chunks.append(struct.pack('<%sQ' % len(offsets), *offsets))
+    chunks.extend(paths)
+    for _, _, flags, column in columns:
+        chunks.append(flags)
+        chunks.append(column)
+
+    temp_file = "%s.%s.tmp" % (index_file, os.getpid())
+    try:
+        with open(temp_file, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        if os.name == 'nt' and os.path.exists(index_file):
+            os.remove(index_file)
+        os.rename(temp_file, index_file)
+    except (IOError, OSError):
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    LOGGER.info("wrote the manifest index %s", index_file)
+    return True
+
+
+def _read_manifest_index(index_file, sources):
+    """
+    Returns the manifest algorithms and an _IndexedEntries of the entries
+    in index_file, or None if it is missing, unreadable or out of date with
+    the given source files
+    """
+    try:
+        with open(index_file, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+
+    try:
+        (magic, version, sep, source_count, count, alg_count, column_count,
+         written_at) = _INDEX_HEADER.unpack_from(mm, 0)
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION or sep != os.sep.encode('ascii'):
+            raise ValueError("unsupported index")
+        at = _INDEX_HEADER.size
+
+        if source_count != len(sources):
+            raise ValueError("the manifests have changed")
+        for path in sources:
+            name_length, size, mtime, ctime, digest = _INDEX_SOURCE.unpack_from(mm, at)
+            at += _INDEX_SOURCE.size
+            name = mm[at:at + name_length].decode('utf-8')
+            at += name_length
+            st = os.stat(path)
+            # a file copied over a source with its modification time
+            # preserved still has a new inode change time
+            if (name != os.path.basename(path) or st.st_size != size or _mtime_ns(st) != mtime
+                    or _ctime_ns(st) != ctime):
+                raise ValueError("%s has changed" % name)
+            if max(mtime, ctime) > written_at - _INDEX_RACY_WINDOW and _file_sha256(path) != digest:
+                raise ValueError("%s has changed" % name)
+
+        algs = []
+        for _ in range(alg_count):
+            length, = struct.unpack_from('<H', mm, at)
+            algs.append(mm[at + 2:at + 2 + length].decode('utf-8'))
+            at += 2 + length
+
+        columns = []
+        for _ in range(column_count):
+            length, width = _INDEX_ALGORITHM.unpack_from(mm, at)
+            at += _INDEX_ALGORITHM.size
+            columns.append((mm[at:at + length].decode('utf-8'), width))
+            at += length
+
+        offsets_at = at
+        paths_length, = struct.unpack_from('<Q', mm, offsets_at + 8 * count)
+        paths_at = offsets_at + 8 * (count + 1)
+        at = paths_at + paths_length
+        algorithms = []
+        for name, width in columns:
+            algorithms.append((name, width, at, at + count))
+            at += count + count * width
+        if at != len(mm):
+            raise ValueError("truncated index")
+    except (IOError, OSError, ValueError, struct.error) as e:
+        LOGGER.debug("not using the manifest index %s: %s", index_file, e)
+        mm.close()
+        return None
+
+    return algs, _IndexedEntries(mm, count, offsets_at, paths_at, algorithms)
+
+
 def _load_tag_file(tag_file_name, encoding='utf-8-sig'):
     with open_text_file(tag_file_name, 'r', encoding=encoding) as tag_file:
         # Store duplicate tags as list of vals
@@ -744,68 +4012,392 @@ def _make_tag_file(bag_info_path, bag_info):
                 f.write("%s: %s\n" % (h, txt))
 
 
-def _make_manifest(manifest_file, data_dir, processes, algorithm='md5', encoding='utf-8'):
-    LOGGER.info('writing manifest with %s processes', processes)
+def _make_manifests(bag_dir, processes, algorithms=('md5',), encoding='utf-8', digest_cache=None,
+                    entries=None, dedupe=False, fadvise=False, device_processes=None, pool=None):
+    """
+    Writes manifest-<alg>.txt for each algorithm, reading every payload file
+    once, and returns the Payload-Oxum of the payload. Files with digests in
+    the digest_cache are not read again, and the digests of the others are
+    added to it as they are calculated. With dedupe, hard links to the same
+    inode are read once. fadvise applies the page cache hints of
+    _read_blocks, prefetching each file's successor, and device_processes
+    sets the number of workers for each device as for _group_by_device. If
+    a dictionary is passed as entries it is filled with the digests of each
+    file, as in Bag.entries. Files are hashed by the given pool if there is
+    one.
+    """
+    for algorithm in algorithms:
+        if _hash_factory(algorithm) is None:
+            raise RuntimeError("unknown algorithm %s" % algorithm)
+
+    settings = _hashing_settings(processes, join(bag_dir, 'data'), algorithms)
+
+    filenames = list(_walk(join(bag_dir, 'data')))
+    known = {}
+    signatures = {}
+    if digest_cache is not None:
+        for filename in filenames:
+            full_path = join(bag_dir, filename)
+            st = os.stat(full_path)
+            digests = digest_cache.lookup(full_path, st, algorithms)
+            if digests is None:
+                signatures[filename] = st
+            else:
+                known[filename] = (digests, _decode_filename(filename), st.st_size)
+        LOGGER.info("reusing the recorded digests of %s files", len(known))
+
+    to_hash = [filename for filename in filenames if filename not in known]
+    aliases = {}
+    if dedupe:
+        unique, aliases = _dedupe_entries(bag_dir, [(filename, {}) for filename in to_hash])
+        to_hash = [filename for filename, _ in unique]
+
+    groups = []
+    if device_processes is not None and pool is None:
+        groups = _group_by_device(bag_dir, to_hash, device_processes, processes, algorithms=algorithms,
+                                  path=lambda filename: filename)
+    if not groups:
+        groups = [(processes, to_hash, settings)]
+
+    pools = []
+    try:
+        streams = []
+        for group_processes, group, group_settings in groups:
+            LOGGER.info('writing manifests with %s processes', group_settings['processes'])
+            context = (bag_dir, tuple(algorithms), group_settings['block_size'], fadvise)
+
+            # each file is paired with the one to prefetch while it is hashed
+            tasks = [(filename, None) for filename in group]
+            if fadvise:
+                tasks = list(zip(group, group[1:] + [None]))
+            if pool is not None:
+                lines = pool.imap(partial(_manifest_batch, context=context),
+                                  _batches(tasks, _batch_size(len(tasks), multiprocessing.cpu_count())))
+            elif group_settings['processes'] > 1:
+                workers = group_settings['processes'] or multiprocessing.cpu_count()
+                if group_settings['executor'] == 'thread':
+                    group_pool = _make_pool(group_settings['processes'], 'thread')
+                    manifest_batch = partial(_manifest_batch, context=context)
+                else:
+                    group_pool = _make_pool(group_settings['processes'], context=context)
+                    manifest_batch = _manifest_batch
+                pools.append(group_pool)
+                lines = group_pool.imap(manifest_batch, _batches(tasks, _batch_size(len(tasks), workers)))
+            else:
+                lines = _lazy_map(partial(_manifest_batch, context=context), _batches(tasks, 1))
+            streams.append(_pair(group, (line for batch in lines for line in batch)))
+
+        if len(streams) == 1:
+            hashed = streams[0]
+        else:
+            hashed = _merge_iterators(streams)
+
+        for filename, (digests, byte_count) in hashed:
+            line = (dict(zip(algorithms, digests)), _decode_filename(filename), byte_count)
+            known[filename] = line
+            if digest_cache is not None:
+                digest_cache.record(join(bag_dir, filename), signatures[filename], line[0])
+            for alias, _ in aliases.get(filename, ()):
+                known[alias] = (line[0], _decode_filename(alias), line[2])
+    finally:
+        for group_pool in pools:
+            group_pool.terminate()
+
+    checksums = [known[filename] for filename in filenames]
+
+    num_files = 0
+    total_bytes = 0
+    for digests, filename, byte_count in checksums:
+        num_files += 1
+        total_bytes += byte_count
+        if entries is not None:
+            entries[filename] = dict(digests)
+
+    for algorithm in algorithms:
+        manifest_file = join(bag_dir, 'manifest-%s.txt' % algorithm)
+        LOGGER.info("writing %s", manifest_file)
+        with open_text_file(manifest_file, 'w', encoding=encoding) as manifest:
+            for digests, filename, _ in checksums:
+                manifest.write("%s  %s\n" % (digests[algorithm], _encode_filename(filename)))
+
+    return "%s.%s" % (total_bytes, num_files)
 
-    if algorithm == 'md5':
-        manifest_line = _manifest_line_md5
-    elif algorithm == 'sha1':
-        manifest_line = _manifest_line_sha1
-    elif algorithm == 'sha256':
-        manifest_line = _manifest_line_sha256
-    elif algorithm == 'sha512':
-        manifest_line = _manifest_line_sha512
-    else:
-        raise RuntimeError("unknown algorithm %s" % algorithm)
 
-    if processes > 1:
-        pool = multiprocessing.Pool(processes=processes)
-        checksums = pool.map(manifest_line, _walk(data_dir))
-        pool.close()
-        pool.join()
-    else:
-        checksums = [manifest_line(i) for i in _walk(data_dir)]
+def _group_by_device(base_dir, items, device_processes, processes, algorithms,
+                     path=lambda entry: entry[0]):
+    """
+    Splits items (by default (path, hashes) entries) by the device holding
+    each file, so that every device can be kept busy by its own workers.
 
-    with open_text_file(manifest_file, 'w', encoding=encoding) as manifest:
-        num_files = 0
-        total_bytes = 0
+    device_processes maps the path of a mount point, or any other path on
+    the device, to the number of processes for that device (or 'auto');
+    devices which are not listed get processes. Returns a list of
+    (processes, items, hashing settings) for each device.
+    """
+    limits = {}
+    for device_path, device_limit in device_processes.items():
+        try:
+            limits[os.stat(device_path).st_dev] = device_limit
+        except OSError as e:
+            raise BagError("Unable to find the device of %s: %s" % (device_path, e))
 
-        for digest, filename, byte_count in checksums:
-            num_files += 1
-            total_bytes += byte_count
-            manifest.write("%s  %s\n" % (digest, _encode_filename(filename)))
-    return "%s.%s" % (total_bytes, num_files)
+    groups = {}
+    order = []
+    for item in items:
+        try:
+            device = os.stat(join(base_dir, path(item))).st_dev
+        except OSError:
+            # left for the hashing to report
+            device = None
+        if device not in groups:
+            groups[device] = []
+            order.append(device)
+        groups[device].append(item)
+
+    result = []
+    for device in order:
+        group = groups[device]
+        group_processes = limits.get(device, processes)
+        settings = _hashing_settings(group_processes, os.path.dirname(join(base_dir, path(group[0]))),
+                                     algorithms)
+        LOGGER.info("hashing %s files on device %s with %s processes", len(group), device,
+                    settings['processes'])
+        result.append((group_processes, group, settings))
+    return result
+
+
+def _merge_iterators(iterators):
+    """
+    Yields the items of all of the iterators as they are produced, each
+    iterator being consumed in a thread of its own
+    """
+    results = queue.Queue()
+    stop = threading.Event()
+    finished = object()
+
+    def consume(iterator):
+        try:
+            for item in iterator:
+                if stop.is_set():
+                    break
+                results.put((item, None))
+        except Exception as e:
+            results.put((None, e))
+        finally:
+            results.put((finished, None))
+
+    threads = [threading.Thread(target=consume, args=(iterator,)) for iterator in iterators]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        remaining = len(threads)
+        while remaining:
+            item, error = results.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        stop.set()
 
 
-def _make_tagmanifest_file(alg, bag_dir, encoding='utf-8'):
-    tagmanifest_file = join(bag_dir, "tagmanifest-%s.txt" % alg)
-    LOGGER.info("writing %s", tagmanifest_file)
+def _pair(keys, values):
+    """Lazily pairs each of keys with the next of values"""
+    values = iter(values)
+    for key in keys:
+        yield key, next(values)
+
+
+def _lazy_map(function, items):
+    for item in items:
+        yield function(item)
+
+
+def _dedupe_entries(base_dir, entries):
+    """
+    Splits the (path, hashes) entries into those which need to be read and
+    a dictionary of the entries for the same inode, and with the same
+    algorithms, as each of those. Paths which cannot be stat'ed are left to
+    be reported when they are read.
+    """
+    unique = []
+    aliases = {}
+    first = {}
+    for rel_path, hashes in entries:
+        try:
+            st = os.stat(join(base_dir, rel_path))
+        except OSError:
+            unique.append((rel_path, hashes))
+            continue
+        key = (st.st_dev, st.st_ino, tuple(sorted(hashes)))
+        if key in first:
+            aliases.setdefault(first[key], []).append((rel_path, hashes))
+        else:
+            first[key] = rel_path
+            unique.append((rel_path, hashes))
+
+    if aliases:
+        LOGGER.info("%s files are links to other files and will not be read again",
+                    sum(len(i) for i in aliases.values()))
+    return unique, aliases
+
+
+def _rollup(entries, algorithm, sizes, top='data'):
+    """
+    Returns a dictionary of the (digest, byte_count, file_count) rollup of
+    top and each directory below it, from the (path, hashes) manifest
+    entries of the files below top and a dictionary of their sizes. The
+    digest of a directory is a hash of a "<digest> <name>" line for each
+    of its files and a "<digest> <name>/" line for each of its
+    subdirectories, sorted by name.
+    """
+    contents = {top: {}}
+    for path, hashes in entries.items():
+        if not path.startswith(top + os.sep) or algorithm not in hashes:
+            continue
+        directory = os.path.dirname(path)
+        contents.setdefault(directory, {})[os.path.basename(path)] = (hashes[algorithm].lower(),
+                                                                      sizes.get(path, 0), 1, False)
+        while directory != top:
+            directory = os.path.dirname(directory)
+            contents.setdefault(directory, {})
+
+    rollups = {}
+    # directories are rolled up before their parents
+    for directory in sorted(contents, key=lambda d: d.count(os.sep), reverse=True):
+        h = _hasher(algorithm)
+        byte_count = file_count = 0
+        for name in sorted(contents[directory]):
+            digest, child_bytes, child_files, is_dir = contents[directory][name]
+            h.update(("%s %s%s\n" % (digest, name, "/" if is_dir else "")).encode('utf-8'))
+            byte_count += child_bytes
+            file_count += child_files
+        rollups[directory] = (h.hexdigest(), byte_count, file_count)
+        if directory != top:
+            contents[os.path.dirname(directory)][os.path.basename(directory)] = rollups[directory] + (True,)
+    return rollups
+
+
+def _make_rollups(bag_dir, entries, algorithms, encoding='utf-8'):
+    """
+    Writes rollup-<alg>.txt for each of the algorithms from the payload
+    entries, as described for Bag.save_rollups(), and returns the names of
+    the files written
+    """
+    if not algorithms:
+        return []
+    sizes = dict((path, os.stat(join(bag_dir, path)).st_size) for path in entries)
+    written = []
+    for algorithm in algorithms:
+        rollups = _rollup(entries, algorithm, sizes)
+        rollup_file = "rollup-%s.txt" % algorithm
+        LOGGER.info("writing %s", join(bag_dir, rollup_file))
+        with open_text_file(join(bag_dir, rollup_file), 'w', encoding=encoding) as f:
+            for directory in sorted(rollups):
+                digest, byte_count, file_count = rollups[directory]
+                f.write("%s %s.%s %s\n" % (digest, byte_count, file_count,
+                                           _encode_filename(directory.replace(os.sep, '/'))))
+        written.append(rollup_file)
+    return written
+
+
+def _load_rollup(rollup_file, encoding):
+    """Reads a rollup-<alg>.txt file written by _make_rollups"""
+    rollups = {}
+    with open_text_file(rollup_file, 'r', encoding=encoding) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            parts = line.split(" ", 2)
+            oxum = parts[1].split(".", 1) if len(parts) == 3 else []
+            if len(oxum) != 2 or not oxum[0].isdigit() or not oxum[1].isdigit():
+                raise BagError("Invalid rollup entry in %s: %s" % (rollup_file, line))
+            path = os.path.normpath(_decode_filename(parts[2]))
+            rollups[path] = (parts[0].lower(), int(oxum[0]), int(oxum[1]))
+    return rollups
+
+
+def _make_tagmanifests(bag_dir, algorithms, encoding='utf-8', entries=None, changed=()):
+    """
+    Writes tagmanifest-<alg>.txt for each algorithm, reading every tag file
+    once, and returns a dictionary of the digests of each tag file.
+
+    The digests in entries (as in Bag.entries) are reused for tag files
+    which are not named in changed and have neither been modified nor
+    replaced since the existing tagmanifests were written: the inode change
+    time is compared too, as copying a file over a tag file may preserve
+    its modification time.
+    """
+    algorithms = sorted(set(algorithms))
+
+    # tag files last changed before every existing tagmanifest was written
+    # are covered by them
+    written = None
+    try:
+        written = min(_mtime(os.stat(join(bag_dir, "tagmanifest-%s.txt" % alg))) for alg in algorithms)
+    except OSError:
+        pass
 
     checksums = []
     for f in _find_tag_files(bag_dir):
         if re.match(r'^tagmanifest-.+\.txt$', f):
             continue
-        with open(join(bag_dir, f), 'rb') as fh:
-            m = _hasher(alg)
-            while True:
-                block = fh.read(16384)
-                if not block:
-                    break
-                m.update(block)
-            checksums.append((m.hexdigest(), f))
+        full_path = join(bag_dir, f)
+        known = (entries or {}).get(f)
+        if (known is not None and written is not None and f not in changed
+                and all(alg in known for alg in algorithms)
+                and _changed_at(os.stat(full_path)) < written):
+            digests = dict((alg, known[alg]) for alg in algorithms)
+        else:
+            LOGGER.debug("hashing tag file %s", full_path)
+            f_hashers = dict((alg, _hasher(alg)) for alg in algorithms)
+            digests = _calculate_file_hashes(full_path, f_hashers)
+        checksums.append((f, digests))
+
+    for alg in algorithms:
+        tagmanifest_file = join(bag_dir, "tagmanifest-%s.txt" % alg)
+        LOGGER.info("writing %s", tagmanifest_file)
+        with open_text_file(tagmanifest_file, mode='w', encoding=encoding) as tagmanifest:
+            for filename, digests in checksums:
+                tagmanifest.write('%s %s\n' % (digests[alg], filename))
+
+    return dict(checksums)
+
 
-    with open_text_file(join(bag_dir, tagmanifest_file),
-                        mode='w', encoding=encoding) as tagmanifest:
-        for digest, filename in checksums:
-            tagmanifest.write('%s %s\n' % (digest, filename))
+def _mtime(st):
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = st.st_mtime
+    return mtime
+
+
+def _ctime(st):
+    ctime = getattr(st, 'st_ctime_ns', None)
+    if ctime is None:
+        ctime = st.st_ctime
+    return ctime
+
+
+def _changed_at(st):
+    # the modification time can be set back (e.g. by cp -p) but the inode
+    # change time can't
+    return max(_mtime(st), _ctime(st))
 
 
 def _find_tag_files(bag_dir):
     for dir in os.listdir(bag_dir):
-        if dir != 'data':
-            if os.path.isfile(dir) and not dir.startswith('tagmanifest-'):
-                yield dir
-            for dir_name, _, filenames in os.walk(dir):
+        if dir not in ('data', MANIFEST_INDEX):
+            full_path = join(bag_dir, dir)
+            if os.path.isfile(full_path):
+                if not dir.startswith('tagmanifest-'):
+                    yield dir
+                continue
+            for dir_name, _, filenames in _walk_tree(full_path):
                 for filename in filenames:
                     if filename.startswith('tagmanifest-'):
                         continue
@@ -814,14 +4406,185 @@ def _find_tag_files(bag_dir):
                     yield os.path.relpath(p, bag_dir)
 
 
+def _walk_tree(top, threads=None):
+    """
+    A drop-in replacement for os.walk(top) which lists directories in a
+    pool of threads, since on network filesystems each listing is a round
+    trip. As with os.walk, directories are yielded top-down, unreadable
+    directories are skipped and symlinked directories are reported but not
+    descended into; dirnames may be pruned in place. Unlike os.walk the
+    names in each directory are sorted, so the order is deterministic.
+
+    The subdirectories of each directory are listed in parallel as soon as
+    it has been yielded, while the caller works through the tree, by a pool
+    of threads shared by every walk in the process. With a single thread
+    the directories are listed in the calling thread as they are reached.
+    """
+    if threads is None:
+        threads = WALK_THREADS
+    if threads > 1:
+        pool = _walk_pool(threads)
+
+        def list_dir(path):
+            return pool.apply_async(_list_dir, (path,)).get
+    else:
+        def list_dir(path):
+            return partial(_list_dir, path)
+
+    stack = [(top, list_dir(top))]
+    while stack:
+        path, listing = stack.pop()
+        listing = listing()
+        if listing is None:
+            continue
+        dirnames, filenames, links = listing
+        yield path, dirnames, filenames
+        children = [(join(path, d), list_dir(join(path, d))) for d in dirnames if d not in links]
+        stack.extend(reversed(children))
+
+
+def _walk_pool(threads):
+    """Returns the thread pool of the given size used by _walk_tree()"""
+    # a pool inherited from the parent of a forked process has no threads
+    key = (os.getpid(), threads)
+    with _WALK_POOLS_LOCK:
+        pool = _WALK_POOLS.get(key)
+        if pool is None:
+            pool = _WALK_POOLS[key] = multiprocessing.pool.ThreadPool(threads)
+    return pool
+
+
+def _list_dir(path):
+    """
+    Returns the sorted names of the directories and other files in path and
+    the set of directory names which are symlinks, or None if path cannot
+    be listed
+    """
+    dirnames = []
+    filenames = []
+    links = set()
+    try:
+        if hasattr(os, 'scandir'):
+            # the file types usually come with the listing, saving a stat
+            # of every entry
+            for entry in os.scandir(path):
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirnames.append(entry.name)
+                    if entry.is_symlink():
+                        links.add(entry.name)
+                else:
+                    filenames.append(entry.name)
+        else:
+            for name in os.listdir(path):
+                full_path = join(path, name)
+                if os.path.isdir(full_path):
+                    dirnames.append(name)
+                    if os.path.islink(full_path):
+                        links.add(name)
+                else:
+                    filenames.append(name)
+    except OSError:
+        return None
+    dirnames.sort()
+    filenames.sort()
+    return dirnames, filenames, links
+
+
+class _PathFilter(object):
+    """
+    Selects the paths in a bag matching any of the include patterns (or any
+    path if there are none) and none of the exclude patterns. A pattern
+    matches a path if fnmatch matches it against the path or the path of
+    any directory containing it, so a plain path prefix selects everything
+    below it. Patterns are relative to the bag, and data/ is added to
+    those which do not start with it, as for Bag.validate_subtree().
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = [self._pattern(p) for p in include or ()]
+        self.exclude = [self._pattern(p) for p in exclude or ()]
+
+    def __str__(self):
+        parts = []
+        if self.include:
+            parts.append("include=%s" % ",".join(self.include))
+        if self.exclude:
+            parts.append("exclude=%s" % ",".join(self.exclude))
+        return " ".join(parts)
+
+    @staticmethod
+    def _pattern(pattern):
+        pattern = pattern.replace(os.sep, '/').rstrip('/')
+        if pattern != 'data' and not pattern.startswith('data/'):
+            pattern = 'data/' + pattern.lstrip('/')
+        return pattern
+
+    def unmatched(self, paths):
+        """Returns the include patterns which match none of paths"""
+        unmatched = list(self.include)
+        for path in paths:
+            if not unmatched:
+                break
+            unmatched = [pattern for pattern in unmatched if not self._matches(path, [pattern])]
+        return unmatched
+
+    def __call__(self, path):
+        if self.include and not self._matches(path, self.include):
+            return False
+        return not self.excludes(path)
+
+    def excludes(self, path):
+        """Whether path, and anything below it, is excluded"""
+        return bool(self.exclude) and self._matches(path, self.exclude)
+
+    def _matches(self, path, patterns):
+        parts = path.replace(os.sep, '/').split('/')
+        for i in range(1, len(parts) + 1):
+            prefix = '/'.join(parts[:i])
+            for pattern in patterns:
+                if fnmatch.fnmatchcase(prefix, pattern):
+                    return True
+        return False
+
+    def roots(self):
+        """
+        Returns the topmost paths in the payload directory below which
+        matching files can be found: the literal part of each of the
+        include patterns
+        """
+        if not self.include:
+            return ['data']
+        roots = set()
+        for pattern in self.include:
+            literal = []
+            for part in pattern.split('/'):
+                if any(c in part for c in '*?['):
+                    break
+                literal.append(part)
+            roots.add(os.sep.join(literal))
+        result = []
+        for root in sorted(roots):
+            if not any(root.startswith(r + os.sep) for r in result):
+                result.append(root)
+        return result
+
+
 def _walk(data_dir):
-    for dirpath, dirnames, filenames in os.walk(data_dir):
-        # if we don't sort here the order of entries is non-deterministic
-        # which makes it hard to test the fixity of tagmanifest-md5.txt
-        filenames.sort()
-        dirnames.sort()
+    """
+    Yields the path of every file below data_dir, relative to the directory
+    containing data_dir (i.e. data/dir/file for a bag's payload directory)
+    """
+    base_dir = os.path.dirname(data_dir)
+    # _walk_tree sorts the entries of each directory, since otherwise the
+    # order would be non-deterministic which makes it hard to test the
+    # fixity of tagmanifest-md5.txt
+    for dirpath, dirnames, filenames in _walk_tree(data_dir):
         for fn in filenames:
-            path = os.path.join(dirpath, fn)
+            path = os.path.relpath(os.path.join(dirpath, fn), base_dir)
             # BagIt spec requires manifest to always use '/' as path separator
             if os.path.sep != '/':
                 parts = path.split(os.path.sep)
@@ -845,7 +4608,7 @@ def _can_read(test_dir):
     """
     unreadable_dirs = []
     unreadable_files = []
-    for dirpath, dirnames, filenames in os.walk(test_dir):
+    for dirpath, dirnames, filenames in _walk_tree(test_dir):
         for dn in dirnames:
             if not os.access(os.path.join(dirpath, dn), os.R_OK):
                 unreadable_dirs.append(os.path.join(dirpath, dn))
@@ -855,48 +4618,149 @@ def _can_read(test_dir):
     return (tuple(unreadable_dirs), tuple(unreadable_files))
 
 
-def _manifest_line_md5(filename):
-    return _manifest_line(filename, 'md5')
-
-
-def _manifest_line_sha1(filename):
-    return _manifest_line(filename, 'sha1')
+def _hash_factory(algorithm):
+    """
+    Returns the fastest available implementation of algorithm from the
+    registry, falling back to hashlib.new() for unregistered names, or None
+    if the algorithm cannot be used on this system.
+    """
+    try:
+        return _SELECTED_HASH_FACTORIES[algorithm]
+    except KeyError:
+        pass
 
+    candidates = []
+    for factory in HASH_ALGORITHMS.get(algorithm, []):
+        try:
+            factory()
+        except (ImportError, ValueError):
+            continue
+        candidates.append(factory)
 
-def _manifest_line_sha256(filename):
-    return _manifest_line(filename, 'sha256')
+    if not candidates and algorithm not in HASH_ALGORITHMS:
+        try:
+            hashlib.new(algorithm)
+            candidates.append(partial(hashlib.new, algorithm))
+        except ValueError:
+            pass
+
+    if len(candidates) > 1:
+        candidates = [_fastest_hash_factory(algorithm, candidates)]
+
+    selected = _SELECTED_HASH_FACTORIES[algorithm] = candidates[0] if candidates else None
+    return selected
+
+
+def _fastest_hash_factory(algorithm, candidates):
+    sample = b'\x5a' * 262144
+    expected = None
+    timings = []
+    for factory in candidates:
+        h = factory()
+        start = time.time()
+        for _ in range(4):
+            h.update(sample)
+        elapsed = time.time() - start
+        digest = h.hexdigest()
+        if expected is None:
+            expected = digest
+        elif digest != expected:
+            LOGGER.warning("Ignoring %s implementation %r which disagrees with %r", algorithm, factory, candidates[0])
+            continue
+        timings.append((elapsed, len(timings), factory))
+    LOGGER.debug("%s implementation timings: %s", algorithm, timings)
+    return min(timings)[2]
 
 
-def _manifest_line_sha512(filename):
-    return _manifest_line(filename, 'sha512')
+def _hasher(algorithm='md5'):
+    factory = _hash_factory(algorithm)
+    if factory is None:
+        raise ValueError("unsupported hash algorithm %s" % algorithm)
+    return factory()
 
 
-def _hasher(algorithm='md5'):
-    if algorithm == 'md5':
-        m = hashlib.md5()
-    elif algorithm == 'sha1':
-        m = hashlib.sha1()
-    elif algorithm == 'sha256':
-        m = hashlib.sha256()
-    elif algorithm == 'sha512':
-        m = hashlib.sha512()
-    return m
-
-
-def _manifest_line(filename, algorithm='md5'):
+def _manifest_line(base_dir, filename, algorithms=('md5',), block_size=HASH_BLOCK_SIZE, fadvise=False):
     LOGGER.info("Generating checksum for file %s", filename)
-    with open(filename, 'rb') as fh:
-        m = _hasher(algorithm)
+    # unbuffered, so that a file smaller than a block is read by a single
+    # system call
+    with open(join(base_dir, filename), 'rb', 0) as fh:
+        hashers = [(alg, _hasher(alg)) for alg in algorithms]
 
         total_bytes = 0
-        while True:
-            block = fh.read(16384)
+        for block in _read_blocks(fh, block_size, fadvise, size=os.fstat(fh.fileno()).st_size):
             total_bytes += len(block)
+            for _, m in hashers:
+                m.update(block)
+
+    digests = dict((alg, m.hexdigest()) for alg, m in hashers)
+    return (digests, _decode_filename(filename), total_bytes)
+
+
+def _manifest_batch(batch, context=None):
+    """
+    Calls _manifest_line for each (filename, next filename) pair in a batch
+    from _make_manifests, returning a (digests, byte_count) tuple for each
+    with the hex digests in the order of the algorithms. The (base_dir,
+    algorithms, block_size, fadvise) context is set once for each worker
+    process by _worker_initializer rather than being sent with every batch.
+    """
+    base_dir, algorithms, block_size, fadvise = context or _worker_context
+    results = []
+    for filename, prefetch in batch:
+        if prefetch is not None:
+            _prefetch(join(base_dir, prefetch))
+        digests, _, byte_count = _manifest_line(base_dir, filename, algorithms=algorithms, block_size=block_size,
+                                                fadvise=fadvise)
+        results.append((tuple(digests[alg] for alg in algorithms), byte_count))
+    return results
+
+
+def _read_blocks(f, block_size, fadvise=False, size=None):
+    """
+    Yields the contents of the open file f in blocks. If the size of the
+    file is given and it is smaller than a block it is read with a single
+    call, rather than another being needed to find the end of the file.
+    With fadvise the kernel is told that the file will be read
+    sequentially, and its pages are dropped from the page cache once it has
+    been read so that hashing does not evict the working set of other
+    programs.
+    """
+    if fadvise:
+        _fadvise(f, 'POSIX_FADV_SEQUENTIAL')
+    try:
+        if size is not None and size < block_size:
+            block = f.read(size + 1)
+            if block:
+                yield block
+            # otherwise the file has changed size and is read as usual
+            if len(block) == size:
+                return
+        while True:
+            block = f.read(block_size)
             if not block:
                 break
-            m.update(block)
+            yield block
+    finally:
+        if fadvise:
+            _fadvise(f, 'POSIX_FADV_DONTNEED')
+
 
-    return (m.hexdigest(), _decode_filename(filename), total_bytes)
+def _prefetch(full_path):
+    """Asks the kernel to start reading a file into the page cache"""
+    try:
+        with open(full_path, 'rb') as f:
+            _fadvise(f, 'POSIX_FADV_WILLNEED')
+    except (IOError, OSError):
+        pass
+
+
+def _fadvise(f, advice):
+    # posix_fadvise is only available on some platforms from Python 3.3
+    if hasattr(os, 'posix_fadvise') and hasattr(os, advice):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, getattr(os, advice))
+        except (OSError, ValueError):
+            pass
 
 
 def _encode_filename(s):
@@ -933,6 +4797,25 @@ class BagArgumentParser(argparse.ArgumentParser):
         argparse.ArgumentParser.__init__(self, *args, **kwargs)
 
 
+def _processes(value):
+    if value == 'auto':
+        return value
+    try:
+        processes = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r is not a number or 'auto'" % value)
+    if processes < 0:
+        raise argparse.ArgumentTypeError("number of processes needs to be 0 or more")
+    return processes
+
+
+def _device_processes(value):
+    path, sep, processes = value.rpartition('=')
+    if not sep or not path:
+        raise argparse.ArgumentTypeError("%r is not of the form PATH=N" % value)
+    return path, _processes(processes)
+
+
 class BagHeaderAction(argparse.Action):
     def __call__(self, parser, _, values, option_string=None):
         opt = option_string.lstrip('--')
@@ -942,23 +4825,96 @@ class BagHeaderAction(argparse.Action):
 
 def _make_parser():
     parser = BagArgumentParser(description='bagit-python version %s' % VERSION)
-    parser.add_argument('--processes', type=int, dest='processes', default=1,
-                        help='parallelize checksums generation and verification')
+    parser.add_argument('--processes', type=_processes, dest='processes', default=1,
+                        help='parallelize checksums generation and verification; '
+                             '"auto" uses the settings recorded by --tune')
+    parser.add_argument('--device-processes', type=_device_processes, action='append', metavar='PATH=N',
+                        help='use N processes (or auto) for the files on the device holding PATH, '
+                             'such as a mount point; may be repeated for each device')
     parser.add_argument('--log', help='The name of the log file')
     parser.add_argument('--quiet', action='store_true')
     parser.add_argument('--validate', action='store_true')
     parser.add_argument('--fast', action='store_true')
+    parser.add_argument('--sample', type=float,
+                        help='only hash enough randomly chosen payload files to cover this '
+                             'fraction of the payload bytes when validating')
+    parser.add_argument('--sample-bytes', type=int,
+                        help='only hash this many bytes of payload files when validating')
+    parser.add_argument('--include', action='append', metavar='PATTERN',
+                        help='only validate the payload files matching this path prefix or glob, '
+                             'such as data/scans/2019; may be repeated')
+    parser.add_argument('--exclude', action='append', metavar='PATTERN',
+                        help='do not validate the payload files matching this path prefix or glob; '
+                             'may be repeated')
+    parser.add_argument('--cursor',
+                        help='validate files in turn, recording the position reached in this file '
+                             'so the next run can carry on from there')
+    parser.add_argument('--max-bytes-per-second', type=int,
+                        help='limit the combined rate at which files are read when validating')
+    parser.add_argument('--max-seconds', type=float,
+                        help='stop hashing after this many seconds when validating, which requires '
+                             '--cursor or --journal to keep the progress made')
+    parser.add_argument('--journal',
+                        help='record the digests of files in this file as they are calculated, '
+                             'so an interrupted run can be resumed by repeating it')
+    parser.add_argument('--digest-store',
+                        help='reuse and record the digests of files in this database, '
+                             'which may be shared by many bags')
+    parser.add_argument('--digest-store-max-age', type=float,
+                        help='only reuse digests from --digest-store calculated within this many seconds')
+    parser.add_argument('--fadvise', action='store_true',
+                        help='read files sequentially, prefetch the next one and drop them from '
+                             'the page cache afterwards, to spare the cache of other programs')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='only read files which are hard links to the same inode once')
+    parser.add_argument('--rollup', action='store_true',
+                        help='also record the digest, byte count and file count of every payload '
+                             'directory when creating a bag, for --subtree')
+    parser.add_argument('--subtree', metavar='PATH',
+                        help='only validate the payload below PATH, using the digests recorded by --rollup')
+    parser.add_argument('--queue', metavar='DIR',
+                        help='validate by handing shards of the bag to --shard-worker processes '
+                             'through this directory, which they must share')
+    parser.add_argument('--shards', type=int, default=8,
+                        help='the number of shards of roughly equal bytes to split a bag into with --queue')
+    parser.add_argument('--local-workers', type=int, default=0,
+                        help='the number of shard workers to start on this host with --queue')
+    parser.add_argument('--shard-worker', action='store_true',
+                        help='hash the shards queued in the directory given, until interrupted')
+    parser.add_argument('--daemon', action='store_true',
+                        help='serve validate and create jobs over HTTP on the address given, '
+                             'host:port or the path of a Unix socket, with metrics at /metrics')
+    parser.add_argument('--root', action='append', metavar='DIR',
+                        help='with --daemon, only accept jobs for paths below this directory; '
+                             'may be repeated')
+    parser.add_argument('--catalog', metavar='DB',
+                        help='index the metadata and manifests of the bags at or below each directory '
+                             'in this SQLite database, skipping those unchanged since they were indexed')
+    parser.add_argument('--json', metavar='FILE',
+                        help='when validating, append a JSON Lines record for each file checked and '
+                             'a summary to FILE, or - for standard output')
+    parser.add_argument('--diff', action='store_true',
+                        help='list the payload files added, removed, modified or renamed '
+                             'between the two bags given')
+    parser.add_argument('--watch', action='store_true',
+                        help='check the bag, then keep re-checking the files which change '
+                             'and report whenever its validity changes (Linux only)')
+    parser.add_argument('--index', action='store_true',
+                        help='when validating, load the manifests from a binary index kept in the bag '
+                             'directory, writing it first if it is missing or out of date')
+    parser.add_argument('--tune', action='store_true',
+                        help='benchmark the filesystem of each directory and record '
+                             'the best hashing settings for --processes auto')
 
     # optionally specify which checksum algorithm(s) to use when creating a bag
-    # NOTE: could generate from checksum_algos ?
-    parser.add_argument('--md5', action='append_const', dest='checksum', const='md5',
-                        help='Generate MD5 manifest when creating a bag (default)')
-    parser.add_argument('--sha1', action='append_const', dest='checksum', const='sha1',
-                        help='Generate SHA1 manifest when creating a bag')
-    parser.add_argument('--sha256', action='append_const', dest='checksum', const='sha256',
-                        help='Generate SHA-256 manifest when creating a bag')
-    parser.add_argument('--sha512', action='append_const', dest='checksum', const='sha512',
-                        help='Generate SHA-512 manifest when creating a bag')
+    for alg in CHECKSUM_ALGOS:
+        if _hash_factory(alg) is None:
+            continue
+        help_text = 'Generate %s manifest when creating a bag' % alg.upper()
+        if alg == 'md5':
+            help_text += ' (default)'
+        parser.add_argument('--%s' % alg, action='append_const', dest='checksum', const=alg,
+                            help=help_text)
 
     for header in STANDARD_BAG_INFO_HEADERS:
         parser.add_argument('--%s' % header.lower(), type=str, action=BagHeaderAction)
@@ -968,6 +4924,14 @@ def _make_parser():
     return parser
 
 
+def _daemon_address(value):
+    """Parses a host:port address for --daemon, or else a Unix socket path"""
+    host, _, port = value.rpartition(':')
+    if host and port.isdigit() and os.sep not in value:
+        return host, int(port)
+    return value
+
+
 def _configure_logging(opts):
     log_format = "%(asctime)s - %(levelname)s - %(message)s"
     if opts.quiet:
@@ -988,24 +4952,154 @@ def main():
     parser = _make_parser()
     args = parser.parse_args()
 
-    if args.processes < 0:
-        parser.error("number of processes needs to be 0 or more")
-
     _configure_logging(args)
 
+    if args.max_seconds is not None and not (args.cursor or args.journal):
+        parser.error("--max-seconds requires --cursor or --journal")
+
+    # compare two bags
+    if args.diff:
+        if len(args.directory) != 2:
+            parser.error("--diff requires exactly two bag directories")
+        try:
+            for change in diff_bags(*args.directory):
+                if change.status == PayloadChange.RENAMED:
+                    print("%s %s -> %s" % (change.status, change.old_path, change.path))
+                else:
+                    print("%s %s" % (change.status, change.path))
+        except BagError as e:
+            LOGGER.error("Unable to compare %s: %s", ' and '.join(args.directory), e)
+            sys.exit(1)
+        sys.exit(0)
+
+    # follow the validity of a bag as it is edited
+    if args.watch:
+        if len(args.directory) != 1:
+            parser.error("--watch requires exactly one bag directory")
+        valid = False
+        try:
+            with BagWatcher(args.directory[0], processes=args.processes) as watcher:
+                valid = watcher.is_valid
+                LOGGER.info("%s is %s", args.directory[0], "valid" if valid else "invalid")
+                for result in watcher.watch():
+                    LOGGER.info("%s: %s", result.path, result.status)
+                    if watcher.is_valid != valid:
+                        valid = watcher.is_valid
+                        LOGGER.info("%s is %s", args.directory[0], "valid" if valid else "invalid")
+        except BagError as e:
+            LOGGER.error("Unable to watch %s: %s", args.directory[0], e)
+            sys.exit(1)
+        except KeyboardInterrupt:
+            sys.exit(0 if valid else 1)
+
+    # serve jobs until interrupted
+    if args.daemon:
+        if len(args.directory) != 1:
+            parser.error("--daemon requires exactly one address")
+        if not args.root:
+            parser.error("--daemon requires at least one --root")
+        try:
+            daemon = ValidationDaemon(_daemon_address(args.directory[0]), args.root, processes=args.processes,
+                                      max_bytes_per_second=args.max_bytes_per_second)
+        except (OSError, socket.error, ValueError) as e:
+            LOGGER.error("Unable to serve on %s: %s", args.directory[0], e)
+            sys.exit(1)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            daemon.close()
+            sys.exit(0)
+
+    # serve the shards queued by --queue
+    if args.shard_worker:
+        if len(args.directory) != 1:
+            parser.error("--shard-worker requires exactly one queue directory")
+        try:
+            run_shard_worker(DirectoryQueueTransport(args.directory[0]), processes=args.processes)
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    # index bags for BagCatalog queries
+    if args.catalog:
+        try:
+            with BagCatalog(args.catalog) as catalog:
+                for top in args.directory:
+                    LOGGER.info("%s: %s bags indexed", top, catalog.update_all(top))
+        except sqlite3.Error as e:
+            LOGGER.error("Unable to update %s: %s", args.catalog, e)
+            sys.exit(1)
+        sys.exit(0)
+
+    device_processes = None
+    if args.device_processes:
+        device_processes = dict(args.device_processes)
+        for device_path in device_processes:
+            if not os.path.exists(device_path):
+                parser.error("--device-processes: %s does not exist" % device_path)
+
+    digest_store = None
+    if args.digest_store:
+        digest_store = DigestStore(args.digest_store, max_age=args.digest_store_max_age)
+
+    json_output = None
+    if args.json == '-':
+        json_output = sys.stdout
+    elif args.json:
+        json_output = open_text_file(args.json, 'a', encoding='utf-8')
+
     rc = 0
     for bag_dir in args.directory:
 
+        # calibrate the hashing settings for the directory's filesystem
+        if args.tune:
+            try:
+                algorithms = args.checksum
+                if not algorithms and isfile(join(bag_dir, 'bagit.txt')):
+                    algorithms = Bag(bag_dir).algs
+                settings = tune(bag_dir, algorithms, persist=True)
+                LOGGER.info("%s: use %s %s workers reading %s byte blocks", bag_dir,
+                            settings['processes'], settings['executor'], settings['block_size'])
+            except (BagError, OSError, IOError) as e:
+                LOGGER.error("Unable to tune %s: %s", bag_dir, e)
+                rc = 1
+
         # validate the bag
-        if args.validate:
+        elif args.validate:
             try:
-                bag = Bag(bag_dir)
-                # validate throws a BagError or BagValidationError
-                bag.validate(processes=args.processes, fast=args.fast)
-                if args.fast:
+                bag = Bag(bag_dir, index=args.index)
+                options = dict(processes=args.processes, fast=args.fast, sample=args.sample,
+                               sample_bytes=args.sample_bytes, cursor=args.cursor,
+                               max_bytes_per_second=args.max_bytes_per_second,
+                               max_seconds=args.max_seconds, journal=args.journal,
+                               dedupe=args.dedupe, digest_store=digest_store,
+                               fadvise=args.fadvise, device_processes=device_processes,
+                               include=args.include, exclude=args.exclude)
+                if args.subtree:
+                    bag.validate_subtree(args.subtree, processes=args.processes, fast=args.fast)
+                elif args.queue:
+                    bag.validate_sharded(DirectoryQueueTransport(args.queue), shards=args.shards,
+                                         local_workers=args.local_workers, processes=args.processes)
+                elif json_output is not None:
+                    summary = write_json_lines(bag.iter_validate(**options), json_output, bag=bag,
+                                               include=args.include, exclude=args.exclude)
+                    if not summary['valid']:
+                        raise BagValidationError("invalid bag")
+                else:
+                    # validate throws a BagError or BagValidationError
+                    bag.validate(**options)
+                if args.subtree:
+                    LOGGER.info("%s is valid below %s", bag_dir, args.subtree)
+                elif args.fast:
                     LOGGER.info("%s valid according to Payload-Oxum", bag_dir)
+                elif args.include or args.exclude:
+                    LOGGER.info("%s is valid for the payload files matching %s (partial validation)", bag_dir,
+                                _PathFilter(args.include, args.exclude))
+                elif args.sample is not None or args.sample_bytes is not None or args.max_seconds is not None:
+                    LOGGER.info("%s is valid according to the files checked", bag_dir)
                 else:
                     LOGGER.info("%s is valid", bag_dir)
+            except BagValidationIncomplete as e:
+                LOGGER.warning("%s: no problems found, but %s", bag_dir, e)
             except BagError as e:
                 LOGGER.error("%s is invalid: %s", bag_dir, e)
                 rc = 1
@@ -1015,12 +5109,20 @@ def main():
             try:
                 make_bag(bag_dir, bag_info=parser.bag_info,
                          processes=args.processes,
-                         checksum=args.checksum)
+                         checksum=args.checksum, journal=args.journal,
+                         dedupe=args.dedupe, digest_store=digest_store,
+                         fadvise=args.fadvise, device_processes=device_processes,
+                         rollup=args.rollup)
             except Exception as exc:
                 LOGGER.error("Failed to create bag in %s: %s", bag_dir, exc, exc_info=True)
                 rc = 1
 
-        sys.exit(rc)
+    if digest_store is not None:
+        digest_store.close()
+    if json_output not in (None, sys.stdout):
+        json_output.close()
+
+    sys.exit(rc)
 
 
 if __name__ == '__main__':
@@ -6,12 +6,18 @@ from __future__ import (absolute_import, division, print_function,
 import codecs
 import datetime
 import hashlib
+import io
+import json
 import logging
+import multiprocessing
 import os
 import shutil
+import socket
 import stat
 import sys
 import tempfile
+import threading
+import time
 import unittest
 from os.path import join as j
 
@@ -51,6 +57,9 @@ class TestSingleProcessValidation(unittest.TestCase):
     def validate(self, bag, *args, **kwargs):
         return bag.validate(*args, **kwargs)
 
+    def iter_validate(self, bag, *args, **kwargs):
+        return bag.iter_validate(*args, **kwargs)
+
     def test_make_bag_sha1_sha256_manifest(self):
         bag = bagit.make_bag(self.tmpdir, checksum=['sha1', 'sha256'])
         # check that relevant manifests are created
@@ -170,6 +179,217 @@ class TestSingleProcessValidation(unittest.TestCase):
         if not got_exception:
             self.fail("didn't get BagValidationError")
 
+    def test_iter_validate(self):
+        bag = bagit.make_bag(self.tmpdir)
+        with open(j(self.tmpdir, "data", "README"), "w") as r:
+            r.write("changed")
+        with open(j(self.tmpdir, "data", "extra"), "w") as ef:
+            ef.write('foo')
+        os.remove(j(self.tmpdir, "data", "loc", "3314493806_6f1db86d66_o_d.jpg"))
+        # remove the bag-info.txt which contains the oxum to force a full
+        # check of the manifest
+        os.remove(j(self.tmpdir, "bag-info.txt"))
+        bag = bagit.Bag(self.tmpdir)
+
+        results = {}
+        for result in self.iter_validate(bag):
+            results.setdefault(result.path, []).append(result)
+        self.assertEqual(results['data/extra'][0].status, bagit.FileValidationResult.UNEXPECTED)
+        self.assertEqual(results['data/README'][0].status, bagit.FileValidationResult.MISMATCH)
+        self.assertEqual(results['data/README'][0].expected['md5'], '8e2af7a0143c7b8f4de0b3fc90f27354')
+        self.assertTrue(isinstance(results['data/README'][0].errors[0], bagit.ChecksumMismatch))
+        self.assertTrue(results['data/si/2584174182_ffd5c24905_b_d.jpg'][0].ok)
+        missing = results['data/loc/3314493806_6f1db86d66_o_d.jpg']
+        self.assertEqual(missing[0].status, bagit.FileValidationResult.MISSING)
+
+    def test_iter_validate_is_lazy(self):
+        bag = bagit.make_bag(self.tmpdir)
+        results = self.iter_validate(bag)
+        first = next(results)
+        self.assertTrue(first.ok)
+        results.close()
+
+    def test_validate_sample(self):
+        bag = bagit.make_bag(self.tmpdir)
+        bag = bagit.Bag(self.tmpdir)
+        readme = j(self.tmpdir, "data", "README")
+        txt = slurp_text_file(readme)
+        with open(readme, "w") as r:
+            r.write('A' + txt[1:])
+
+        # files are picked in proportion to their size so with a fixed
+        # random number a small sample takes the largest image
+        with mock.patch('bagit.random.random', return_value=0.5):
+            sampled = bag.sample_entries(sample_bytes=1)
+            self.assertEqual(sampled, ['data/si/2584174182_ffd5c24905_b_d.jpg'])
+            self.assertTrue(self.validate(bag, sample_bytes=1))
+
+        # a sample covering every byte catches it
+        self.assertRaises(bagit.BagValidationError, self.validate, bag, sample=1.0)
+
+        # as does the full completeness check, whatever the sample
+        os.remove(j(self.tmpdir, "data", "loc", "2478433644_2839c5e8b8_o_d.jpg"))
+        self.assertRaises(bagit.BagValidationError, self.validate, bag, sample_bytes=1)
+
+    def test_validate_sample_cursor(self):
+        bag = bagit.make_bag(self.tmpdir)
+        cursor = j(self.tmpdir, "cursor.json")
+        covered = []
+        for i in range(5):
+            checked = [r.path for r in self.iter_validate(bag, sample_bytes=1, cursor=cursor)
+                       if r.path.startswith('data/')]
+            self.assertEqual(len(checked), 1)
+            covered.extend(checked)
+        self.assertEqual(sorted(covered), sorted(bag.payload_entries()))
+        # the cursor wraps around to the beginning
+        self.assertEqual(bag.sample_entries(sample_bytes=1, cursor_file=cursor), [sorted(covered)[0]])
+
+    def test_validate_max_bytes_per_second(self):
+        bag = bagit.make_bag(self.tmpdir)
+        start = time.time()
+        self.assertTrue(self.validate(bag, max_bytes_per_second=5000000))
+        # the last file may start reading as soon as the others have used
+        # their share of the bandwidth
+        self.assertTrue(time.time() - start >= (991765 - 381813) / 5000000.0)
+
+    def test_validate_max_seconds_resumes(self):
+        bag = bagit.make_bag(self.tmpdir)
+        cursor = j(self.tmpdir, "cursor.json")
+        covered = []
+        for i in range(5):
+            results = []
+            with self.assertRaises(bagit.BagValidationIncomplete):
+                for result in self.iter_validate(bag, max_seconds=0, cursor=cursor):
+                    results.append(result)
+            # the tag files are always checked
+            self.assertTrue('bagit.txt' in [r.path for r in results])
+            checked = [r.path for r in results if r.path.startswith('data/')]
+            self.assertTrue(checked)
+            covered.extend(checked)
+            if len(covered) >= 5:
+                break
+        self.assertEqual(sorted(covered[:5]), sorted(bag.payload_entries()))
+
+    def test_validate_max_seconds_incomplete(self):
+        bag = bagit.make_bag(self.tmpdir)
+        cursor = j(self.tmpdir, "cursor.json")
+        self.assertRaises(bagit.BagError, self.validate, bag, max_seconds=0)
+        self.assertRaises(bagit.BagValidationIncomplete, self.validate, bag, max_seconds=0, cursor=cursor)
+
+        output = io.StringIO()
+        with self.assertRaises(bagit.BagValidationIncomplete):
+            bagit.write_json_lines(self.iter_validate(bag, max_seconds=0, cursor=cursor), output, bag=bag)
+        summary = json.loads(output.getvalue().splitlines()[-1])
+        self.assertFalse(summary['valid'])
+        self.assertFalse(summary['complete'])
+
+        # problems found before the time ran out are still reported
+        with open(j(self.tmpdir, 'data', 'README'), 'r+b') as r:
+            r.write(b'X')
+        with mock.patch('bagit.Bag.sample_entries',
+                        return_value=['data/README', 'data/si/4011399822_65987a4806_b_d.jpg']):
+            self.assertRaises(bagit.BagValidationError, self.validate, bag, max_seconds=0, cursor=cursor)
+
+    def test_validate_journal(self):
+        bag = bagit.make_bag(self.tmpdir)
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        journal = j(journal_dir, 'journal.jsonl')
+        self.assertTrue(self.validate(bag, journal=journal))
+
+        # files whose signature has not changed are not read again
+        readme = j(self.tmpdir, 'data', 'README')
+        st = os.stat(readme)
+        with open(readme, 'r+') as r:
+            r.write('x')
+        os.utime(readme, (st.st_atime, st.st_mtime))
+        if hasattr(st, 'st_mtime_ns'):
+            os.utime(readme, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertTrue(self.validate(bag, journal=journal))
+
+        # but changed files are
+        os.utime(readme, (st.st_atime, st.st_mtime + 10))
+        self.assertRaises(bagit.BagValidationError, self.validate, bag, journal=journal)
+
+    def test_validate_dedupe(self):
+        os.link(j(self.tmpdir, 'README'), j(self.tmpdir, 'README-link'))
+        bag = bagit.make_bag(self.tmpdir)
+        self.assertTrue(self.validate(bag, dedupe=True))
+
+        # both entries for the shared inode are checked
+        with open(j(self.tmpdir, 'data', 'README'), 'a') as r:
+            r.write('x')
+        os.remove(j(self.tmpdir, 'bag-info.txt'))
+        bag = bagit.Bag(self.tmpdir)
+        results = [r.path for r in self.iter_validate(bag, dedupe=True)
+                   if not r.ok and r.path.startswith('data/')]
+        self.assertEqual(sorted(results), ['data/README', 'data/README-link'])
+
+    def test_validate_json_lines(self):
+        bag = bagit.make_bag(self.tmpdir, checksum=['md5', 'sha1'])
+        with open(j(self.tmpdir, 'data', 'README'), 'a') as r:
+            r.write('x')
+        os.remove(j(self.tmpdir, 'bag-info.txt'))
+        bag = bagit.Bag(self.tmpdir)
+
+        output = io.StringIO()
+        summary = bagit.write_json_lines(self.iter_validate(bag), output, bag=bag)
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(records[-1], summary)
+
+        readme = [r for r in records if r.get('path') == 'data/README']
+        self.assertEqual(sorted(r['algorithm'] for r in readme), ['md5', 'sha1'])
+        md5 = [r for r in readme if r['algorithm'] == 'md5'][0]
+        self.assertEqual(md5['status'], 'mismatch')
+        self.assertEqual(md5['expected'], '8e2af7a0143c7b8f4de0b3fc90f27354')
+        self.assertEqual(md5['bytes'], 222)
+        self.assertTrue(md5['duration'] >= 0)
+
+        self.assertFalse(summary['valid'])
+        self.assertEqual(summary['bytes'], 991766 + os.path.getsize(j(self.tmpdir, 'bagit.txt'))
+                         + os.path.getsize(j(self.tmpdir, 'manifest-md5.txt'))
+                         + os.path.getsize(j(self.tmpdir, 'manifest-sha1.txt')))
+        self.assertEqual(summary['statuses'], {'ok': 7, 'mismatch': 2, 'missing': 1})
+
+    def test_validate_partial(self):
+        bag = bagit.make_bag(self.tmpdir)
+        with open(j(self.tmpdir, 'data', 'si', '2584174182_ffd5c24905_b_d.jpg'), 'ab') as f:
+            f.write(b'x')
+        os.remove(j(self.tmpdir, 'data', 'loc', '3314493806_6f1db86d66_o_d.jpg'))
+        with open(j(self.tmpdir, 'data', 'loc', 'extra.txt'), 'w') as f:
+            f.write('extra')
+        bag = bagit.Bag(self.tmpdir)
+
+        # the Payload-Oxum describes the whole payload, so is not checked
+        self.assertTrue(self.validate(bag, include=['data/README']))
+        self.assertTrue(self.validate(bag, exclude=['data/si', 'data/loc/']))
+
+        results = list(self.iter_validate(bag, include=['data/*/*.jpg'], exclude=['data/si']))
+        self.assertEqual(sorted((r.path, r.status) for r in results if r.path.startswith('data')),
+                         [(j('data', 'loc', '2478433644_2839c5e8b8_o_d.jpg'), 'ok'),
+                          (j('data', 'loc', '3314493806_6f1db86d66_o_d.jpg'), 'mismatch'),
+                          (j('data', 'loc', '3314493806_6f1db86d66_o_d.jpg'), 'missing')])
+
+        with self.assertRaises(bagit.BagValidationError) as cm:
+            self.validate(bag, include=['data/loc'])
+        self.assertEqual(sorted(type(d).__name__ for d in cm.exception.details),
+                         ['ChecksumMismatch', 'FileMissing', 'UnexpectedFile'])
+        self.assertRaises(bagit.BagValidationError, self.validate, bag, fast=True, include=['data/README'])
+
+        # patterns are relative to the payload directory if they do not
+        # start with data/, and must match something in the manifests
+        with self.assertRaises(bagit.BagValidationError) as cm:
+            self.validate(bag, include=['loc'])
+        self.assertEqual(len(cm.exception.details), 3)
+        with self.assertRaises(bagit.BagError) as cm:
+            self.validate(bag, include=['data/nosuch', 'README'])
+        self.assertEqual(str(cm.exception), "no payload file in the manifests matches data/nosuch")
+
+        # only the directories which can hold matching files are walked
+        self.assertEqual(bagit._PathFilter(['data/si/*.jpg', 'data/si/x', 'data/README']).roots(),
+                         ['data/README', 'data/si'])
+        self.assertEqual(bagit._PathFilter(['*.jpg', 'bag-info.txt']).roots(), ['data'])
+
     def test_bom_in_bagit_txt(self):
         bag = bagit.make_bag(self.tmpdir)
         BOM = codecs.BOM_UTF8
@@ -331,6 +551,9 @@ class TestMultiprocessValidation(TestSingleProcessValidation):
     def validate(self, bag, *args, **kwargs):
         return super(TestMultiprocessValidation, self).validate(bag, *args, processes=2, **kwargs)
 
+    def iter_validate(self, bag, *args, **kwargs):
+        return super(TestMultiprocessValidation, self).iter_validate(bag, *args, processes=2, **kwargs)
+
 
 @mock.patch('bagit.VERSION', new='1.5.4')  # This avoids needing to change expected hashes on each release
 class TestBag(unittest.TestCase):
@@ -415,6 +638,518 @@ class TestBag(unittest.TestCase):
 
     def test_make_bag_unknown_algorithm(self):
         self.assertRaises(RuntimeError, bagit.make_bag, self.tmpdir, checksum=['not-really-a-name'])
+        # the payload should not have been moved
+        self.assertFalse(os.path.isdir(j(self.tmpdir, 'data')))
+
+    def test_make_bag_journal_resume(self):
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        journal = j(journal_dir, 'journal.jsonl')
+
+        # interrupt the creation of the bag after the payload has been hashed
+        with mock.patch('bagit._make_tagmanifests', side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, bagit.make_bag, self.tmpdir, journal=journal)
+        self.assertTrue(os.path.isdir(j(self.tmpdir, 'data')))
+
+        # resuming neither moves the payload again nor re-hashes it
+        with mock.patch('bagit._manifest_line', side_effect=AssertionError):
+            bag = bagit.make_bag(self.tmpdir, journal=journal)
+        self.assertFalse(os.path.exists(j(self.tmpdir, 'data', 'data')))
+        self.assertEqual(bag.entries['data/README']['md5'], '8e2af7a0143c7b8f4de0b3fc90f27354')
+        self.assertTrue(bag.validate())
+
+    def test_digest_store(self):
+        store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store_dir)
+        store = bagit.DigestStore(j(store_dir, 'digests.db'))
+        self.addCleanup(store.close)
+
+        # another directory with links to the same files
+        other_dir = j(store_dir, 'other')
+        for dirpath, _, filenames in os.walk(self.tmpdir):
+            os.makedirs(j(other_dir, os.path.relpath(dirpath, self.tmpdir)))
+            for filename in filenames:
+                os.link(j(dirpath, filename), j(other_dir, os.path.relpath(dirpath, self.tmpdir), filename))
+
+        bag = bagit.make_bag(self.tmpdir, digest_store=store)
+        with mock.patch('bagit._manifest_line', side_effect=AssertionError):
+            other = bagit.make_bag(other_dir, digest_store=store)
+        self.assertEqual(other.payload_entries(), bag.payload_entries())
+
+        hashed = []
+        hash_file = bagit._hash_file
+
+        def record(full_path, *args, **kwargs):
+            hashed.append(os.path.basename(full_path))
+            return hash_file(full_path, *args, **kwargs)
+
+        with mock.patch('bagit._hash_file', side_effect=record):
+            self.assertTrue(other.validate(digest_store=store))
+            self.assertFalse('README' in hashed)
+
+            # digests older than the audit cycle are not reused
+            del hashed[:]
+            store.max_age = 0
+            self.assertTrue(other.validate(digest_store=store))
+            self.assertTrue('README' in hashed)
+
+    @unittest.skipIf(not hasattr(os, 'posix_fadvise'), "posix_fadvise is not available")
+    def test_fadvise(self):
+        with mock.patch('os.posix_fadvise') as fadvise:
+            bag = bagit.make_bag(self.tmpdir, fadvise=True)
+            advice = [c[0][3] for c in fadvise.call_args_list]
+            # every payload file is read sequentially then dropped, and all
+            # but the first are prefetched
+            self.assertEqual(advice.count(os.POSIX_FADV_SEQUENTIAL), 5)
+            self.assertEqual(advice.count(os.POSIX_FADV_DONTNEED), 5)
+            self.assertEqual(advice.count(os.POSIX_FADV_WILLNEED), 4)
+
+            fadvise.reset_mock()
+            self.assertTrue(bag.validate(fadvise=True))
+            advice = [c[0][3] for c in fadvise.call_args_list]
+            self.assertEqual(advice.count(os.POSIX_FADV_DONTNEED), len(bag.entries))
+
+        with mock.patch('os.posix_fadvise') as fadvise:
+            self.assertTrue(bag.validate())
+            self.assertFalse(fadvise.called)
+
+    @unittest.skipIf(not os.path.isdir('/dev/shm'), "no second filesystem to test with")
+    def test_device_processes(self):
+        other_dir = tempfile.mkdtemp(dir='/dev/shm')
+        self.addCleanup(shutil.rmtree, other_dir)
+        if os.stat(other_dir).st_dev == os.stat(self.tmpdir).st_dev:
+            self.skipTest("/dev/shm is on the same device as %s" % self.tmpdir)
+        for name in ('a', 'b', 'c'):
+            with open(j(other_dir, name), 'w') as f:
+                f.write(name)
+            os.symlink(j(other_dir, name), j(self.tmpdir, name))
+
+        make_pool = bagit._make_pool
+        with mock.patch('bagit._make_pool', side_effect=make_pool) as pools:
+            bag = bagit.make_bag(self.tmpdir, device_processes={other_dir: 2})
+            # only the files on the second device are hashed by a pool
+            self.assertEqual([c[0][0] for c in pools.call_args_list], [2])
+            self.assertEqual(bag.entries['data/b']['md5'], hashlib.md5(b'b').hexdigest())
+
+            pools.reset_mock()
+            results = list(bag.iter_validate(processes=3, device_processes={other_dir: 2}))
+            self.assertEqual(sorted(c[0][0] for c in pools.call_args_list), [2, 3])
+            self.assertEqual(sorted(r.path for r in results), sorted(bag.entries))
+            self.assertTrue(all(r.ok for r in results))
+
+    def test_device_processes_single_device(self):
+        make_pool = bagit._make_pool
+        with mock.patch('bagit._make_pool', side_effect=make_pool) as pools:
+            bag = bagit.make_bag(self.tmpdir, device_processes={self.tmpdir: 3})
+            # the limit for the only device is kept
+            self.assertEqual([c[0][0] for c in pools.call_args_list], [3])
+
+            pools.reset_mock()
+            self.assertTrue(bag.validate(device_processes={self.tmpdir: 2}))
+            self.assertEqual([c[0][0] for c in pools.call_args_list], [2])
+
+    def test_device_processes_missing_path(self):
+        bag = bagit.make_bag(self.tmpdir)
+        missing = j(self.tmpdir, 'no-such-mount')
+        self.assertRaises(bagit.BagError, bag.validate, device_processes={missing: 2})
+        self.assertRaises(bagit.BagError, bag.save, manifests=True, device_processes={missing: 2})
+
+    def test_walk_tree(self):
+        os.makedirs(j(self.tmpdir, 'b', 'c'))
+        os.makedirs(j(self.tmpdir, 'a'))
+        for name in ('z', 'y'):
+            with open(j(self.tmpdir, 'b', 'c', name), 'w') as f:
+                f.write(name)
+        os.symlink(j(self.tmpdir, 'b'), j(self.tmpdir, 'link'))
+
+        expected = []
+        for dirpath, dirnames, filenames in os.walk(self.tmpdir):
+            dirnames.sort()
+            expected.append((dirpath, dirnames, sorted(filenames)))
+        self.assertEqual(list(bagit._walk_tree(self.tmpdir, threads=4)), expected)
+        self.assertEqual(list(bagit._walk_tree(self.tmpdir, threads=1)), expected)
+        self.assertEqual(list(bagit._walk_tree(j(self.tmpdir, 'missing'))), [])
+        # the walks share a pool
+        self.assertTrue(bagit._walk_pool(4) is bagit._walk_pool(4))
+
+        # pruned directories are not descended into
+        walked = []
+        for dirpath, dirnames, _ in bagit._walk_tree(self.tmpdir):
+            walked.append(dirpath)
+            if 'c' in dirnames:
+                dirnames.remove('c')
+        self.assertEqual(walked[:3], [self.tmpdir, j(self.tmpdir, 'a'), j(self.tmpdir, 'b')])
+        self.assertFalse(j(self.tmpdir, 'b', 'c') in walked)
+
+    def test_hash_batch(self):
+        bagit.make_bag(self.tmpdir, checksum=['md5', 'sha1'])
+        with open(j(self.tmpdir, 'data', 'README'), 'rb') as f:
+            readme = f.read()
+        batch = [('data/README', None, None), ('data/missing', ('md5',), 'data/README')]
+        context = (self.tmpdir, ('md5', 'sha1'), bagit.HASH_BLOCK_SIZE, False, None, None)
+
+        results = bagit._hash_batch(batch, context)
+        self.assertEqual(results[0][:3], ('data/README', (hashlib.md5(readme).hexdigest(),
+                                                          hashlib.sha1(readme).hexdigest()), len(readme)))
+        self.assertEqual(results[1][0], 'data/missing')
+        self.assertTrue('does not exist' in results[1][1])
+
+        # worker processes are given the context when they start
+        pool = bagit._make_pool(2, context=context)
+        self.addCleanup(pool.terminate)
+        self.assertEqual([r[:3] for r in pool.map(bagit._hash_batch, [batch])[0]], [r[:3] for r in results])
+
+    def test_read_small_file(self):
+        f = mock.Mock()
+        f.read.side_effect = [b'small', b'']
+        self.assertEqual(list(bagit._read_blocks(f, 1024, size=5)), [b'small'])
+        self.assertEqual(f.read.call_count, 1)
+
+        # a file which has grown since it was opened is read to the end
+        f.read.side_effect = [b'grown', b'!', b'']
+        self.assertEqual(list(bagit._read_blocks(f, 1024, size=4)), [b'grown', b'!'])
+
+    def test_rollups(self):
+        bag = bagit.make_bag(self.tmpdir, checksum=['md5', 'sha256'], rollup=True)
+        self.assertTrue('rollup-md5.txt' in bag.entries)
+        algorithm, rollups = bag.rollups()
+        self.assertEqual(algorithm, 'md5')
+        self.assertEqual(rollups[j('data', 'loc')][1:], (143435 + 139367, 2))
+        self.assertEqual(rollups['data'][1:], (991765, 5))
+        self.assertTrue(bag.is_valid())
+        self.assertTrue(bag.validate_subtree('loc'))
+
+        copy_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, copy_dir)
+        copy_dir = j(copy_dir, 'copy')
+        shutil.copytree(self.tmpdir, copy_dir)
+        copy = bagit.Bag(copy_dir)
+        self.assertEqual(bag.changed_directories(copy), [])
+
+        with open(j(copy_dir, 'data', 'loc', '2478433644_2839c5e8b8_o_d.jpg'), 'ab') as f:
+            f.write(b'x')
+        # only the changed subtree fails
+        self.assertTrue(copy.validate_subtree('data/si'))
+        self.assertRaises(bagit.BagValidationError, copy.validate_subtree, 'data/loc')
+
+        # the rollups are kept up to date by save, and point to the change
+        copy.save(manifests=True)
+        self.assertTrue(copy.validate_subtree('data/loc'))
+        self.assertEqual(bag.changed_directories(copy_dir), ['data', j('data', 'loc')])
+
+    def test_validate_sharded(self):
+        queue_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, queue_dir)
+        transport = bagit.DirectoryQueueTransport(queue_dir)
+        bag = bagit.make_bag(self.tmpdir, checksum=['md5', 'sha1'])
+
+        shards = bagit._balanced_shards(self.tmpdir, list(bag.payload_entries().items()), 2)
+        self.assertEqual(sorted(len(shard) for shard in shards), [2, 3])
+        self.assertEqual(sorted(path for shard in shards for path, _ in shard), sorted(bag.payload_entries()))
+
+        self.assertTrue(bag.validate_sharded(transport, shards=3, local_workers=2, poll_interval=0.05,
+                                             timeout=60))
+        # local workers can hash with a pool of their own
+        self.assertTrue(bag.validate_sharded(transport, shards=2, local_workers=1, processes=2,
+                                             poll_interval=0.05, timeout=60))
+
+        # corrupted without changing the Payload-Oxum
+        with open(j(self.tmpdir, 'data', 'si', '4011399822_65987a4806_b_d.jpg'), 'r+b') as f:
+            f.write(b'x')
+        # a worker in this process, so the coordinator only merges results
+        worker = threading.Thread(target=bagit.run_shard_worker, args=(transport,),
+                                  kwargs={'idle_timeout': 1, 'poll_interval': 0.05})
+        worker.start()
+        self.addCleanup(worker.join)
+        results = list(bag.iter_validate_sharded(transport, shards=4, poll_interval=0.05, timeout=60))
+        self.assertEqual(sorted(r.path for r in results), sorted(bag.entries))
+        self.assertEqual([(r.path, r.status) for r in results if not r.ok],
+                         [(j('data', 'si', '4011399822_65987a4806_b_d.jpg'), 'mismatch')])
+
+    def test_shard_worker_errors(self):
+        queue_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, queue_dir)
+        transport = bagit.DirectoryQueueTransport(queue_dir)
+        bag = bagit.make_bag(self.tmpdir)
+
+        # unexpected errors are returned to the coordinator
+        transport.put_shard('a', {'bag': self.tmpdir, 'entries': list(bag.payload_entries().items())})
+        with mock.patch('bagit.Bag._iter_hash_entries', side_effect=RuntimeError('boom')):
+            self.assertEqual(bagit.run_shard_worker(transport, idle_timeout=0, poll_interval=0.01), 1)
+        (shard_id, result), = transport.take_results(['a'])
+        self.assertEqual(result['error'], 'RuntimeError: boom')
+        self.assertEqual(os.listdir(j(queue_dir, 'claimed')), [])
+
+        # and local workers which die are noticed
+        with mock.patch('bagit.run_shard_worker', lambda *args, **kwargs: os._exit(3)):
+            with self.assertRaises(bagit.BagError) as cm:
+                bag.validate_sharded(transport, local_workers=1, poll_interval=0.05, timeout=60)
+        self.assertTrue('exited with code 3' in str(cm.exception))
+
+    def test_directory_queue_transport(self):
+        queue_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, queue_dir)
+        transport = bagit.DirectoryQueueTransport(queue_dir)
+        other = bagit.DirectoryQueueTransport(queue_dir)
+
+        transport.put_shard('a', {'entries': [['data/a', {'md5': 'x'}]]})
+        self.assertEqual(other.claim_shard('w1'), ('a', {'entries': [['data/a', {'md5': 'x'}]]}))
+        self.assertEqual(transport.claim_shard('w2'), None)
+
+        # a shard which has been claimed for too long is handed out again
+        transport.requeue_stale(-1)
+        self.assertEqual(transport.claim_shard('w2')[0], 'a')
+        transport.put_result('a', {'results': []})
+        self.assertEqual(list(transport.take_results(['a', 'b'])), [('a', {'results': []})])
+        self.assertEqual(list(transport.take_results(['a'])), [])
+        self.assertEqual(os.listdir(j(queue_dir, 'claimed')), [])
+
+    def test_daemon(self):
+        try:
+            from urllib.request import Request, urlopen
+        except ImportError:  # Python 2
+            from urllib2 import Request, urlopen
+
+        bagit.make_bag(self.tmpdir)
+        new_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, new_dir)
+        with open(j(new_dir, 'file.txt'), 'w') as f:
+            f.write('new')
+
+        daemon = bagit.ValidationDaemon(('127.0.0.1', 0), [self.tmpdir, new_dir], processes=2)
+        self.addCleanup(daemon.close)
+        daemon.start()
+        url = 'http://%s:%s' % daemon.address
+
+        def post(job):
+            request = Request(url + '/jobs', data=json.dumps(job).encode('utf-8'),
+                              headers={'Content-Type': 'application/json'})
+            return json.loads(urlopen(request).read().decode('utf-8'))
+
+        def get(path):
+            return urlopen(url + path).read().decode('utf-8')
+
+        job = post({'type': 'validate', 'path': self.tmpdir, 'priority': 5})
+        self.assertEqual(daemon.wait(job['id'], timeout=60)['status'], 'valid')
+        self.assertEqual(json.loads(get('/jobs/' + job['id']))['files'], 8)
+
+        with open(j(self.tmpdir, 'data', 'README'), 'r+') as f:
+            f.write('x')
+        job = post({'type': 'validate', 'path': self.tmpdir})
+        job = daemon.wait(job['id'], timeout=60)
+        self.assertEqual((job['status'], job['error_count']), ('invalid', 1))
+        self.assertTrue('data/README' in job['errors'][0])
+
+        job = post({'type': 'create', 'path': new_dir, 'options': {'checksum': ['sha256']}})
+        self.assertEqual(daemon.wait(job['id'], timeout=60)['status'], 'done')
+        self.assertTrue(bagit.Bag(new_dir).is_valid())
+
+        metrics = get('/metrics')
+        self.assertTrue('bagit_jobs_total{status="valid",type="validate"} 1' in metrics)
+        self.assertTrue('bagit_validation_errors_total 1' in metrics)
+        self.assertTrue('bagit_job_duration_seconds_count{type="create"} 1' in metrics)
+        self.assertTrue('bagit_queue_depth 0' in metrics)
+        self.assertEqual(len(json.loads(get('/jobs'))), 3)
+        self.assertRaises(Exception, post, {'type': 'destroy', 'path': new_dir})
+
+        # options naming files, and paths outside the roots, are refused
+        cursor = j(new_dir, 'cursor.json')
+        self.assertRaises(Exception, post, {'path': self.tmpdir, 'options': {'cursor': cursor}})
+        self.assertRaises(ValueError, daemon.submit, 'validate', self.tmpdir, options={'journal': cursor})
+        self.assertRaises(ValueError, daemon.submit, 'validate', self.tmpdir, options={'processes': '2'})
+        self.assertRaises(ValueError, daemon.submit, 'validate', self.tmpdir, options={'processes': 100000})
+        self.assertRaises(ValueError, daemon.submit, 'create', new_dir, options={'processes': 100000})
+        self.assertRaises(ValueError, daemon.submit, 'create', os.path.dirname(self.tmpdir))
+        os.symlink(os.path.dirname(self.tmpdir), j(new_dir, 'escape'))
+        self.assertRaises(ValueError, daemon.submit, 'validate', j(new_dir, 'escape'))
+        self.assertFalse(os.path.exists(cursor))
+        self.assertEqual(len(daemon.jobs()), 3)
+        self.assertRaises(ValueError, bagit.ValidationDaemon, ('127.0.0.1', 0), [])
+
+    def test_daemon_max_bytes_per_second(self):
+        bag = bagit.make_bag(self.tmpdir)
+        pool = bagit._make_pool(2)
+        self.addCleanup(pool.terminate)
+        # a running process pool cannot be throttled after the fact
+        self.assertRaises(bagit.BagError, bag.validate, pool=pool, max_bytes_per_second=5000000)
+
+        daemon = bagit.ValidationDaemon(('127.0.0.1', 0), [self.tmpdir], processes=2,
+                                        max_bytes_per_second=5000000)
+        self.addCleanup(daemon.close)
+        daemon.start()
+        job = daemon.wait(daemon.submit('validate', self.tmpdir)['id'], timeout=60)
+        self.assertEqual(job['status'], 'valid')
+        # the worker processes share the limit
+        self.assertTrue(job['finished'] - job['started'] >= (991765 - 381813) / 5000000.0)
+
+    def test_daemon_auto_processes(self):
+        bagit.make_bag(self.tmpdir)
+        settings = {'processes': 2, 'executor': 'thread', 'block_size': bagit.HASH_BLOCK_SIZE}
+        with mock.patch('bagit._hashing_settings', return_value=settings) as hashing_settings:
+            daemon = bagit.ValidationDaemon(('127.0.0.1', 0), [self.tmpdir], processes='auto')
+        self.addCleanup(daemon.close)
+        daemon.start()
+        self.assertEqual(hashing_settings.call_args[0][:2], ('auto', os.path.realpath(self.tmpdir)))
+        self.assertTrue(isinstance(daemon._pool, multiprocessing.pool.ThreadPool))
+        job = daemon.wait(daemon.submit('validate', self.tmpdir)['id'], timeout=60)
+        self.assertEqual(job['status'], 'valid')
+
+    @unittest.skipIf(not hasattr(socket, 'AF_UNIX'), "Unix sockets are not available")
+    def test_daemon_unix_socket(self):
+        socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, socket_dir)
+        daemon = bagit.ValidationDaemon(j(socket_dir, 'bagit.sock'), [socket_dir])
+        self.addCleanup(daemon.close)
+        daemon.start()
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(client.close)
+        client.connect(j(socket_dir, 'bagit.sock'))
+        client.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            response += data
+        self.assertTrue(response.startswith(b'HTTP/1.0 200'))
+        self.assertTrue(b'bagit_hashed_files_total 0' in response)
+
+    def test_catalog(self):
+        archive = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive)
+        for name, group in (('one', 'A'), ('two', 'A'), ('three', 'B')):
+            shutil.copytree('test-data', j(archive, name))
+            bagit.make_bag(j(archive, name), {'Bag-Group-Identifier': group, 'Contact-Name': ['x', 'y']},
+                           checksum=['md5', 'sha256'])
+        with open(j(archive, 'three', 'data', 'new.txt'), 'w') as f:
+            f.write('new')
+        bagit.Bag(j(archive, 'three')).save(manifests=True)
+
+        catalog = bagit.BagCatalog(j(archive, 'catalog.db'))
+        self.addCleanup(catalog.close)
+        self.assertEqual(catalog.update_all(archive), 3)
+        # unchanged bags are not indexed again
+        self.assertEqual(catalog.update_all(archive), 0)
+
+        readme = hashlib.sha256(slurp_text_file(j('test-data', 'README')).encode('utf-8')).hexdigest()
+        self.assertEqual(catalog.find_digest(readme.upper()),
+                         [(j(archive, name), 'data/README', 'sha256') for name in ('one', 'three', 'two')])
+        self.assertEqual(catalog.find_digest(hashlib.md5(b'new').hexdigest(), algorithm='md5'),
+                         [(j(archive, 'three'), 'data/new.txt', 'md5')])
+        self.assertEqual(catalog.find_path('data/*.txt'), [(j(archive, 'three'), 'data/new.txt')])
+        self.assertEqual(catalog.bags(Bag_Group_Identifier='A'), [j(archive, 'one'), j(archive, 'two')])
+        self.assertEqual(catalog.oxum(Bag_Group_Identifier='A'), (2 * 991765, 10))
+        self.assertEqual(catalog.info(j(archive, 'one'))['Contact-Name'], ['x', 'y'])
+
+        # changed manifests are indexed again, and removed bags forgotten
+        bag = bagit.Bag(j(archive, 'two'))
+        os.remove(j(archive, 'two', 'data', 'README'))
+        bag.save(manifests=True)
+        shutil.rmtree(j(archive, 'one'))
+        self.assertEqual(catalog.update_all(archive), 1)
+        self.assertEqual(catalog.find_digest(readme), [(j(archive, 'three'), 'data/README', 'sha256')])
+        self.assertEqual(catalog.oxum(Bag_Group_Identifier='A'), (991765 - 221, 4))
+
+    def test_manifest_index(self):
+        bag = bagit.make_bag(self.tmpdir, checksum=['md5', 'sha256'])
+        expected = dict(bag.entries)
+
+        # the index is written on the first open, then used instead of the manifests
+        bag = bagit.Bag(self.tmpdir, index=True)
+        self.assertTrue(os.path.isfile(j(self.tmpdir, bagit.MANIFEST_INDEX)))
+        with mock.patch('bagit._iter_manifest') as iter_manifest:
+            bag = bagit.Bag(self.tmpdir, index=True)
+        self.assertFalse(iter_manifest.called)
+        self.assertTrue(isinstance(bag.entries, bagit._IndexedEntries))
+        self.assertEqual(sorted(bag.algs), ['md5', 'md5', 'sha256', 'sha256'])
+        self.assertEqual(dict(bag.entries), expected)
+        self.assertEqual(len(bag.entries), len(expected))
+        # whole passes read the rows in order rather than looking up each key
+        with mock.patch.object(bagit._IndexedEntries, '_find') as find:
+            self.assertEqual(bag.payload_entries(), dict((k, v) for k, v in expected.items()
+                                                         if k.startswith('data' + os.sep)))
+            self.assertEqual(sorted(map(sorted, bag.entries.values())),
+                             sorted(map(sorted, expected.values())))
+        self.assertFalse(find.called)
+        self.assertTrue('data/README' in bag.entries)
+        self.assertFalse('data/nothing' in bag.entries)
+        self.assertTrue(bag.validate())
+
+        # the index is not a tag file
+        bag.save()
+        self.assertFalse(bagit.MANIFEST_INDEX in slurp_text_file(j(self.tmpdir, 'tagmanifest-md5.txt')))
+
+        # a manifest rewritten within the resolution of its modification time
+        # is caught by its hash, and the index written again
+        manifest = j(self.tmpdir, 'manifest-md5.txt')
+        st = os.stat(manifest)
+        text = slurp_text_file(manifest)
+        with open(manifest, 'w') as f:
+            f.write(text.replace(expected['data/README']['md5'], 'f' * 32))
+        os.utime(manifest, (st.st_atime, st.st_mtime))
+        bag = bagit.Bag(self.tmpdir, index=True)
+        self.assertEqual(bag.entries['data/README']['md5'], 'f' * 32)
+        with mock.patch('bagit._iter_manifest') as iter_manifest:
+            bag = bagit.Bag(self.tmpdir, index=True)
+        self.assertFalse(iter_manifest.called)
+        self.assertEqual(bag.entries['data/README']['md5'], 'f' * 32)
+
+        # as is one replaced long after the index was written, with its
+        # modification time preserved as by cp -p
+        with mock.patch('bagit._INDEX_RACY_WINDOW', 0):
+            with open(manifest, 'w') as f:
+                f.write(text)
+            os.utime(manifest, (st.st_atime, st.st_mtime))
+            bag = bagit.Bag(self.tmpdir, index=True)
+            self.assertEqual(bag.entries['data/README']['md5'], expected['data/README']['md5'])
+
+    def test_make_bag_dedupe(self):
+        os.link(j(self.tmpdir, 'README'), j(self.tmpdir, 'README-link'))
+        manifest_line = bagit._manifest_line
+        with mock.patch('bagit._manifest_line', side_effect=manifest_line) as hashed:
+            bag = bagit.make_bag(self.tmpdir, dedupe=True)
+        self.assertEqual(hashed.call_count, 5)
+        self.assertEqual(bag.entries['data/README-link'], bag.entries['data/README'])
+        self.assertTrue('Payload-Oxum: 991986.6' in slurp_text_file(j(self.tmpdir, 'bag-info.txt')))
+        self.assertTrue(bag.validate())
+
+    @unittest.skipIf(not hasattr(hashlib, 'blake2b'), "blake2b is not available")
+    def test_make_bag_blake2b_manifest(self):
+        bag = bagit.make_bag(self.tmpdir, checksum=['blake2b', 'sha512'])
+        with open(j(self.tmpdir, 'data', 'README'), 'rb') as readme:
+            expected = hashlib.blake2b(readme.read()).hexdigest()
+        manifest_txt = slurp_text_file(j(self.tmpdir, 'manifest-blake2b.txt'))
+        self.assertTrue('%s  data/README' % expected in manifest_txt)
+        self.assertTrue(os.path.isfile(j(self.tmpdir, 'tagmanifest-blake2b.txt')))
+        self.assertEqual(bag.entries['data/README']['blake2b'], expected)
+        self.assertTrue(bag.validate(processes=2))
+
+    def test_register_hash_algorithm(self):
+        def unavailable():
+            raise ImportError("no such module")
+
+        def disagrees():
+            return hashlib.md5()
+
+        bagit.register_hash_algorithm('test-sha256', unavailable)
+        bagit.register_hash_algorithm('test-sha256', hashlib.sha256)
+        bagit.register_hash_algorithm('test-sha256', disagrees)
+        try:
+            self.assertEqual(bagit._hash_factory('test-sha256'), hashlib.sha256)
+            bag = bagit.make_bag(self.tmpdir, checksum=['test-sha256'])
+            self.assertTrue(os.path.isfile(j(self.tmpdir, 'manifest-test-sha256.txt')))
+            self.assertEqual(bag.entries['data/si/2584174182_ffd5c24905_b_d.jpg']['test-sha256'],
+                             'f065a4ae2bc5d47c6d046c3cba5c8cdfd66b07c96ff3604164e2c31328e41c1a')
+            self.assertTrue(bag.validate())
+        finally:
+            del bagit.HASH_ALGORITHMS['test-sha256']
+            bagit._SELECTED_HASH_FACTORIES.pop('test-sha256', None)
+            bagit.CHECKSUM_ALGOS.remove('test-sha256')
+
+    def test_unavailable_hash_algorithm(self):
+        self.assertEqual(bagit._hash_factory('not-really-a-name'), None)
+        self.assertRaises(ValueError, bagit._hasher, 'not-really-a-name')
 
     def test_make_bag_with_data_dir_present(self):
         os.mkdir(j(self.tmpdir, 'data'))
@@ -464,6 +1199,74 @@ Tag-File-Character-Encoding: UTF-8
             bf.write(bagfile)
         self.assertRaises(bagit.BagValidationError, bagit.Bag, self.tmpdir)
 
+    def test_make_bag_does_not_change_cwd(self):
+        cwd = os.getcwd()
+        bag = bagit.make_bag(self.tmpdir)
+        self.assertEqual(os.getcwd(), cwd)
+        bag.info['foo'] = 'bar'
+        bag.save(manifests=True)
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertTrue(bag.is_valid())
+
+    def test_make_bags_in_threads(self):
+        bag_dirs = []
+        for i in range(4):
+            bag_dir = j(self.tmpdir, 'bag%d' % i)
+            shutil.copytree('test-data', bag_dir)
+            bag_dirs.append(bag_dir)
+
+        errors = []
+
+        def make_and_save(bag_dir):
+            try:
+                bag = bagit.make_bag(bag_dir, checksum=['sha256'])
+                bag.info['Contact-Name'] = bag_dir
+                bag.save(manifests=True)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=make_and_save, args=(d,)) for d in bag_dirs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        for bag_dir in bag_dirs:
+            bag = bagit.Bag(bag_dir)
+            self.assertEqual(bag.info['Contact-Name'], bag_dir)
+            self.assertTrue(bag.is_valid())
+
+    def test_tune(self):
+        cache_file = j(self.tmpdir, 'tuning.json')
+        settings = bagit.tune(self.tmpdir, ['sha256'], persist=True, cache_file=cache_file)
+        self.assertTrue(1 <= settings['processes'] <= multiprocessing.cpu_count())
+        self.assertTrue(settings['executor'] in ('process', 'thread'))
+        self.assertTrue(settings['block_size'] > 0)
+        self.assertEqual(bagit._load_tuning(self.tmpdir, ['sha256'], cache_file), settings)
+        self.assertEqual(bagit._load_tuning(self.tmpdir, ['md5'], cache_file), None)
+
+    def test_auto_processes(self):
+        settings = {'processes': 2, 'executor': 'thread', 'block_size': 65536}
+        with mock.patch('bagit._load_tuning', return_value=settings):
+            bag = bagit.make_bag(self.tmpdir, processes='auto')
+            self.assertTrue(bag.validate(processes='auto'))
+            bag.save(processes='auto', manifests=True)
+        with mock.patch('bagit._load_tuning', return_value=None):
+            with mock.patch('bagit.tune', return_value=settings) as tune:
+                self.assertTrue(bag.validate(processes='auto'))
+                self.assertTrue(tune.called)
+
+    def test_auto_processes_tunes_once(self):
+        settings = {'processes': 2, 'executor': 'thread', 'block_size': 65536}
+        bag = bagit.make_bag(self.tmpdir)
+        with mock.patch.dict('bagit._TUNED_SETTINGS', clear=True):
+            with mock.patch('bagit._load_tuning', return_value=None):
+                with mock.patch('bagit.tune', return_value=settings) as tune:
+                    self.assertTrue(bag.validate(processes='auto'))
+                    bag.save(processes='auto', manifests=True)
+                    self.assertEqual(tune.call_count, 1)
+
     def test_make_bag_multiprocessing(self):
         bagit.make_bag(self.tmpdir, processes=2)
         self.assertTrue(os.path.isdir(j(self.tmpdir, 'data')))
@@ -558,6 +1361,95 @@ Tag-File-Character-Encoding: UTF-8
         bag = bagit.Bag(self.tmpdir)
         self.assertTrue(bag.is_valid())
 
+    def test_save_rehashes_changed_tag_files(self):
+        bag = bagit.make_bag(self.tmpdir, checksum=['md5', 'sha256'])
+        extra = j(self.tmpdir, 'extra.txt')
+        with open(extra, 'w') as f:
+            f.write('extra')
+        os.utime(extra, (time.time() - 60, time.time() - 60))
+        bag.save()
+
+        hashed = []
+        calculate = bagit._calculate_file_hashes
+
+        def record(full_path, f_hashers, *args, **kwargs):
+            hashed.append((os.path.relpath(full_path, self.tmpdir), sorted(f_hashers)))
+            return calculate(full_path, f_hashers, *args, **kwargs)
+
+        with mock.patch('bagit._calculate_file_hashes', side_effect=record):
+            bag.info['foo'] = 'bar'
+            bag.save()
+            self.assertEqual(hashed, [('bag-info.txt', ['md5', 'sha256'])])
+
+            del hashed[:]
+            with open(extra, 'w') as f:
+                f.write('changed')
+            os.utime(extra, (time.time() + 60, time.time() + 60))
+            bag.save()
+            self.assertEqual(sorted(h[0] for h in hashed), ['bag-info.txt', 'extra.txt'])
+
+            # a tag file replaced with its modification time preserved, as
+            # by cp -p, is hashed again
+            del hashed[:]
+            bag = bagit.Bag(self.tmpdir)
+            mtime = os.stat(extra).st_mtime
+            with open(extra, 'w') as f:
+                f.write('replaced')
+            os.utime(extra, (mtime - 120, mtime - 120))
+            bag.save()
+            self.assertEqual(sorted(h[0] for h in hashed), ['bag-info.txt', 'extra.txt'])
+
+        self.assertTrue(bagit.Bag(self.tmpdir).is_valid())
+
+    def test_save_updates_entries(self):
+        bag = bagit.make_bag(self.tmpdir, checksum=['md5', 'sha1'])
+        with open(j(self.tmpdir, 'data', 'newfile'), 'w') as nf:
+            nf.write('newfile')
+        with mock.patch.object(bagit.Bag, '_load_manifests') as load_manifests:
+            bag.info['foo'] = 'bar'
+            bag.save()
+            self.assertFalse('data/newfile' in bag.entries)
+            bag.save(manifests=True)
+            self.assertFalse(load_manifests.called)
+        self.assertEqual(bag.entries, bagit.Bag(self.tmpdir).entries)
+        self.assertTrue(bag.is_valid())
+
+    def test_diff_bags(self):
+        bagit.make_bag(self.tmpdir)
+        new_dir = tempfile.mkdtemp()
+        shutil.rmtree(new_dir)
+        shutil.copytree(self.tmpdir, new_dir)
+        self.addCleanup(shutil.rmtree, new_dir)
+
+        with open(j(new_dir, 'data', 'README'), 'a') as r:
+            r.write('x')
+        os.rename(j(new_dir, 'data', 'si', '2584174182_ffd5c24905_b_d.jpg'), j(new_dir, 'data', 'renamed.jpg'))
+        os.remove(j(new_dir, 'data', 'loc', '3314493806_6f1db86d66_o_d.jpg'))
+        with open(j(new_dir, 'data', 'added'), 'w') as f:
+            f.write('added')
+        bagit.Bag(new_dir).save(manifests=True)
+
+        with open(j(new_dir, 'data', 'README'), 'rb') as r:
+            readme_digest = hashlib.md5(r.read()).hexdigest()
+        expected = [
+            bagit.PayloadChange('modified', 'data/README', old_digest='8e2af7a0143c7b8f4de0b3fc90f27354',
+                                new_digest=readme_digest),
+            bagit.PayloadChange('removed', 'data/loc/3314493806_6f1db86d66_o_d.jpg',
+                                old_digest='6172e980c2767c12135e3b9d246af5a3'),
+            bagit.PayloadChange('renamed', 'data/renamed.jpg', old_path='data/si/2584174182_ffd5c24905_b_d.jpg',
+                                old_digest='38a84cd1c41de793a0bccff6f3ec8ad0',
+                                new_digest='38a84cd1c41de793a0bccff6f3ec8ad0'),
+            bagit.PayloadChange('added', 'data/added', new_digest=hashlib.md5(b'added').hexdigest()),
+        ]
+
+        key = lambda c: (c.status, c.path)
+        # spilling every entry to disk gives the same result
+        for chunk_size in (100000, 1):
+            changes = list(bagit.diff_bags(self.tmpdir, new_dir, chunk_size=chunk_size))
+            self.assertEqual(sorted(changes, key=key), sorted(expected, key=key))
+        self.assertEqual(list(bagit.diff_bags(self.tmpdir, self.tmpdir)), [])
+        self.assertRaises(bagit.BagError, bagit.diff_bags, self.tmpdir, new_dir, algorithm='sha1')
+
     def test_save_only_baginfo(self):
         bag = bagit.make_bag(self.tmpdir)
         with open(j(self.tmpdir, 'data', 'newfile'), 'w') as nf:
@@ -578,5 +1470,146 @@ Tag-File-Character-Encoding: UTF-8
         bag = bagit.Bag(self.tmpdir)
         self.assertEqual(bag.info['test'], '♡')
 
+@unittest.skipIf(not sys.platform.startswith('linux'), "inotify is only available on Linux")
+class TestBagWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        shutil.copytree('test-data', self.tmpdir)
+        self.bag = bagit.make_bag(self.tmpdir)
+        self.watcher = bagit.BagWatcher(self.bag)
+
+    def tearDown(self):
+        self.watcher.close()
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def poll(self):
+        return dict((r.path, r.status) for r in self.watcher.poll(timeout=5))
+
+    def test_payload_changes(self):
+        self.assertTrue(self.watcher.is_valid)
+        readme = j(self.tmpdir, 'data', 'README')
+        with open(readme, 'a') as r:
+            r.write('x')
+        self.assertEqual(self.poll(), {'data/README': 'mismatch'})
+        self.assertFalse(self.watcher.is_valid)
+
+        os.remove(readme)
+        self.assertEqual(self.poll(), {'data/README': 'missing'})
+
+        os.makedirs(j(self.tmpdir, 'data', 'new'))
+        with open(j(self.tmpdir, 'data', 'new', 'file'), 'w') as f:
+            f.write('new')
+        self.assertEqual(self.poll(), {'data/new/file': 'unexpected'})
+
+        shutil.rmtree(j(self.tmpdir, 'data', 'new'))
+        self.assertEqual(self.poll(), {'data/new/file': 'ok'})
+        self.assertFalse('data/new/file' in self.watcher.results)
+        self.assertEqual([p for p, r in self.watcher.results.items() if not r.ok], ['data/README'])
+
+    def test_manifest_changes(self):
+        with open(j(self.tmpdir, 'data', 'README'), 'a') as r:
+            r.write('x')
+        self.poll()
+        self.assertFalse(self.watcher.is_valid)
+
+        # saving new manifests makes the bag valid again
+        bagit.Bag(self.tmpdir).save(manifests=True)
+        self.poll()
+        self.assertTrue(self.watcher.is_valid)
+        self.assertEqual(self.watcher.bag.entries, bagit.Bag(self.tmpdir).entries)
+
+
+@unittest.skipIf(bagit.asyncio is None, "asyncio is not available")
+class TestAsyncAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        shutil.copytree('test-data', self.tmpdir)
+        self.loop = bagit.asyncio.new_event_loop()
+        bagit.asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        bagit.asyncio.set_event_loop(None)
+        self.loop.close()
+        if os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+
+    def collect(self, bag, **kwargs):
+        results = []
+        aiter = bag.iter_validate_async(**kwargs)
+        while True:
+            try:
+                results.append(self.loop.run_until_complete(aiter.__anext__()))
+            except StopAsyncIteration:
+                return results
+
+    def test_make_bag_async(self):
+        bag = self.loop.run_until_complete(bagit.make_bag_async(self.tmpdir, checksum=['sha256']))
+        self.assertTrue(isinstance(bag, bagit.Bag))
+        self.assertTrue(self.loop.run_until_complete(bag.validate_async(concurrency=2)))
+
+    def test_make_bag_async_rollup_pool(self):
+        pool = bagit._make_pool(2, 'thread')
+        try:
+            bag = self.loop.run_until_complete(bagit.make_bag_async(self.tmpdir, rollup=True, pool=pool))
+        finally:
+            pool.terminate()
+        self.assertTrue('rollup-md5.txt' in bag.entries)
+        self.assertTrue(bag.is_valid())
+
+    def test_iter_validate_async(self):
+        bag = bagit.make_bag(self.tmpdir)
+        with open(j(self.tmpdir, "data", "README"), "w") as r:
+            r.write("changed")
+        os.remove(j(self.tmpdir, "bag-info.txt"))
+        bag = bagit.Bag(self.tmpdir)
+
+        results = self.collect(bag, concurrency=3)
+        statuses = dict((r.path, r.status) for r in results)
+        self.assertEqual(statuses['data/README'], bagit.FileValidationResult.MISMATCH)
+        self.assertEqual(statuses['data/loc/2478433644_2839c5e8b8_o_d.jpg'], bagit.FileValidationResult.OK)
+        self.assertEqual(len([r for r in results if r.status == bagit.FileValidationResult.MISSING]), 1)
+
+        with self.assertRaises(bagit.BagValidationError) as cm:
+            self.loop.run_until_complete(bag.validate_async(concurrency=3))
+        self.assertEqual(len(cm.exception.details), 3)
+
+    def test_validate_async_structure_error(self):
+        bagit.make_bag(self.tmpdir)
+        bag = bagit.Bag(self.tmpdir)
+        os.remove(j(self.tmpdir, "manifest-md5.txt"))
+        self.assertRaises(bagit.BagValidationError, self.loop.run_until_complete, bag.validate_async())
+
+    def test_cancel_validate_async(self):
+        bag = bagit.make_bag(self.tmpdir)
+        aiter = bag.iter_validate_async(concurrency=2)
+        waiter = aiter.__anext__()
+        waiter.cancel()
+        self.loop.run_until_complete(bagit.asyncio.sleep(0))
+        self.assertTrue(aiter._cancelled.is_set())
+        # the validation thread stops, terminating its pool
+        aiter._thread.join(10)
+        self.assertFalse(aiter._thread.is_alive())
+
+    def test_iter_validate_async_options(self):
+        bag = bagit.make_bag(self.tmpdir)
+        results = self.collect(bag, concurrency=2, executor='process', include=['data/loc'])
+        self.assertEqual(sorted(r.path for r in results if r.path.startswith('data')),
+                         [j('data', 'loc', '2478433644_2839c5e8b8_o_d.jpg'),
+                          j('data', 'loc', '3314493806_6f1db86d66_o_d.jpg')])
+        self.assertTrue(all(r.ok for r in results))
+
+        # files are not hashed any further once the validation is cancelled
+        cancelled = threading.Event()
+        cancelled.set()
+        self.assertRaises(bagit.BagError, list, bag.iter_validate(cancelled=cancelled))
+
+
 if __name__ == '__main__':
     unittest.main()